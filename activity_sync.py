@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Activity-driven bulk sync of personal bests, attempts and last attempt dates.
+
+Instead of up to four Strava calls per segment, this walks the athlete's
+activities (/athlete/activities pages, fetched concurrently), fetches each
+detailed activity once, and keeps the segment efforts embedded in it that are on
+segments in the items table. Activities are read oldest first in batches, and
+each batch is written in bulk: one upsert into segment_efforts and one into
+user_segment_stats. For an athlete who runs the same loops this covers every
+tracked segment with a fraction of the quota.
+
+The first run (or --full) reads the whole activity history, keeping a checkpoint
+in backfill_checkpoints so a run that fails part way resumes where it stopped.
+Later runs only read activities since the previous run, and only add efforts to
+segments whose history is already stored; other tracked segments are handed to
+the background refresher for a full per-segment sync.
+
+Usage:
+    python activity_sync.py                    # Every connected athlete
+    python activity_sync.py --athlete 123456   # One athlete (Strava athlete ID)
+    python activity_sync.py --full             # Re-read the whole history
+    python activity_sync.py --days 30          # Only the last 30 days
+"""
+
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import httpx
+from dotenv import load_dotenv
+from sqlalchemy.orm import Session
+
+import app_logging
+import models
+import segment_efforts
+import stats_refresher
+from database import SessionLocal
+from strava_client import STRAVA_API_URL, RateLimiter, get_valid_access_token_async
+
+# Load environment variables
+load_dotenv()
+
+# Strava's maximum page size for /athlete/activities
+ACTIVITIES_PER_PAGE = 200
+
+# Activity list pages requested together
+MAX_CONCURRENT_PAGES = 4
+
+# Detailed activity requests in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+
+# Attempts per request for 429s, 5xx and network errors
+MAX_ATTEMPTS = 4
+
+# Detailed activities read, and their efforts committed, together
+ACTIVITIES_PER_BATCH = 50
+
+# Incremental runs re-read this far back, for activities uploaded a while after they were recorded.
+# A resumed history sync re-reads this far back from its checkpoint for the same reason.
+RESYNC_OVERLAP = timedelta(days=2)
+
+
+async def _gather(*awaitables) -> list:
+    """asyncio.gather that cancels the other requests if one fails, instead of leaving them running"""
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _get(client: httpx.AsyncClient, limiter: RateLimiter, url: str, access_token: str,
+               params: Optional[dict] = None) -> Optional[httpx.Response]:
+    """GET with backoff on rate limits and transient errors. None if the object is gone."""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        response = None
+        try:
+            response = await limiter.get(
+                client, url,
+                headers={"Authorization": f"Bearer {access_token}"},
+                params=params,
+                timeout=15.0,
+            )
+        except httpx.TransportError:
+            if attempt == MAX_ATTEMPTS:
+                raise
+
+        if response is not None:
+            if response.status_code == 200:
+                return response
+            if response.status_code == 404:
+                return None
+            if attempt == MAX_ATTEMPTS or (response.status_code != 429 and response.status_code < 500):
+                response.raise_for_status()
+
+        delay = limiter.backoff_delay(response, attempt)
+        if response is not None and response.status_code == 429:
+            limiter.pause(delay)
+        await asyncio.sleep(delay)
+
+
+async def fetch_activity_summaries(client: httpx.AsyncClient, limiter: RateLimiter, access_token: str,
+                                   after: Optional[datetime] = None) -> List[dict]:
+    """Every activity since `after`, reading MAX_CONCURRENT_PAGES list pages at a time"""
+    params = {"per_page": ACTIVITIES_PER_PAGE}
+    if after:
+        params["after"] = int((after - datetime(1970, 1, 1)).total_seconds())
+
+    # Incremental runs usually fit on one page, so only fan out once the first page is full
+    url = f"{STRAVA_API_URL}/athlete/activities"
+    response = await _get(client, limiter, url, access_token, {**params, "page": 1})
+    activities = response.json() if response is not None else []
+    next_page = 2
+    while len(activities) == (next_page - 1) * ACTIVITIES_PER_PAGE:
+        pages = await _gather(*(
+            _get(client, limiter, url, access_token, {**params, "page": page})
+            for page in range(next_page, next_page + MAX_CONCURRENT_PAGES)
+        ))
+        for response in pages:
+            page = response.json() if response is not None else []
+            activities.extend(page)
+            if len(page) < ACTIVITIES_PER_PAGE:
+                return activities
+        next_page += MAX_CONCURRENT_PAGES
+    return activities
+
+
+def _has_segment_efforts(activity: dict) -> bool:
+    # Manual and indoor activities have no GPS track, so no segment efforts
+    return not activity.get("manual") and bool(activity.get("start_latlng"))
+
+
+def _start_time(activity: dict) -> datetime:
+    return segment_efforts.parse_strava_time(activity.get("start_date")) or datetime.min
+
+
+async def sync_athlete_activities(db: Session, user: models.User, client: httpx.AsyncClient,
+                                  limiter: RateLimiter, full: bool = False, days: Optional[int] = None) -> int:
+    """Sync one athlete's PBs from their activities. Returns the number of tracked segments updated.
+
+    Activities are read oldest first, ACTIVITIES_PER_BATCH at a time, and each batch's efforts and stats
+    are committed together. A history sync (first run or --full) moves a checkpoint forward in the same
+    commit, so after a failure the next run resumes from it instead of reading the whole history again.
+    """
+    access_token = await get_valid_access_token_async(user, db)
+    if not access_token:
+        print(f"❌ Athlete {user.strava_id}: could not get a valid Strava access token")
+        return 0
+
+    # Without a full history read, only segments whose efforts are already stored
+    # can safely take new ones - anything else would undercount attempts
+    complete_history = days is None and (full or user.activities_synced_through is None)
+    checkpoint = None
+    if days is not None:
+        after = datetime.utcnow() - timedelta(days=days)
+    elif complete_history:
+        after = None
+        job = f"activity_history:{user.id}"
+        checkpoint = db.query(models.BackfillCheckpoint).filter(models.BackfillCheckpoint.job == job).first()
+        if checkpoint is None:
+            checkpoint = models.BackfillCheckpoint(job=job, last_item_id=0, processed=0)
+            db.add(checkpoint)
+            db.flush()
+        elif checkpoint.resume_after is not None:
+            after = checkpoint.resume_after - RESYNC_OVERLAP
+            print(f"↩️  Athlete {user.strava_id}: resuming the history sync from {checkpoint.resume_after:%Y-%m-%d}")
+    else:
+        after = user.activities_synced_through - RESYNC_OVERLAP
+    started_at = datetime.utcnow()
+
+    summaries = [a for a in await fetch_activity_summaries(client, limiter, access_token, after) if _has_segment_efforts(a)]
+    summaries.sort(key=lambda activity: (_start_time(activity), activity["id"]))
+    print(f"📋 Athlete {user.strava_id}: {len(summaries)} activit{'y' if len(summaries) == 1 else 'ies'} to read")
+
+    read = 0
+    updated = set()
+    for start in range(0, len(summaries), ACTIVITIES_PER_BATCH):
+        batch = summaries[start:start + ACTIVITIES_PER_BATCH]
+        responses = await _gather(*(
+            _get(client, limiter, f"{STRAVA_API_URL}/activities/{activity['id']}", access_token,
+                 {"include_all_efforts": "true"})
+            for activity in batch
+        ))
+        efforts = [
+            effort
+            for response in responses if response is not None
+            for effort in response.json().get("segment_efforts") or []
+        ]
+        read += len(efforts)
+
+        # Keep only efforts on tracked segments
+        segment_ids = list({(effort.get("segment") or {}).get("id") for effort in efforts} - {None})
+        tracked = {row[0] for row in db.query(models.Item.strava_segment_id).filter(
+            models.Item.strava_segment_id.in_(segment_ids)
+        )} if segment_ids else set()
+
+        if complete_history:
+            accepted = tracked
+        else:
+            accepted = segment_efforts.synced_segment_ids(db, user.id, tracked)
+            unsynced = list(tracked - accepted)
+            if unsynced:
+                db.query(models.Item).filter(models.Item.strava_segment_id.in_(unsynced)).update(
+                    {models.Item.stats_refreshed_at: None}, synchronize_session=False
+                )
+                stats_refresher.mark_user_stats_stale(db, user.id, unsynced)
+                print(f"   ⏭️  {len(unsynced)} tracked segment(s) have no stored history, left for the stats refresher")
+
+        segment_efforts.upsert_efforts(db, user.id, [
+            effort for effort in efforts if (effort.get("segment") or {}).get("id") in accepted
+        ])
+        stats_refresher.recompute_user_stats(db, user.id, list(accepted))
+        updated |= accepted
+        if checkpoint is not None:
+            checkpoint.resume_after = _start_time(batch[-1])
+            checkpoint.processed += len(batch)
+        db.commit()
+
+    if days is None:
+        user.activities_synced_through = started_at
+    if checkpoint is not None:
+        db.delete(checkpoint)
+    db.commit()
+
+    print(f"   ✓ {read} effort(s) read, {len(updated)} tracked segment(s) updated")
+    return len(updated)
+
+
+async def sync_activities(strava_id: Optional[int] = None, full: bool = False, days: Optional[int] = None) -> int:
+    """Run the activity sync for one athlete, or every connected one"""
+    db = SessionLocal()
+
+    try:
+        query = db.query(models.User).filter(models.User.strava_access_token.isnot(None))
+        if strava_id is not None:
+            query = query.filter(models.User.strava_id == strava_id)
+        users = query.order_by(models.User.id).all()
+        if not users:
+            print("❌ Error: No connected Strava athlete found.")
+            return 0
+
+        started = time.monotonic()
+        updated = 0
+        limiter = RateLimiter(max_concurrency=MAX_CONCURRENT_REQUESTS)
+        limits = httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS)
+        async with httpx.AsyncClient(limits=limits) as client:
+            for user in users:
+                try:
+                    updated += await sync_athlete_activities(db, user, client, limiter, full, days)
+                except (httpx.HTTPError, RuntimeError) as e:
+                    db.rollback()
+                    print(f"❌ Athlete {user.strava_id}: {e}")
+
+        print(f"\n✓ Updated {updated} segment stat(s) for {len(users)} athlete(s) in {time.monotonic() - started:.1f}s")
+        return updated
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync personal bests from Strava activities")
+    parser.add_argument("--athlete", type=int, help="Strava athlete ID (default: every connected athlete)")
+    parser.add_argument("--full", action="store_true", help="Re-read the whole activity history")
+    parser.add_argument("--days", type=int, help="Only read activities from the last N days")
+    args = parser.parse_args()
+    app_logging.configure_logging(fmt="text")
+
+    asyncio.run(sync_activities(args.athlete, args.full, args.days))
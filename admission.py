@@ -0,0 +1,193 @@
+"""
+Admission control: per-route-group concurrency limits with small bounded queues.
+
+Routes that wait on Strava and routes that only touch the database get separate
+capacity, so a slow Strava can't use up the connections and threads that
+/items/ reads need. When a group's slots are all taken, requests wait in its
+queue for up to its queue timeout. Past that, or when the queue is full, they
+are shed:
+
+- The segment times and metadata routes keep going without Strava: they answer
+  from the database (marked stale), or 503 when the segment isn't stored.
+- Other requests get 503 with Retry-After straight away.
+
+Limits are per worker process. Settings per group (STRAVA or LOCAL):
+
+    ADMISSION_<GROUP>_LIMIT                  requests handled at once (0 turns the group's limit off)
+    ADMISSION_<GROUP>_QUEUE                  requests allowed to wait for a slot
+    ADMISSION_<GROUP>_QUEUE_TIMEOUT_SECONDS  longest wait before being shed
+    ADMISSION_RETRY_AFTER_SECONDS            Retry-After sent with 503s
+"""
+
+import asyncio
+import collections
+import os
+import re
+import time
+from contextvars import ContextVar
+from typing import Optional, Pattern, Tuple
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+import metrics
+
+RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "2"))
+
+# Never limited: monitoring, and webhook deliveries that Strava expects answered quickly
+EXEMPT_PREFIXES = ("/metrics", "/debug/", "/strava/webhook", "/strava/circuit-breaker")
+
+queue_wait = metrics.Histogram(
+    "admission_queue_wait_seconds", "Time requests waited for a slot, by route group", ("group",),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+shed_requests = metrics.Counter(
+    "admission_shed_total",
+    "Requests shed because their route group was saturated: rejected (503) or fallback (answered from the database)",
+    ("group", "outcome"),
+)
+
+_shedding: ContextVar[bool] = ContextVar("admission_shedding", default=False)
+
+
+class AdmissionGroup:
+    """At most `limit` requests at once, `queue_size` more waiting (first come, first served)"""
+
+    def __init__(self, name: str, limit: int, queue_size: int, queue_timeout: float,
+                 prefixes: Tuple[str, ...] = (), fallback_paths: Optional[Pattern] = None):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.prefixes = prefixes
+        self.fallback_paths = fallback_paths
+        self.active = 0
+        self._waiters: collections.deque = collections.deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> bool:
+        """Take a slot, waiting in the queue if needed. False means shed."""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.queue_size:
+            return False
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        timer = loop.call_later(self.queue_timeout, lambda: waiter.done() or waiter.set_result(False))
+        try:
+            # True: release() handed this request its slot. False: timed out.
+            admitted = await waiter
+        except asyncio.CancelledError:
+            # The client went away while queued; pass on a slot that was just handed over
+            if waiter.done() and not waiter.cancelled() and waiter.result():
+                self.release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+        finally:
+            timer.cancel()
+        if not admitted and waiter in self._waiters:
+            self._waiters.remove(waiter)
+        return admitted
+
+    def release(self):
+        """Give the slot to the first request still waiting, or free it"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+
+def _group_from_env(name: str, default_limit: int, default_queue: int, default_timeout: float, **kwargs) -> AdmissionGroup:
+    prefix = f"ADMISSION_{name.upper()}"
+    return AdmissionGroup(
+        name,
+        int(os.getenv(f"{prefix}_LIMIT", str(default_limit))),
+        int(os.getenv(f"{prefix}_QUEUE", str(default_queue))),
+        float(os.getenv(f"{prefix}_QUEUE_TIMEOUT_SECONDS", str(default_timeout))),
+        **kwargs,
+    )
+
+
+# Strava-bound routes hold a database connection while they wait on Strava, so the default
+# limit stays under the connection pool's 15 (5 + 10 overflow)
+strava = _group_from_env(
+    "strava", 8, 16, 1.0,
+    prefixes=("/strava/segments/", "/auth/strava/callback", "/auth/strava/athlete", "/auth/strava/status"),
+    fallback_paths=re.compile(r"^/strava/segments/\d+/(times|metadata)$"),
+)
+# Everything else: database-only routes
+local = _group_from_env("local", 64, 256, 5.0)
+
+GROUPS = (strava, local)
+
+
+def group_for(path: str) -> Optional[AdmissionGroup]:
+    if path.startswith(EXEMPT_PREFIXES):
+        return None
+    group = strava if path.startswith(strava.prefixes) else local
+    return group if group.limit > 0 else None
+
+
+def shedding() -> bool:
+    """True when this request was shed from the Strava group and must not call Strava"""
+    return _shedding.get()
+
+
+def overloaded_error() -> HTTPException:
+    return HTTPException(
+        status_code=503, detail="Too many requests are waiting on Strava. Please try again shortly.",
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+    )
+
+
+def _collect(reading: str) -> dict:
+    return {(group.name,): getattr(group, reading) for group in GROUPS}
+
+
+metrics.Gauge("admission_active", "Requests holding a slot, by route group", ("group",), collect=lambda: _collect("active"))
+metrics.Gauge("admission_queued", "Requests waiting for a slot, by route group", ("group",), collect=lambda: _collect("queued"))
+metrics.Gauge("admission_limit", "Slots per worker, by route group", ("group",), merge="max", collect=lambda: _collect("limit"))
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying the route groups' limits"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        group = group_for(scope["path"]) if scope["type"] == "http" else None
+        if group is None:
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        admitted = await group.acquire()
+        queue_wait.observe(time.perf_counter() - started, group=group.name)
+
+        if admitted:
+            try:
+                return await self.app(scope, receive, send)
+            finally:
+                group.release()
+
+        if group.fallback_paths and group.fallback_paths.match(scope["path"]) and scope["method"] == "GET":
+            shed_requests.inc(group=group.name, outcome="fallback")
+            token = _shedding.set(True)
+            try:
+                return await self.app(scope, receive, send)
+            finally:
+                _shedding.reset(token)
+
+        shed_requests.inc(group=group.name, outcome="rejected")
+        error = overloaded_error()
+        response = JSONResponse({"detail": error.detail}, status_code=error.status_code, headers=error.headers)
+        await response(scope, receive, send)
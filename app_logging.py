@@ -0,0 +1,205 @@
+"""
+Structured logging that keeps log I/O off the request path.
+
+Log calls only put the record on an in-memory queue; a background thread
+(logging.handlers.QueueListener) formats it and writes it to stdout, one JSON
+object per line. Each line carries the id and route of the request that logged
+it. Settings:
+
+    LOG_LEVEL               default level (INFO)
+    LOG_ROUTE_LEVELS        per-route levels by route template, e.g.
+                            "/strava/segments/{segment_id}/times=DEBUG,/items/=WARNING"
+    LOG_DEBUG_SAMPLE_RATE   share of high-volume debug lines kept (0.01)
+    LOG_FORMAT              json (default) or text
+
+High-volume lines opt into sampling with extra={"sample_rate": DEBUG_SAMPLE_RATE}.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+import metrics
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_ROUTE_LEVELS = os.getenv("LOG_ROUTE_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+
+# Records waiting for the writer thread; past this they're dropped rather than block a request
+QUEUE_SIZE = 10000
+
+# Incoming X-Request-ID values are kept only if they look like an ID
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,128}$")
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+_scope_var = contextvars.ContextVar("scope", default=None)
+
+# LogRecord attributes that aren't `extra` fields
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id", "route"}
+
+dropped_records = metrics.Counter("log_records_dropped_total", "Log records dropped because the log queue was full")
+
+_queue: Optional[queue.Queue] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def current_route() -> Optional[str]:
+    """Route template of the request being handled (filled in once routing has matched it)"""
+    scope = _scope_var.get()
+    route = scope.get("route") if scope else None
+    return getattr(route, "path", None)
+
+
+def _parse_levels(value: str) -> dict:
+    levels = {}
+    for item in value.split(","):
+        route, _, level = item.strip().rpartition("=")
+        numeric = logging.getLevelName(level.strip().upper())
+        if route and isinstance(numeric, int):
+            levels[route] = numeric
+    return levels
+
+
+class ContextFilter(logging.Filter):
+    """Applies per-route levels and sampling, and tags records with the request id and route.
+
+    Runs in the caller, before the record is queued, so contextvars still hold its request.
+    """
+
+    def __init__(self, default_level: int, route_levels: dict):
+        super().__init__()
+        self.default_level = default_level
+        self.route_levels = route_levels
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        route = current_route()
+        if record.levelno < self.route_levels.get(route, self.default_level):
+            return False
+        sample_rate = getattr(record, "sample_rate", None)
+        if sample_rate is not None and random.random() >= sample_rate:
+            return False
+        record.request_id = request_id_var.get()
+        record.route = route
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only fix the message now (its args could change later); formatting waits for the writer thread
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if getattr(record, "route", None):
+            entry["route"] = record.route
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key != "sample_rate":
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(fmt: Optional[str] = None):
+    """Send every logger's records through the queue to stdout. Safe to call more than once."""
+    global _queue, _listener
+    if _listener is not None:
+        return
+
+    default_level = logging.getLevelName(LOG_LEVEL)
+    if not isinstance(default_level, int):
+        default_level = logging.INFO
+    route_levels = _parse_levels(LOG_ROUTE_LEVELS)
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if (fmt or LOG_FORMAT) == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    _queue = queue.Queue(QUEUE_SIZE)
+    queue_handler = _QueueHandler(_queue)
+    queue_handler.addFilter(ContextFilter(default_level, route_levels))
+
+    # Skip what the lines don't use (per the logging docs' optimization notes): the caller's
+    # file and line need a stack walk on every call
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    # Loggers must let the most verbose route level through; the filter does the rest
+    root.setLevel(min([default_level, *route_levels.values()]))
+    # httpx logs every request at INFO
+    for noisy in ("httpx", "httpcore"):
+        logging.getLogger(noisy).setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(_queue, stream_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def flush():
+    """Wait until every queued record is written (e.g. before a Lambda container is frozen)"""
+    if _queue is not None:
+        _queue.join()
+
+
+class RequestContextMiddleware:
+    """ASGI middleware giving each request an id for its log lines.
+
+    A sane incoming X-Request-ID (e.g. from a load balancer) is reused, otherwise
+    a new one is made; either way it is returned in the X-Request-ID header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        incoming = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        request_id = incoming if REQUEST_ID_PATTERN.match(incoming) else uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        request_token = request_id_var.set(request_id)
+        scope_token = _scope_var.set(scope)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id_var.reset(request_token)
+            _scope_var.reset(scope_token)
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+Reproducible load benchmark for the API.
+
+Seeds a database with synthetic segments and one connected athlete, starts the
+app with uvicorn, and drives each scenario at fixed concurrency levels for a
+fixed time, reporting throughput and p50/p95/p99 latency. Results are saved as
+JSON. With --baseline, a scenario whose p95 latency rose or throughput fell by
+more than --tolerance is flagged and the exit status is 1, so CI can fail.
+
+By default it uses a fresh SQLite file; pass --database-url to run against a
+local Postgres instead. Use a dedicated, empty database - it will be seeded.
+
+Strava is replaced by mock_strava.py (started alongside, with --strava-latency):
+segment_times is served from the database since the seeded stats are fresh,
+while segment_times_miss (segments that aren't stored) and segment_metadata
+go to the mock every time.
+
+Usage:
+    python benchmark.py                                       # Every scenario at concurrency 1, 8 and 32
+    python benchmark.py --scenarios items_list,items_detail --concurrency 16 --duration 20
+    python benchmark.py --database-url postgresql://bench@localhost/bench_db
+    python benchmark.py --output current.json --baseline baseline.json --tolerance 0.15
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+from itsdangerous import TimestampSigner
+
+DEFAULT_CONCURRENCY = "1,8,32"
+DEFAULT_DURATION_SECONDS = 10.0
+WARMUP_SECONDS = 2.0
+DEFAULT_ITEMS = 2000
+DEFAULT_TOLERANCE = 0.15
+DEFAULT_STRAVA_LATENCY = "lognormal:80:0.5"
+
+# Secret the benchmark server signs sessions with, so requests can be sent as the seeded athlete
+SESSION_SECRET = "benchmark-session-secret"
+ATHLETE_ID = 1000001
+FIRST_SEGMENT_ID = 9000000
+
+SERVER_START_TIMEOUT_SECONDS = 30
+
+Request = Tuple[str, str, Optional[dict]]
+
+
+class Context:
+    """What scenarios pick their requests from"""
+
+    def __init__(self, item_ids: List[int], segment_ids: List[int]):
+        self.item_ids = item_ids
+        self.segment_ids = segment_ids
+        self.created = 0
+
+
+def _items_list(rng: random.Random, ctx: Context) -> Request:
+    return "GET", f"/items/?skip={rng.randrange(0, max(len(ctx.item_ids) - 100, 1))}&limit=100", None
+
+
+def _items_detail(rng: random.Random, ctx: Context) -> Request:
+    return "GET", f"/items/{rng.choice(ctx.item_ids)}", None
+
+
+def _items_update(rng: random.Random, ctx: Context) -> Request:
+    return "PUT", f"/items/{rng.choice(ctx.item_ids)}", {"dibs": rng.choice(["Alex", "Sam", None])}
+
+
+def _items_create(rng: random.Random, ctx: Context) -> Request:
+    ctx.created += 1
+    return "POST", "/items/", {"segment_name": f"Benchmark segment {rng.getrandbits(48):x}-{ctx.created}"}
+
+
+def _segment_times(rng: random.Random, ctx: Context) -> Request:
+    return "GET", f"/strava/segments/{rng.choice(ctx.segment_ids)}/times", None
+
+
+def _segment_times_miss(rng: random.Random, ctx: Context) -> Request:
+    # Segments past the seeded ones aren't stored, so every request goes to Strava
+    return "GET", f"/strava/segments/{ctx.segment_ids[-1] + 1 + rng.randrange(len(ctx.segment_ids))}/times", None
+
+
+def _segment_metadata(rng: random.Random, ctx: Context) -> Request:
+    return "GET", f"/strava/segments/{rng.choice(ctx.segment_ids)}/metadata", None
+
+
+SCENARIOS: Dict[str, Callable[[random.Random, Context], Request]] = {
+    "items_list": _items_list,
+    "items_detail": _items_detail,
+    "items_update": _items_update,
+    "items_create": _items_create,
+    "segment_times": _segment_times,
+    "segment_times_miss": _segment_times_miss,
+    "segment_metadata": _segment_metadata,
+}
+
+
+def seed_database(item_count: int, seed: int) -> Tuple[int, Context]:
+    """Create the schema and synthetic data. Returns (athlete's user id, context)."""
+    # Imported here: the database module reads DATABASE_URL when it is imported
+    from sqlalchemy import insert
+
+    import migrations
+    import models
+    from database import SessionLocal, engine
+
+    migrations.ensure_schema(engine)
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        if db.query(models.Item).count():
+            raise SystemExit("❌ The database already has items - point --database-url at an empty one")
+
+        user = models.User(strava_id=ATHLETE_ID, strava_access_token="benchmark", strava_refresh_token="benchmark",
+                           token_expires_at=datetime(2100, 1, 1))
+        db.add(user)
+        db.flush()
+
+        segment_ids = [FIRST_SEGMENT_ID + i for i in range(item_count)]
+        db.execute(insert(models.Item), [{
+            "segment_name": f"Segment {segment_id}",
+            "distance": round(rng.uniform(0.1, 5.0), 2),
+            "elevation_gain": round(rng.uniform(0, 500), 1),
+            "strava_segment_id": segment_id,
+            "strava_url": f"https://www.strava.com/segments/{segment_id}",
+            "completed": rng.random() < 0.3,
+            "polyline": "".join(rng.choice("abcdefghijklmnopqrstuvwxyz_~@?") for _ in range(200)),
+            "start_latitude": rng.uniform(37.0, 38.0),
+            "start_longitude": rng.uniform(-123.0, -122.0),
+            "stats_refreshed_at": now,
+            "stats_requested_at": now,
+        } for segment_id in segment_ids])
+        db.execute(insert(models.UserSegmentStats), [{
+            "user_id": user.id,
+            "segment_id": segment_id,
+            "personal_best_time": f"{rng.randint(1, 20)}:{rng.randint(0, 59):02d}",
+            "personal_attempts": rng.randint(1, 40),
+            "last_attempt_date": "06/01/2024",
+            "refreshed_at": now,
+        } for segment_id in segment_ids])
+        db.commit()
+        item_ids = [item_id for (item_id,) in db.query(models.Item.id).order_by(models.Item.id)]
+        return user.id, Context(item_ids, segment_ids)
+    finally:
+        db.close()
+
+
+def session_cookie(user_id: int) -> str:
+    """A session cookie the app's SessionMiddleware accepts as this user being logged in"""
+    data = base64.b64encode(json.dumps({"user_id": user_id}).encode("utf-8"))
+    return TimestampSigner(SESSION_SECRET).sign(data).decode("utf-8")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start(name: str, command: List[str], env: dict, ready_path: str) -> Tuple[subprocess.Popen, str]:
+    """Start a server process on a free port and wait until ready_path answers"""
+    port = _free_port()
+    process = subprocess.Popen(
+        [*command, "--host", "127.0.0.1", "--port", str(port)],
+        env={**os.environ, **env}, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + SERVER_START_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"❌ {name} exited with status {process.returncode}")
+        try:
+            if httpx.get(f"{base_url}{ready_path}", timeout=1.0).status_code == 200:
+                return process, base_url
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"❌ {name} didn't start in time")
+
+
+def start_mock_strava(latency: str, ctx: Context) -> Tuple[subprocess.Popen, str]:
+    """The fake Strava API, with no rate limit and activities on the seeded segments"""
+    return _start(
+        "Mock Strava", [sys.executable, "mock_strava.py", "--latency", latency, "--rate-limit", "off",
+         "--segments", f"{ctx.segment_ids[0]}-{ctx.segment_ids[-1]}"],
+        {}, "/_mock/config",
+    )
+
+
+def start_server(database_url: str, workers: int, strava_url: str) -> Tuple[subprocess.Popen, str]:
+    return _start(
+        "Server", [sys.executable, "-m", "uvicorn", "--workers", str(workers), "--log-level", "warning", "--no-access-log",
+         "main:app"],
+        {
+            "DATABASE_URL": database_url,
+            "SESSION_SECRET_KEY": SESSION_SECRET,
+            "STRAVA_BASE_URL": strava_url,
+            # Slow query warnings under lock contention would drown out the report
+            "LOG_LEVEL": os.getenv("LOG_LEVEL", "ERROR"),
+            # Measure the app, not the rate limits and load shedding in front of it
+            "RATE_LIMIT_USER_BURST": "0",
+            "RATE_LIMIT_IP_BURST": "0",
+            "ADMISSION_STRAVA_LIMIT": "0",
+            "ADMISSION_LOCAL_LIMIT": "0",
+        },
+        "/",
+    )
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+async def run_scenario(base_url: str, cookie: str, name: str, ctx: Context, concurrency: int,
+                       duration: float, seed: int) -> dict:
+    """Drive one scenario with `concurrency` clients for `duration` seconds (after a warmup)"""
+    make_request = SCENARIOS[name]
+    latencies: List[float] = []
+    errors = {"count": 0}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, cookies={"session": cookie}, limits=limits, timeout=30.0) as client:
+        async def worker(worker_id: int, until: float, record: bool):
+            rng = random.Random(seed * 1000 + worker_id)
+            while time.perf_counter() < until:
+                method, path, body = make_request(rng, ctx)
+                started = time.perf_counter()
+                try:
+                    response = await client.request(method, path, json=body)
+                    ok = response.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                if record:
+                    latencies.append(time.perf_counter() - started)
+                    if not ok:
+                        errors["count"] += 1
+
+        warmup_until = time.perf_counter() + WARMUP_SECONDS
+        await asyncio.gather(*(worker(i, warmup_until, False) for i in range(concurrency)))
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i, started + duration, True) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors["count"],
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+    }
+
+
+def compare(results: List[dict], baseline: List[dict], tolerance: float) -> List[str]:
+    """Regressions against the baseline: p95 up or throughput down by more than `tolerance`"""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result["scenario"], result["concurrency"]))
+        if not before:
+            continue
+        label = f"{result['scenario']} @ {result['concurrency']}"
+        if before["p95_ms"] and result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{label}: p95 {before['p95_ms']} -> {result['p95_ms']} ms")
+        if before["throughput_rps"] and result["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {before['throughput_rps']} -> {result['throughput_rps']} req/s")
+        if result["errors"] > before["errors"]:
+            regressions.append(f"{label}: errors {before['errors']} -> {result['errors']}")
+    return regressions
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(args) -> int:
+    scenarios = args.scenarios.split(",") if args.scenarios else list(SCENARIOS)
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"❌ Unknown scenarios: {', '.join(unknown)} (choose from {', '.join(SCENARIOS)})")
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+
+    temp_dir = None
+    database_url = args.database_url
+    if not database_url:
+        temp_dir = tempfile.mkdtemp(prefix="benchmark-")
+        database_url = f"sqlite:///{os.path.join(temp_dir, 'benchmark.db')}"
+    os.environ["DATABASE_URL"] = database_url
+
+    print(f"🌱 Seeding {args.items} segments into {database_url.split('@')[-1]}")
+    user_id, ctx = seed_database(args.items, args.seed)
+    strava_process, strava_url = start_mock_strava(args.strava_latency, ctx)
+    print(f"🏃 Mock Strava running at {strava_url} (latency {args.strava_latency})")
+    try:
+        process, base_url = start_server(database_url, args.workers, strava_url)
+    except BaseException:
+        strava_process.terminate()
+        raise
+    print(f"🚀 Server running at {base_url} ({args.workers} worker(s))")
+
+    results = []
+    try:
+        cookie = session_cookie(user_id)
+        for name in scenarios:
+            for concurrency in concurrency_levels:
+                result = asyncio.run(run_scenario(base_url, cookie, name, ctx, concurrency, args.duration, args.seed))
+                results.append(result)
+                print(f"  {name:<18} c={concurrency:<4} {result['throughput_rps']:>8} req/s  "
+                      f"p50 {result['p50_ms']:>7} ms  p95 {result['p95_ms']:>7} ms  p99 {result['p99_ms']:>7} ms  "
+                      f"errors {result['errors']}")
+    finally:
+        for server in (process, strava_process):
+            server.terminate()
+            server.wait(timeout=10)
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "database": database_url.split(":", 1)[0],
+            "items": args.items,
+            "duration_seconds": args.duration,
+            "workers": args.workers,
+            "strava_latency": args.strava_latency,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"💾 Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        if regressions:
+            print(f"❌ {len(regressions)} regression(s) against {args.baseline}:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            return 1
+        print(f"✓ No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the API at fixed concurrency levels")
+    parser.add_argument("--database-url", help="Empty database to seed and run against (default: a temporary SQLite file)")
+    parser.add_argument("--scenarios", help=f"Comma-separated scenarios (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument("--concurrency", default=DEFAULT_CONCURRENCY, help=f"Comma-separated concurrency levels (default {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION_SECONDS, help="Seconds per scenario and level")
+    parser.add_argument("--items", type=int, default=DEFAULT_ITEMS, help="Segments to seed")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--strava-latency", default=DEFAULT_STRAVA_LATENCY, help=f"Mock Strava latency (default {DEFAULT_STRAVA_LATENCY})")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for data and request mix")
+    parser.add_argument("--output", default="benchmark-results.json", help="Where to save the results")
+    parser.add_argument("--baseline", help="Earlier results to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed relative change (default 0.15)")
+    sys.exit(main(parser.parse_args()))
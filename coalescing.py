@@ -0,0 +1,73 @@
+"""
+In-flight deduplication of identical Strava fetches.
+
+When several tabs or club members open the same segment at once, the first
+request starts the Strava fetch and the others await that same task instead of
+spending quota and connections on identical calls. Nothing is cached: the key
+is forgotten as soon as the fetch finishes, successfully or not.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time; concurrent callers share its result.
+
+    Errors reach every caller. A caller that is cancelled (e.g. the client went
+    away) stops waiting without affecting the others; the shared call is only
+    cancelled once nobody is waiting for it.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self.started = 0  # calls actually made
+        self.joined = 0   # callers that shared a call already in flight
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Await fn() for this key, or the call already in flight. Returns (result, joined)."""
+        call = self._calls.get(key)
+        joined = call is not None
+        if joined:
+            self.joined += 1
+        else:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            self.started += 1
+            call.task.add_done_callback(lambda task: self._finished(key, call))
+
+        call.waiters += 1
+        try:
+            # shield: cancelling one caller must not cancel the call the others are waiting on
+            return await asyncio.shield(call.task), joined
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+                # Forget it now, not when the cancellation lands: a caller arriving in between
+                # would join a cancelled call and get CancelledError it never asked for
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+
+    def _finished(self, key: Hashable, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not call.task.cancelled():
+            call.task.exception()  # Retrieved here so an error nobody awaited isn't logged as lost
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def snapshot(self) -> dict:
+        """Counters for monitoring"""
+        return {"in_flight": self.in_flight(), "started": self.started, "joined": self.joined}
+
+
+# Shared by the segment endpoints in this process
+strava_fetches = SingleFlight()
@@ -10,6 +10,7 @@ from dotenv import load_dotenv
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import models
+import migrations
 
 # Load environment variables
 load_dotenv()
@@ -31,10 +32,10 @@ if DATABASE_URL.startswith("postgres://"):
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-# Create all tables
-print("Creating database tables...")
-models.Base.metadata.create_all(bind=engine)
-print("✓ Database tables created successfully!")
+# Create tables by applying schema migrations
+print("Applying database migrations...")
+migrations.run_migrations(engine)
+print(f"✓ Database schema is at version {migrations.LATEST_VERSION}!")
 print("\nTables created:")
 for table_name in models.Base.metadata.tables.keys():
     print(f"  - {table_name}")
@@ -198,22 +199,7 @@ try:
         
         db.commit()
         print(f"✓ Successfully seeded {len(test_segments)} test segments!")
-        
-        # Update existing segments to extract segment IDs from URLs
-        print("\nUpdating existing segments with Strava segment IDs...")
-        existing_items = db.query(models.Item).filter(models.Item.strava_segment_id == None).all()
-        updated_count = 0
-        for item in existing_items:
-            if item.strava_url:
-                match = re.search(r'/segments/(\d+)', item.strava_url)
-                if match:
-                    item.strava_segment_id = int(match.group(1))
-                    updated_count += 1
-        if updated_count > 0:
-            db.commit()
-            print(f"✓ Updated {updated_count} existing segments with Strava segment IDs")
-        else:
-            print("✓ No segments needed updating")
+
 finally:
     db.close()
 
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic dataset for scale testing: segments (items), athletes,
+their segment efforts and per-athlete stats.
+
+Rows look like the real thing: encoded polylines from random walks around a
+few cities, start coordinates on the route, time strings in the formats found
+in the table (Strava's M:SS, hand-entered MM:SS:00, H:MM:SS for long
+segments), both date styles, dibs and completion flags, and stats that are
+fresh, stale or never refreshed. The output only depends on --seed.
+
+On Postgres, rows are streamed in with COPY (in chunks, so a million items
+don't have to fit in memory); other databases get batched INSERTs. Generated
+rows use their own ID ranges, so they can be removed again with --clear
+without touching real data.
+
+Usage:
+    python generate_data.py --items 10000                          # 10k segments, 100 athletes
+    python generate_data.py --items 1000000 --users 1000 --segments-per-user 500
+    python generate_data.py --clear                                # Remove generated rows
+"""
+
+import argparse
+import csv
+import io
+import math
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Iterator, List, Sequence
+
+from dotenv import load_dotenv
+from sqlalchemy import insert, text
+
+import migrations
+import models
+from database import SessionLocal, engine
+
+# Load environment variables
+load_dotenv()
+
+# Generated rows live in ID ranges real Strava IDs don't reach (the columns are 32-bit)
+SEGMENT_ID_BASE = 1_500_000_000
+ATHLETE_ID_BASE = 1_900_000_000
+EFFORT_ID_BASE = 9_000_000_000_000
+ACTIVITY_ID_BASE = 8_000_000_000_000
+
+# Rows per COPY / INSERT batch
+CHUNK_ROWS = 50_000
+
+# Route start points: (latitude, longitude) of places with plenty of segments
+CITIES = [
+    (37.7749, -122.4194),  # San Francisco
+    (40.0150, -105.2705),  # Boulder
+    (47.6062, -122.3321),  # Seattle
+    (51.5072, -0.1276),    # London
+    (45.5152, -122.6784),  # Portland
+    (-33.8688, 151.2093),  # Sydney
+]
+
+NAME_PLACES = ["Hawk Hill", "Twin Peaks", "Sweeney Ridge", "Mount Tam", "Flagstaff", "Green Mountain", "Lake Union",
+               "Richmond Park", "Forest Park", "Bondi", "Mission Creek", "Ridge Trail", "Old Stage", "Ocean Beach"]
+NAME_KINDS = ["Climb", "Descent", "Sprint", "Loop", "Out and Back", "Switchbacks", "Stairs", "Road Climb", "Trail"]
+NAME_EXTRAS = ["", "", "", " (Full)", " - Steep Bit", " Northbound", " Southbound", " to the Top", " Dash"]
+PEOPLE = ["Jacob Smith", "Maria Garcia", "Wei Chen", "Aisha Khan", "Liam O'Brien", "Sofia Rossi", "Kenji Tanaka",
+          "Emma Johnson", "Noah Williams", "Olivia Brown", "Lucas Martin", "Zoe Taylor"]
+
+ITEM_COLUMNS = [
+    "segment_name", "distance", "elevation_gain", "elevation_loss", "crown_holder", "crown_date", "crown_time",
+    "crown_pace", "personal_best_time", "personal_best_pace", "personal_attempts", "overall_attempts",
+    "last_attempt_date", "strava_url", "strava_segment_id", "dibs", "completed", "polyline", "start_latitude",
+    "start_longitude", "personal_best_grade_adjusted_pace", "personal_best_activity_id", "stats_refreshed_at",
+    "stats_requested_at",
+]
+EFFORT_COLUMNS = ["id", "user_id", "segment_id", "activity_id", "start_date", "start_date_local", "elapsed_time"]
+STATS_COLUMNS = [
+    "user_id", "segment_id", "personal_best_time", "personal_best_pace", "personal_best_grade_adjusted_pace",
+    "personal_attempts", "last_attempt_date", "personal_best_activity_id", "refreshed_at",
+]
+
+
+def encode_polyline(points: Sequence[tuple]) -> str:
+    """Google's encoded polyline format (precision 5), as Strava returns it"""
+    encoded = []
+    previous_lat = previous_lng = 0
+    for lat, lng in points:
+        lat_e5, lng_e5 = int(round(lat * 1e5)), int(round(lng * 1e5))
+        for delta in (lat_e5 - previous_lat, lng_e5 - previous_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        previous_lat, previous_lng = lat_e5, lng_e5
+    return "".join(encoded)
+
+
+def random_route(rng: random.Random, distance_meters: float) -> List[tuple]:
+    """A wandering route of about `distance_meters`, starting near one of CITIES"""
+    city_lat, city_lng = rng.choice(CITIES)
+    lat, lng = city_lat + rng.uniform(-0.15, 0.15), city_lng + rng.uniform(-0.15, 0.15)
+    steps = max(2, min(int(distance_meters / 25), 400))
+    step_meters = distance_meters / steps
+    heading = rng.uniform(0, 2 * math.pi)
+    points = [(lat, lng)]
+    for _ in range(steps):
+        heading += rng.gauss(0, 0.35)
+        lat += step_meters * math.cos(heading) / 111_320
+        lng += step_meters * math.sin(heading) / (111_320 * math.cos(math.radians(lat)))
+        points.append((lat, lng))
+    return points
+
+
+def _duration_string(rng: random.Random, seconds: int) -> str:
+    """A time in one of the formats stored in the table"""
+    minutes, secs = divmod(seconds, 60)
+    if minutes >= 60 and rng.random() < 0.5:
+        return f"{minutes // 60}:{minutes % 60:02d}:{secs:02d}"
+    if rng.random() < 0.3:
+        return f"{minutes}:{secs:02d}:00"  # Hand-entered, with hundredths
+    return f"{minutes}:{secs:02d}"
+
+
+def _pace(seconds: int, distance_miles: float) -> str:
+    pace = seconds / max(distance_miles, 0.01)
+    return f"{int(pace // 60)}:{int(pace % 60):02d}"
+
+
+def _date_string(rng: random.Random, day: datetime) -> str:
+    style = rng.random()
+    if style < 0.4:
+        return day.strftime("%d-%b-%y")          # 12-Aug-25
+    if style < 0.8:
+        return f"{day.month}/{day.day}/{day.year}"  # 7/3/2025
+    return day.strftime("%m/%d/%Y")              # 07/03/2025
+
+
+def generate_items(count: int, rng: random.Random, now: datetime) -> Iterator[list]:
+    for i in range(count):
+        segment_id = SEGMENT_ID_BASE + i
+        distance_miles = round(min(rng.lognormvariate(math.log(0.8), 0.8), 15.0), 2)
+        distance_meters = distance_miles * 1609.34
+        grade = rng.choice([0, 0.01, 0.03, 0.06, 0.1, 0.15])
+        elevation_gain = round(distance_meters * grade * rng.uniform(0.5, 1.2) * 3.281, 1)
+        route = random_route(rng, distance_meters)
+        crown_seconds = int(distance_miles * rng.uniform(290, 420))
+        attempts = rng.choice([0, 0, 1, 2, 3, 5, 8, 13, 30])
+        pb_seconds = int(crown_seconds * rng.uniform(1.1, 1.9))
+        refreshed = rng.random()
+        stats_refreshed_at = None if refreshed < 0.3 else now - timedelta(minutes=rng.randint(1, 60 * 24 * 30))
+        yield [
+            f"{rng.choice(NAME_PLACES)} {rng.choice(NAME_KINDS)}{rng.choice(NAME_EXTRAS)}",
+            distance_miles,
+            elevation_gain,
+            round(elevation_gain * rng.uniform(0.2, 1.0), 1) if rng.random() < 0.4 else None,
+            rng.choice(PEOPLE) if rng.random() < 0.7 else None,
+            _date_string(rng, now - timedelta(days=rng.randint(1, 2000))),
+            _duration_string(rng, crown_seconds),
+            _pace(crown_seconds, distance_miles),
+            _duration_string(rng, pb_seconds) if attempts else None,
+            _pace(pb_seconds, distance_miles) if attempts else None,
+            attempts,
+            attempts + rng.randint(0, 5000),
+            _date_string(rng, now - timedelta(days=rng.randint(1, 900))) if attempts else None,
+            f"https://www.strava.com/segments/{segment_id}",
+            segment_id,
+            rng.choice(PEOPLE) if rng.random() < 0.2 else None,
+            rng.random() < 0.3,
+            encode_polyline(route),
+            round(route[0][0], 6),
+            round(route[0][1], 6),
+            _pace(int(pb_seconds * 0.95), distance_miles) if attempts and grade else None,
+            ACTIVITY_ID_BASE + rng.randrange(10 ** 9) if attempts else None,
+            stats_refreshed_at,
+            now - timedelta(minutes=rng.randint(1, 60 * 24 * 60)) if rng.random() < 0.5 else None,
+        ]
+
+
+def generate_efforts(user_ids: List[int], item_count: int, segments_per_user: int, rng: random.Random,
+                     now: datetime, stats_rows: list) -> Iterator[list]:
+    """Efforts for every athlete; the matching user_segment_stats rows are appended to stats_rows"""
+    effort_id = EFFORT_ID_BASE
+    for user_id in user_ids:
+        for index in rng.sample(range(item_count), min(segments_per_user, item_count)):
+            segment_id = SEGMENT_ID_BASE + index
+            base_seconds = rng.randint(60, 3600)
+            attempts = min(1 + int(rng.expovariate(1 / 4)), 200)
+            best = None
+            latest = None
+            for _ in range(attempts):
+                started = now - timedelta(days=rng.uniform(1, 2000))
+                elapsed = int(base_seconds * rng.uniform(0.9, 1.5))
+                activity_id = ACTIVITY_ID_BASE + user_id * 100_000 + (now - started).days
+                yield [effort_id, user_id, segment_id, activity_id, started, started - timedelta(hours=7), elapsed]
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, activity_id)
+                if latest is None or started > latest:
+                    latest = started
+                effort_id += 1
+            minutes, secs = divmod(best[0], 60)
+            stats_rows.append([
+                user_id, segment_id, f"{minutes}:{secs:02d}", f"{rng.randint(6, 14)}:{rng.randint(0, 59):02d}", None,
+                attempts, latest.strftime("%m/%d/%Y"), best[1],
+                now - timedelta(minutes=rng.randint(1, 60 * 24 * 14)),
+            ])
+
+
+def _chunks(rows: Iterator[list], size: int) -> Iterator[List[list]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_rows(table: str, columns: List[str], rows: Iterator[list]) -> int:
+    """Load rows with COPY on Postgres, batched INSERTs elsewhere. Returns the row count."""
+    started = time.monotonic()
+    total = 0
+    for chunk in _chunks(rows, CHUNK_ROWS):
+        if engine.dialect.name == "postgresql":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in chunk:
+                writer.writerow(["" if value is None else value for value in row])
+            buffer.seek(0)
+            connection = engine.raw_connection()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+                connection.commit()
+            finally:
+                connection.close()
+        else:
+            table_model = models.Base.metadata.tables[table]
+            with engine.begin() as connection:
+                connection.execute(insert(table_model), [dict(zip(columns, row)) for row in chunk])
+        total += len(chunk)
+        print(f"  {table}: {total:,} rows ({total / max(time.monotonic() - started, 0.001):,.0f}/s)")
+    return total
+
+
+def clear_generated():
+    """Remove every row in the generated ID ranges"""
+    with engine.begin() as connection:
+        user_ids = f"SELECT id FROM users WHERE strava_id >= {ATHLETE_ID_BASE}"
+        for statement in (
+            f"DELETE FROM segment_efforts WHERE user_id IN ({user_ids})",
+            f"DELETE FROM user_segment_stats WHERE user_id IN ({user_ids})",
+            f"DELETE FROM users WHERE strava_id >= {ATHLETE_ID_BASE}",
+            f"DELETE FROM items WHERE strava_segment_id >= {SEGMENT_ID_BASE}",
+        ):
+            result = connection.execute(text(statement))
+            print(f"🗑  {statement.split(' WHERE')[0]}: {result.rowcount:,} rows")
+
+
+def generate(item_count: int, user_count: int, segments_per_user: int, seed: int):
+    migrations.ensure_schema(engine)
+    db = SessionLocal()
+    try:
+        if db.query(models.Item).filter(models.Item.strava_segment_id >= SEGMENT_ID_BASE).first():
+            raise SystemExit("❌ Generated rows are already loaded - run with --clear first")
+    finally:
+        db.close()
+
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    started = time.monotonic()
+
+    print(f"🌱 Generating {item_count:,} segments")
+    load_rows("items", ITEM_COLUMNS, generate_items(item_count, rng, now))
+
+    print(f"👥 Creating {user_count:,} athletes")
+    with engine.begin() as connection:
+        connection.execute(insert(models.User), [{
+            "strava_id": ATHLETE_ID_BASE + i,
+            "strava_access_token": f"synthetic-{i}",
+            "strava_refresh_token": f"synthetic-refresh-{i}",
+            "token_expires_at": now + timedelta(hours=6),
+            "created_at": now,
+            "updated_at": now,
+        } for i in range(user_count)])
+        user_ids = [row[0] for row in connection.execute(
+            text("SELECT id FROM users WHERE strava_id >= :base ORDER BY id"), {"base": ATHLETE_ID_BASE}
+        )]
+
+    print(f"🏃 Generating efforts on {segments_per_user:,} segments per athlete")
+    stats_rows: list = []
+    load_rows("segment_efforts", EFFORT_COLUMNS, generate_efforts(user_ids, item_count, segments_per_user, rng, now, stats_rows))
+    load_rows("user_segment_stats", STATS_COLUMNS, iter(stats_rows))
+
+    # Fresh planner statistics, so query plans match what production would pick
+    with engine.begin() as connection:
+        connection.execute(text("ANALYZE"))
+    print(f"✓ Done in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load a synthetic dataset for scale testing")
+    parser.add_argument("--items", type=int, default=10_000, help="Segments to generate (default 10,000)")
+    parser.add_argument("--users", type=int, default=100, help="Athletes to generate (default 100)")
+    parser.add_argument("--segments-per-user", type=int, default=200, help="Segments each athlete has efforts on (default 200)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (the same seed gives the same data)")
+    parser.add_argument("--clear", action="store_true", help="Remove previously generated rows and exit")
+    args = parser.parse_args()
+
+    if args.clear:
+        clear_generated()
+    else:
+        generate(args.items, args.users, args.segments_per_user, args.seed)
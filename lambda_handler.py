@@ -2,10 +2,39 @@
 AWS Lambda handler for FastAPI application
 Use this for serverless deployment with API Gateway
 """
+import asyncio
+
 from mangum import Mangum
 from main import app
+import app_logging
+import metrics
+import stats_refresher
+import strava_webhooks
+import tracing
 
 # Create Mangum handler
 # lifespan="off" disables FastAPI lifespan events (not supported in Lambda)
-handler = Mangum(app, lifespan="off")
+asgi_handler = Mangum(app, lifespan="off")
+
+
+def handler(event, context):
+    """API Gateway entry point. A Lambda container can't be scraped, so its metrics go to the logs."""
+    try:
+        return asgi_handler(event, context)
+    finally:
+        metrics.maybe_log_snapshot()
+        # The container may be frozen as soon as this returns - write out queued log lines and traces first
+        tracing.flush()
+        app_logging.flush()
+
+
+def refresh_handler(event, context):
+    """Scheduled (EventBridge) handler that refreshes stale segment stats from Strava.
 
+    Also drains any queued webhook events that weren't processed after their request.
+    """
+    limit = int(event.get("limit", stats_refresher.REFRESH_BATCH_SIZE)) if isinstance(event, dict) else stats_refresher.REFRESH_BATCH_SIZE
+    webhook_events = asyncio.run(strava_webhooks.process_pending_events())
+    refreshed = asyncio.run(stats_refresher.refresh_stale_items(limit))
+    app_logging.flush()
+    return {"refreshed": refreshed, "webhook_events": webhook_events}
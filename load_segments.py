@@ -1,24 +1,56 @@
 #!/usr/bin/env python3
 """
 ETL script to load multiple Strava segments into the database.
-Usage: python load_segments.py
+
+Existing segments are skipped with a single query, missing ones are fetched from
+Strava concurrently (within the rate limit) and inserted in batches. Segments can
+also be discovered from the athlete's starred segments or from Strava's segment
+explore over a bounding box; those are loaded straight from the discovery results.
+
+Usage:
+    python load_segments.py                       # Uses SEGMENT_IDS list in script
+    python load_segments.py 8403912 13651993 ...  # IDs (or segment URLs) as arguments
+    python load_segments.py --file segments.txt   # One or more IDs/URLs per line
+    cat segments.txt | python load_segments.py -  # Read IDs/URLs from stdin
+    python load_segments.py --starred             # The athlete's starred segments
+    python load_segments.py --bounds 37.70,-122.52,37.82,-122.35 --grid 4  # Explore an area
 """
 
-import os
+import argparse
+import re
 import sys
+import time
+from typing import List, Optional, Tuple
 from dotenv import load_dotenv
-from sqlalchemy.orm import Session
+from sqlalchemy import insert
 import httpx
-from datetime import datetime, timedelta
 import asyncio
 
 # Import database and models
 from database import SessionLocal
+import app_logging
 import models
+from map_backfill import QuotaExhausted
+from strava_client import STRAVA_API_URL, RateLimiter, extract_map_data, get_connected_user, get_valid_access_token_async
 
 # Load environment variables
 load_dotenv()
 
+# Number of Strava requests in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+
+# Attempts per segment for 429s, 5xx and network errors
+MAX_ATTEMPTS = 5
+
+# Rows per multi-row INSERT statement
+INSERT_BATCH_SIZE = 500
+
+# Strava's maximum page size for /segments/starred
+STARRED_PER_PAGE = 200
+
+# Explore returns at most 10 segments per call, so --bounds is split into GRID x GRID tiles
+EXPLORE_GRID = 3
+
 # Strava segment IDs to load
 SEGMENT_IDS = [
     8403912,
@@ -50,119 +82,215 @@ SEGMENT_IDS = [
 ]
 
 
-async def get_valid_access_token_async(user: models.User, db: Session):
-    """Get valid access token, refreshing if needed"""
-    if not user.strava_access_token:
-        return None
-    
-    # Check if token is expired or expires soon (within 5 minutes)
-    if user.token_expires_at and user.token_expires_at <= datetime.utcnow() + timedelta(minutes=5):
-        return await refresh_strava_token_async(user, db)
-    
-    return user.strava_access_token
+def parse_segment_ids(text: str):
+    """Extract segment IDs from free text: bare IDs or Strava segment URLs, any separator"""
+    # Drop comments first
+    text = "\n".join(line.split("#", 1)[0] for line in text.splitlines())
 
+    segment_ids = []
+    for token in re.split(r"[\s,]+", text):
+        if not token:
+            continue
+        match = re.search(r"/segments/(\d+)", token)
+        if match:
+            segment_ids.append(int(match.group(1)))
+        elif token.isdigit():
+            segment_ids.append(int(token))
+        else:
+            raise ValueError(f"Not a segment ID or URL: {token}")
+    # Keep the first occurrence of each ID, in order
+    return list(dict.fromkeys(segment_ids))
 
-async def refresh_strava_token_async(user: models.User, db: Session):
-    """Refresh Strava access token"""
-    if not user.strava_refresh_token:
-        return None
-    
-    try:
-        STRAVA_CLIENT_ID = os.getenv("STRAVA_CLIENT_ID")
-        STRAVA_CLIENT_SECRET = os.getenv("STRAVA_CLIENT_SECRET")
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://www.strava.com/oauth/token",
-                data={
-                    "client_id": STRAVA_CLIENT_ID,
-                    "client_secret": STRAVA_CLIENT_SECRET,
-                    "grant_type": "refresh_token",
-                    "refresh_token": user.strava_refresh_token,
-                },
-                timeout=10.0
-            )
-            
-            if response.status_code != 200:
-                print(f"Token refresh failed: {response.status_code} - {response.text}")
-                return None
-            
-            token_data = response.json()
-            
-            if "access_token" in token_data:
-                user.strava_access_token = token_data["access_token"]
-                user.strava_refresh_token = token_data.get("refresh_token", user.strava_refresh_token)
-                expires_in = token_data.get("expires_at", 0)
-                user.token_expires_at = datetime.fromtimestamp(expires_in) if expires_in else None
-                db.commit()
-                return user.strava_access_token
-    except Exception as e:
-        print(f"Error refreshing token: {e}")
-        return None
-    
-    return None
 
+def segment_row(segment_data: dict) -> dict:
+    """items row for a Strava segment (detailed, starred or explore result)"""
+    segment_id = segment_data["id"]
+
+    # Convert distance from meters to miles
+    distance_meters = segment_data.get("distance") or 0
+    distance_miles = distance_meters / 1609.34 if distance_meters > 0 else None
+
+    # Convert elevation from meters to feet (explore results only have elev_difference)
+    elevation_high = segment_data.get("elevation_high") or 0
+    elevation_low = segment_data.get("elevation_low") or 0
+    elevation_gain_meters = elevation_high - elevation_low if elevation_high > elevation_low else 0
+    if not elevation_gain_meters:
+        elevation_gain_meters = max(segment_data.get("elev_difference") or 0, 0)
+    elevation_gain_feet = elevation_gain_meters * 3.28084 if elevation_gain_meters > 0 else None
+
+    # Explore results carry the polyline as "points"
+    polyline, start_latitude, start_longitude = extract_map_data(segment_data)
+
+    return {
+        "segment_name": segment_data.get("name", ""),
+        "distance": round(distance_miles, 2) if distance_miles else None,
+        "elevation_gain": round(elevation_gain_feet, 1) if elevation_gain_feet else None,
+        "elevation_loss": None,
+        "strava_url": f"https://www.strava.com/segments/{segment_id}",
+        "strava_segment_id": segment_id,
+        "crown_holder": None,
+        "crown_date": None,
+        "crown_time": None,
+        "crown_pace": None,
+        "personal_best_time": None,
+        "personal_best_pace": None,
+        "personal_attempts": 0,
+        "overall_attempts": 0,
+        "last_attempt_date": None,
+        "dibs": None,
+        "completed": False,
+        "polyline": polyline or segment_data.get("points") or None,
+        "start_latitude": start_latitude,
+        "start_longitude": start_longitude,
+    }
 
-async def fetch_segment_metadata(segment_id: int, access_token: str):
-    """Fetch segment metadata from Strava API"""
-    async with httpx.AsyncClient() as client:
+
+async def fetch_starred_segments(client: httpx.AsyncClient, limiter: RateLimiter, access_token: str) -> List[dict]:
+    """The athlete's starred segments (summary objects, enough to load them without another call)"""
+    segments = []
+    page = 1
+    while True:
+        response = await limiter.get(
+            client,
+            f"{STRAVA_API_URL}/segments/starred",
+            headers={"Authorization": f"Bearer {access_token}"},
+            params={"page": page, "per_page": STARRED_PER_PAGE},
+            timeout=10.0
+        )
+        response.raise_for_status()
+        batch = response.json()
+        segments.extend(batch)
+        if len(batch) < STARRED_PER_PAGE:
+            return segments
+        page += 1
+
+
+def split_bounds(bounds: Tuple[float, float, float, float], grid: int) -> List[Tuple[float, float, float, float]]:
+    """Split (sw_lat, sw_lng, ne_lat, ne_lng) into grid x grid tiles"""
+    sw_lat, sw_lng, ne_lat, ne_lng = bounds
+    lat_step = (ne_lat - sw_lat) / grid
+    lng_step = (ne_lng - sw_lng) / grid
+    return [
+        (sw_lat + row * lat_step, sw_lng + col * lng_step,
+         sw_lat + (row + 1) * lat_step, sw_lng + (col + 1) * lng_step)
+        for row in range(grid)
+        for col in range(grid)
+    ]
+
+
+async def explore_segments(client: httpx.AsyncClient, limiter: RateLimiter, access_token: str,
+                           bounds: Tuple[float, float, float, float], grid: int = 3,
+                           activity_type: str = "running") -> List[dict]:
+    """Segments Strava's explore endpoint finds in a bounding box.
+
+    Explore returns at most 10 segments per call, so the box is split into tiles
+    that are all requested concurrently.
+    """
+    async def explore_tile(tile):
+        response = await limiter.get(
+            client,
+            f"{STRAVA_API_URL}/segments/explore",
+            headers={"Authorization": f"Bearer {access_token}"},
+            params={"bounds": ",".join(f"{value:.6f}" for value in tile), "activity_type": activity_type},
+            timeout=10.0
+        )
+        response.raise_for_status()
+        return response.json().get("segments") or []
+
+    tiles = split_bounds(bounds, grid)
+    results = await asyncio.gather(*(explore_tile(tile) for tile in tiles))
+    segments = {}
+    for tile_segments in results:
+        for segment in tile_segments:
+            segments.setdefault(segment["id"], segment)
+    print(f"🗺️  Explored {len(tiles)} tiles, found {len(segments)} segments")
+    return list(segments.values())
+
+
+async def fetch_segment_metadata(client: httpx.AsyncClient, limiter: RateLimiter, segment_id: int, access_token: str):
+    """Fetch segment metadata from Strava API, backing off on rate limits and transient errors.
+
+    Returns (row, error). Raises QuotaExhausted if Strava is still rate limiting after
+    MAX_ATTEMPTS, since every other segment would be refused too.
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        segment_response = None
         try:
-            segment_response = await client.get(
-                f"https://www.strava.com/api/v3/segments/{segment_id}",
+            segment_response = await limiter.get(
+                client,
+                f"{STRAVA_API_URL}/segments/{segment_id}",
                 headers={"Authorization": f"Bearer {access_token}"},
                 timeout=10.0
             )
-            
-            if segment_response.status_code != 200:
-                if segment_response.status_code == 404:
-                    return None, f"Segment {segment_id} not found"
-                if segment_response.status_code == 401:
-                    return None, f"Authentication failed for segment {segment_id}"
+        except RuntimeError as e:
+            # Daily limit reached
+            raise QuotaExhausted(str(e))
+        except httpx.TransportError as e:
+            if attempt == MAX_ATTEMPTS:
+                return None, f"Network error for segment {segment_id}: {e}"
+
+        if segment_response is not None:
+            if segment_response.status_code == 200:
+                return segment_row(segment_response.json()), None
+            if segment_response.status_code == 404:
+                return None, f"Segment {segment_id} not found"
+            if segment_response.status_code == 401:
+                return None, f"Authentication failed for segment {segment_id}"
+            if segment_response.status_code == 429 and attempt == MAX_ATTEMPTS:
+                raise QuotaExhausted(f"Rate limit exceeded for segment {segment_id}")
+            if segment_response.status_code != 429 and (segment_response.status_code < 500 or attempt == MAX_ATTEMPTS):
                 return None, f"Error {segment_response.status_code} for segment {segment_id}"
-            
-            segment_data = segment_response.json()
-            
-            # Convert distance from meters to miles
-            distance_meters = segment_data.get("distance", 0)
-            distance_miles = distance_meters / 1609.34 if distance_meters > 0 else None
-            
-            # Convert elevation from meters to feet
-            elevation_high = segment_data.get("elevation_high", 0)
-            elevation_low = segment_data.get("elevation_low", 0)
-            elevation_gain_meters = elevation_high - elevation_low if elevation_high > elevation_low else 0
-            elevation_gain_feet = elevation_gain_meters * 3.28084 if elevation_gain_meters > 0 else None
-            
-            return {
-                "segment_name": segment_data.get("name", ""),
-                "distance": round(distance_miles, 2) if distance_miles else None,
-                "elevation_gain": round(elevation_gain_feet, 1) if elevation_gain_feet else None,
-                "elevation_loss": None,
-                "strava_url": f"https://www.strava.com/segments/{segment_id}",
-                "strava_segment_id": segment_id,
-                "crown_holder": None,
-                "crown_date": None,
-                "crown_time": None,
-                "crown_pace": None,
-                "personal_best_time": None,
-                "personal_best_pace": None,
-                "personal_attempts": 0,
-                "overall_attempts": 0,
-                "last_attempt_date": None,
-                "dibs": None,
-            }, None
-            
-        except Exception as e:
-            return None, f"Exception fetching segment {segment_id}: {str(e)}"
-
-
-async def load_segments():
-    """Main ETL function to load segments"""
+
+        delay = limiter.backoff_delay(segment_response, attempt)
+        if segment_response is not None and segment_response.status_code == 429:
+            # Hold back the other workers too, not just this one
+            limiter.pause(delay)
+        await asyncio.sleep(delay)
+
+
+async def fetch_missing_segments(client: httpx.AsyncClient, limiter: RateLimiter, segment_ids: List[int],
+                                 access_token: str) -> Tuple[dict, Optional[QuotaExhausted]]:
+    """Fetch segments concurrently. Returns ({segment_id: (row, error)}, why it stopped early).
+
+    Once the quota is exhausted the remaining fetches are cancelled; their segments
+    are missing from the results.
+    """
+    tasks = {
+        segment_id: asyncio.ensure_future(fetch_segment_metadata(client, limiter, segment_id, access_token))
+        for segment_id in segment_ids
+    }
+    stopped = None
+    try:
+        await asyncio.gather(*tasks.values())
+    except QuotaExhausted as e:
+        stopped = e
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    results = {
+        segment_id: task.result()
+        for segment_id, task in tasks.items()
+        if not task.cancelled() and task.exception() is None
+    }
+    return results, stopped
+
+
+async def load_segments(segment_ids=SEGMENT_IDS, starred: bool = False,
+                        bounds: Optional[Tuple[float, float, float, float]] = None,
+                        grid: int = EXPLORE_GRID, activity_type: str = "running"):
+    """Main ETL function to load segments.
+
+    Besides segment_ids, starred adds the athlete's starred segments and bounds
+    (sw_lat, sw_lng, ne_lat, ne_lng) adds what Strava's explore finds there.
+    """
     db = SessionLocal()
-    
+    started = time.perf_counter()
+
     try:
         # Check for Strava user
-        user = db.query(models.User).first()
-        if not user or not user.strava_access_token:
+        user = get_connected_user(db)
+        if not user:
             print("❌ Error: No Strava user found. Please connect Strava first.")
             print("   Run the app and connect your Strava account, then run this script again.")
             return
@@ -175,55 +303,96 @@ async def load_segments():
             return
         
         print(f"✓ Authenticated with Strava")
-        print(f"📋 Loading {len(SEGMENT_IDS)} segments...\n")
-        
-        loaded_count = 0
-        skipped_count = 0
-        error_count = 0
-        
-        for segment_id in SEGMENT_IDS:
-            # Check if segment already exists
-            existing = db.query(models.Item).filter(
-                models.Item.strava_segment_id == segment_id
-            ).first()
-            
-            if existing:
-                print(f"⏭️  Segment {segment_id}: Already exists ('{existing.segment_name}')")
-                skipped_count += 1
+
+        limiter = RateLimiter(max_concurrency=MAX_CONCURRENT_REQUESTS)
+        limits = httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS)
+        async with httpx.AsyncClient(limits=limits) as client:
+            # Discovered segments come with enough data to insert them without another call
+            summaries = {}
+            if starred:
+                for segment in await fetch_starred_segments(client, limiter, access_token):
+                    summaries.setdefault(segment["id"], segment)
+                print(f"⭐ Found {len(summaries)} starred segments")
+            if bounds:
+                for segment in await explore_segments(client, limiter, access_token, bounds, grid, activity_type):
+                    summaries.setdefault(segment["id"], segment)
+            segment_ids = list(dict.fromkeys([*segment_ids, *summaries]))
+
+            print(f"📋 Loading {len(segment_ids)} segments...\n")
+
+            # One query for every segment we already have
+            existing = {
+                row.strava_segment_id: row.segment_name
+                for row in db.query(models.Item.strava_segment_id, models.Item.segment_name).filter(
+                    models.Item.strava_segment_id.in_(segment_ids)
+                )
+            }
+            for segment_id, segment_name in existing.items():
+                print(f"⏭️  Segment {segment_id}: Already exists ('{segment_name}')")
+
+            missing_ids = [segment_id for segment_id in segment_ids if segment_id not in existing]
+            skipped_count = len(existing)
+            error_count = 0
+
+            # Fetch everything else that's missing concurrently over one connection pool
+            fetch_ids = [segment_id for segment_id in missing_ids if segment_id not in summaries]
+            results, stopped = await fetch_missing_segments(client, limiter, fetch_ids, access_token)
+        fetched_at = time.perf_counter()
+
+        for segment_id in missing_ids:
+            if segment_id in summaries:
+                results[segment_id] = (segment_row(summaries[segment_id]), None)
+        left_ids = [segment_id for segment_id in missing_ids if segment_id not in results]
+        if stopped:
+            print(f"⏸️  Stopped fetching: {stopped}")
+            print(f"   {len(left_ids)} segment(s) not loaded, run again later: {' '.join(map(str, left_ids))}")
+
+        rows = []
+        for segment_id in missing_ids:
+            if segment_id not in results:
                 continue
-            
-            # Fetch segment metadata
-            segment_data, error = await fetch_segment_metadata(segment_id, access_token)
-            
+            segment_data, error = results[segment_id]
             if error:
                 print(f"❌ Segment {segment_id}: {error}")
                 error_count += 1
-                continue
-            
-            if not segment_data:
+            elif not segment_data:
                 print(f"❌ Segment {segment_id}: No data returned")
                 error_count += 1
-                continue
-            
-            # Create database item
+            else:
+                rows.append(segment_data)
+
+        # Insert in batches - each batch is a single multi-row INSERT
+        loaded_count = 0
+        for start in range(0, len(rows), INSERT_BATCH_SIZE):
+            batch = rows[start:start + INSERT_BATCH_SIZE]
             try:
-                db_item = models.Item(**segment_data)
-                db.add(db_item)
+                db.execute(insert(models.Item), batch)
                 db.commit()
-                db.refresh(db_item)
-                print(f"✓ Segment {segment_id}: Loaded '{segment_data['segment_name']}' ({segment_data['distance']} mi, {segment_data['elevation_gain']} ft)")
-                loaded_count += 1
             except Exception as e:
                 db.rollback()
-                print(f"❌ Segment {segment_id}: Database error - {str(e)}")
-                error_count += 1
+                print(f"❌ Database error inserting {len(batch)} segments: {str(e)}")
+                error_count += len(batch)
+                continue
+
+            for segment_data in batch:
+                print(f"✓ Segment {segment_data['strava_segment_id']}: Loaded '{segment_data['segment_name']}' ({segment_data['distance']} mi, {segment_data['elevation_gain']} ft)")
+            loaded_count += len(batch)
+
+        elapsed = time.perf_counter() - started
+        fetch_elapsed = fetched_at - started
         
         print(f"\n{'='*60}")
         print(f"📊 Summary:")
         print(f"   ✓ Loaded: {loaded_count}")
         print(f"   ⏭️  Skipped (already exists): {skipped_count}")
         print(f"   ❌ Errors: {error_count}")
-        print(f"   📋 Total: {len(SEGMENT_IDS)}")
+        if left_ids:
+            print(f"   ⏸️  Not fetched (stopped early): {len(left_ids)}")
+        print(f"   📋 Total: {len(segment_ids)}")
+        print(f"   ⏱️  Time: {elapsed:.1f}s ({len(segment_ids) / elapsed:.1f} segments/s, "
+              f"{len(fetch_ids) / fetch_elapsed if fetch_elapsed else 0:.1f} Strava fetches/s)")
+        if limiter.remaining is not None:
+            print(f"   🚦 Strava requests left in this window: {limiter.remaining}")
         print(f"{'='*60}")
         
     except Exception as e:
@@ -234,6 +403,53 @@ async def load_segments():
         db.close()
 
 
+def parse_bounds(value: str) -> Tuple[float, float, float, float]:
+    """"sw_lat,sw_lng,ne_lat,ne_lng" -> tuple of floats"""
+    try:
+        sw_lat, sw_lng, ne_lat, ne_lng = (float(part) for part in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError("bounds must be sw_lat,sw_lng,ne_lat,ne_lng")
+    if sw_lat >= ne_lat or sw_lng >= ne_lng:
+        raise argparse.ArgumentTypeError("bounds must be the south-west corner, then the north-east corner")
+    return sw_lat, sw_lng, ne_lat, ne_lng
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Load Strava segments into the database")
+    parser.add_argument("segments", nargs="*", help="Segment IDs or URLs, or '-' to read them from stdin")
+    parser.add_argument("--file", "-f", help="File with segment IDs or URLs (whitespace/comma separated, # comments)")
+    parser.add_argument("--starred", action="store_true", help="Also load the athlete's starred segments")
+    parser.add_argument("--bounds", type=parse_bounds, help="Also load segments found in sw_lat,sw_lng,ne_lat,ne_lng")
+    parser.add_argument("--grid", type=int, default=EXPLORE_GRID, help="Split --bounds into GRID x GRID tiles")
+    parser.add_argument("--activity-type", default="running", choices=["running", "riding"])
+    return parser.parse_args(argv)
+
+
+def read_segment_ids(args):
+    texts = []
+    if args.file:
+        with open(args.file) as f:
+            texts.append(f.read())
+    for segment in args.segments:
+        texts.append(sys.stdin.read() if segment == "-" else segment)
+
+    if not texts:
+        # The built-in list is only the default when nothing else was asked for
+        return [] if args.starred or args.bounds else SEGMENT_IDS
+    return parse_segment_ids("\n".join(texts))
+
+
 if __name__ == "__main__":
-    asyncio.run(load_segments())
+    args = parse_args(sys.argv[1:])
+    app_logging.configure_logging(fmt="text")
+    try:
+        segment_ids = read_segment_ids(args)
+    except ValueError as e:
+        print(f"❌ Error: {e}")
+        sys.exit(1)
+
+    if not segment_ids and not args.starred and not args.bounds:
+        print("❌ Error: No segment IDs provided.")
+        sys.exit(1)
 
+    asyncio.run(load_segments(segment_ids, args.starred, args.bounds, args.grid, args.activity_type))
@@ -1,24 +1,66 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi import FastAPI, HTTPException, Depends, Request, Response, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import FileResponse, PlainTextResponse, RedirectResponse
 from starlette.middleware.sessions import SessionMiddleware
+from sqlalchemy import and_, literal
 from sqlalchemy.orm import Session
 from typing import List, Optional
 import os
 import models
 import schemas
+import metrics
+import admission
+import migrations
+import profiling
+import query_stats
+import rate_limits
+import tracing
+import stats_refresher
+import strava_webhooks
 from database import SessionLocal, engine
+from coalescing import strava_fetches
+from strava_client import (
+    STRAVA_API_URL,
+    STRAVA_AUTHORIZE_URL,
+    STRAVA_TOKEN_URL,
+    DeadlineExceeded,
+    StravaUnavailable,
+    fetch_segment_metadata_from_strava,
+    fetch_segment_times_from_strava,
+    get_valid_access_token_async,
+    refresh_strava_token_async,
+    strava_breaker,
+    strava_get,
+    strava_request,
+)
 import httpx
 from datetime import datetime, timedelta
 import re
 import secrets
+import asyncio
+import logging
+import time
+import app_logging
+from app_logging import DEBUG_SAMPLE_RATE
+
+# JSON log lines, written by a background thread
+app_logging.configure_logging()
+logger = logging.getLogger("main")
+
+# Count and time every SQL statement (per-request tallies, slow query log)
+query_stats.install(engine)
 
-# Create database tables
-models.Base.metadata.create_all(bind=engine)
+# Bring the database schema up to date (a single version read when nothing is pending)
+migrations.ensure_schema(engine)
 
 app = FastAPI(title="Strava Segment Tracker API", version="1.0.0")
 
+# Innermost, so profiles show the app rather than the other middleware (off unless PROFILE_DIR is set)
+app.add_middleware(profiling.ProfilingMiddleware)
+# Separate capacity for Strava-bound and local routes; inside CORS so 503s carry CORS headers
+app.add_middleware(admission.AdmissionMiddleware)
+
 # Generate a secret key for sessions (in production, use a fixed secret from env)
 SESSION_SECRET_KEY = os.getenv("SESSION_SECRET_KEY", secrets.token_urlsafe(32))
 
@@ -31,7 +73,7 @@ app.add_middleware(
     https_only=False,  # Set to True in production with HTTPS
 )
 
-# Note: Database tables are created automatically on startup.
+# Note: Database migrations are applied automatically on startup (see migrations.py).
 # To seed test data, use the /seed/ endpoint or run create_tables.py
 
 # Add CORS middleware to allow frontend to access the API
@@ -49,6 +91,50 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so request latency covers every other middleware and every log line has a request id
+app.add_middleware(query_stats.QueryStatsMiddleware)
+app.add_middleware(tracing.TracingMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(app_logging.RequestContextMiddleware)
+
+
+@app.on_event("startup")
+async def start_stats_refresher():
+    """Keep segment stats warm in the background when STATS_REFRESH_INTERVAL_SECONDS is set"""
+    interval = int(os.getenv("STATS_REFRESH_INTERVAL_SECONDS", "0"))
+    if interval > 0:
+        app.state.stats_refresher = asyncio.create_task(stats_refresher.run_forever(interval))
+
+
+@app.on_event("startup")
+async def start_metrics_flusher():
+    """With METRICS_DIR set, share this worker's metrics with the others every few seconds"""
+    if metrics.METRICS_DIR:
+        app.state.metrics_flusher = asyncio.create_task(flush_metrics_forever())
+
+
+async def flush_metrics_forever():
+    while True:
+        await asyncio.sleep(metrics.METRICS_FLUSH_SECONDS)
+        try:
+            metrics.write_snapshot()
+        except OSError as e:
+            logger.warning("Could not write metrics snapshot", extra={"error": str(e)})
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    """Stop the stats refresher and the metrics flusher, then write the last interval's metrics"""
+    tasks = [task for task in (getattr(app.state, name, None) for name in ("stats_refresher", "metrics_flusher")) if task]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if metrics.METRICS_DIR:
+        try:
+            metrics.write_snapshot()
+        except OSError as e:
+            logger.warning("Could not write metrics snapshot", extra={"error": str(e)})
+
 
 # Dependency to get DB session
 def get_db():
@@ -110,44 +196,71 @@ def create_item(item: schemas.ItemCreate, db: Session = Depends(get_db)):
                 )
         
         item_data = item.model_dump()
-        print(f"Creating item with data: {list(item_data.keys())}")
-        print(f"Polyline present: {bool(item_data.get('polyline'))}")
-        print(f"Start coordinates: {item_data.get('start_latitude')}, {item_data.get('start_longitude')}")
-        
         db_item = models.Item(**item_data)
         db.add(db_item)
         db.commit()
         db.refresh(db_item)
         
-        print(f"Created item ID {db_item.id} with polyline: {bool(db_item.polyline)}")
+        logger.debug("Created item", extra={
+            "item_id": db_item.id,
+            "strava_segment_id": db_item.strava_segment_id,
+            "has_polyline": bool(db_item.polyline),
+            "has_start": db_item.start_latitude is not None and db_item.start_longitude is not None,
+        })
         return db_item
     except HTTPException:
         raise
     except Exception as e:
         db.rollback()
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"Error creating item: {error_trace}")
+        logger.exception("Error creating item")
         raise HTTPException(status_code=400, detail=f"Error creating item: {str(e)}")
 
 
+def items_with_user_stats(db: Session, current_user: Optional[models.User]):
+    """Items query that also loads the signed-in athlete's stats in the same round trip"""
+    if not current_user:
+        return db.query(models.Item, literal(None))
+    return db.query(models.Item, models.UserSegmentStats).outerjoin(
+        models.UserSegmentStats,
+        and_(
+            models.UserSegmentStats.user_id == current_user.id,
+            models.UserSegmentStats.segment_id == models.Item.strava_segment_id,
+        ),
+    )
+
+
+def item_response(db_item: models.Item, user_stats: Optional[models.UserSegmentStats]) -> schemas.Item:
+    """An item with the athlete's own PB and attempts in place of the stored values"""
+    item = schemas.Item.model_validate(db_item)
+    if user_stats:
+        item = item.model_copy(update={
+            "personal_best_time": user_stats.personal_best_time,
+            "personal_best_pace": user_stats.personal_best_pace,
+            "personal_attempts": user_stats.personal_attempts or 0,
+            "last_attempt_date": user_stats.last_attempt_date,
+        })
+    return item
+
+
 @app.get("/items/", response_model=List[schemas.Item])
-def read_items(skip: int = 0, limit: int = 100, completed: Optional[bool] = None, db: Session = Depends(get_db)):
-    """Get all items, optionally filtered by completed status"""
-    query = db.query(models.Item)
+def read_items(skip: int = 0, limit: int = 100, completed: Optional[bool] = None, db: Session = Depends(get_db),
+               current_user: Optional[models.User] = Depends(get_current_user)):
+    """Get all items, optionally filtered by completed status, with the signed-in athlete's stats"""
+    query = items_with_user_stats(db, current_user)
     if completed is not None:
         query = query.filter(models.Item.completed == completed)
-    items = query.offset(skip).limit(limit).all()
-    return items
+    rows = query.order_by(models.Item.id).offset(skip).limit(limit).all()
+    return [item_response(db_item, user_stats) for db_item, user_stats in rows]
 
 
 @app.get("/items/{item_id}", response_model=schemas.Item)
-def read_item(item_id: int, db: Session = Depends(get_db)):
+def read_item(item_id: int, db: Session = Depends(get_db),
+              current_user: Optional[models.User] = Depends(get_current_user)):
     """Get a specific item by ID"""
-    db_item = db.query(models.Item).filter(models.Item.id == item_id).first()
-    if db_item is None:
+    row = items_with_user_stats(db, current_user).filter(models.Item.id == item_id).first()
+    if row is None:
         raise HTTPException(status_code=404, detail="Item not found")
-    return db_item
+    return item_response(*row)
 
 
 @app.put("/items/{item_id}", response_model=schemas.Item)
@@ -342,47 +455,6 @@ def get_or_create_user(db: Session, strava_id: int):
     return user
 
 
-# Helper function to refresh Strava token
-async def refresh_strava_token_async(user: models.User, db: Session):
-    """Async version of token refresh"""
-    if not user.strava_refresh_token:
-        return None
-    
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://www.strava.com/oauth/token",
-                data={
-                    "client_id": STRAVA_CLIENT_ID,
-                    "client_secret": STRAVA_CLIENT_SECRET,
-                    "grant_type": "refresh_token",
-                    "refresh_token": user.strava_refresh_token,
-                },
-                timeout=10.0
-            )
-            
-            if response.status_code != 200:
-                print(f"Token refresh failed: {response.status_code} - {response.text}")
-                return None
-            
-            token_data = response.json()
-            
-            if "access_token" in token_data:
-                user.strava_access_token = token_data["access_token"]
-                user.strava_refresh_token = token_data.get("refresh_token", user.strava_refresh_token)
-                expires_in = token_data.get("expires_at", 0)
-                user.token_expires_at = datetime.fromtimestamp(expires_in) if expires_in else None
-                db.commit()
-                return user.strava_access_token
-    except Exception as e:
-        import traceback
-        print(f"Error refreshing token: {e}")
-        print(traceback.format_exc())
-        return None
-    
-    return None
-
-
 def refresh_strava_token(user: models.User, db: Session):
     """Sync wrapper for token refresh (for backward compatibility)"""
     if not user.strava_refresh_token:
@@ -402,25 +474,11 @@ def refresh_strava_token(user: models.User, db: Session):
             pass
         
         return asyncio.run(refresh_strava_token_async(user, db))
-    except Exception as e:
-        import traceback
-        print(f"Error in sync token refresh wrapper: {e}")
-        print(traceback.format_exc())
+    except Exception:
+        logger.exception("Error in sync token refresh wrapper")
         return None
 
 
-# Helper function to get valid access token (async version for use in async endpoints)
-async def get_valid_access_token_async(user: models.User, db: Session):
-    if not user.strava_access_token:
-        return None
-    
-    # Check if token is expired or expires soon (within 5 minutes)
-    if user.token_expires_at and user.token_expires_at <= datetime.utcnow() + timedelta(minutes=5):
-        return await refresh_strava_token_async(user, db)
-    
-    return user.strava_access_token
-
-
 # Helper function to get valid access token (sync version for backward compatibility)
 def get_valid_access_token(user: models.User, db: Session):
     if not user.strava_access_token:
@@ -452,7 +510,7 @@ def strava_authorize():
     redirect_uri = f"{backend_url}/auth/strava/callback"
     
     auth_url = (
-        f"https://www.strava.com/oauth/authorize"
+        f"{STRAVA_AUTHORIZE_URL}"
         f"?client_id={STRAVA_CLIENT_ID}"
         f"&redirect_uri={redirect_uri}"
         f"&response_type=code"
@@ -474,8 +532,10 @@ async def strava_callback(code: str, request: Request, db: Session = Depends(get
     try:
         async with httpx.AsyncClient() as client:
             # Exchange code for token
-            response = await client.post(
-                "https://www.strava.com/oauth/token",
+            response = await strava_request(
+                client,
+                "POST",
+                STRAVA_TOKEN_URL,
                 data={
                     "client_id": STRAVA_CLIENT_ID,
                     "client_secret": STRAVA_CLIENT_SECRET,
@@ -516,68 +576,80 @@ async def strava_callback(code: str, request: Request, db: Session = Depends(get
             
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=400, detail=f"Strava API error: {e.response.text}")
+    except StravaUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error connecting to Strava: {str(e)}")
 
 
 @app.get("/auth/strava/status", response_model=schemas.StravaAuthStatus)
-def strava_auth_status(current_user: Optional[models.User] = Depends(get_current_user)):
+async def strava_auth_status(request: Request, current_user: Optional[models.User] = Depends(get_current_user),
+                             db: Session = Depends(get_db)):
     """Check Strava connection status for current user"""
     if not current_user or not current_user.strava_access_token:
         return schemas.StravaAuthStatus(connected=False)
     
     # Check if token is still valid
-    db = next(get_db())
-    try:
-        token = get_valid_access_token(current_user, db)
-        if token:
-            # Try to get athlete name
-            athlete_name = None
-            try:
-                import httpx
-                response = httpx.get(
-                    "https://www.strava.com/api/v3/athlete",
+    token = await get_valid_access_token_async(current_user, db)
+    if token:
+        # Try to get athlete name
+        athlete_name = None
+        try:
+            if not strava_breaker.allows_requests():
+                raise StravaUnavailable("circuit open")  # Before the rate limit, so it doesn't cost a token
+            if (await rate_limits.check(request, current_user.id)).limited:
+                raise StravaUnavailable("rate limited")  # Just leave the name out
+            async with httpx.AsyncClient() as client:
+                # No retries: the name is optional, so don't keep the page waiting for it
+                athlete_response = await strava_get(
+                    client,
+                    f"{STRAVA_API_URL}/athlete",
+                    retry=False,
                     headers={"Authorization": f"Bearer {token}"},
                     timeout=5.0
                 )
-                if response.status_code == 200:
-                    athlete_data = response.json()
-                    athlete_name = athlete_data.get("firstname", "") + " " + athlete_data.get("lastname", "")
-                    athlete_name = athlete_name.strip()
-            except Exception:
-                pass  # If we can't get athlete name, just return connected=True
-            
-            return schemas.StravaAuthStatus(connected=True, athlete_name=athlete_name)
-    finally:
-        db.close()
+            if athlete_response.status_code == 200:
+                athlete_data = athlete_response.json()
+                athlete_name = athlete_data.get("firstname", "") + " " + athlete_data.get("lastname", "")
+                athlete_name = athlete_name.strip()
+        except Exception:
+            pass  # If we can't get athlete name, just return connected=True
+        
+        return schemas.StravaAuthStatus(connected=True, athlete_name=athlete_name)
     
     return schemas.StravaAuthStatus(connected=False)
 
 
 @app.get("/auth/strava/athlete")
-async def get_athlete_info(current_user: models.User = Depends(require_auth), db: Session = Depends(get_db)):
+async def get_athlete_info(request: Request, response: Response,
+                           current_user: models.User = Depends(require_auth), db: Session = Depends(get_db)):
     """Get authenticated athlete information from Strava"""
     if not current_user.strava_access_token:
         raise HTTPException(status_code=401, detail="Not authenticated with Strava")
-    
-    access_token = await get_valid_access_token_async(current_user, db)
-    if not access_token:
-        raise HTTPException(status_code=401, detail="Strava authentication expired. Please reconnect.")
+    limit = await rate_limits.check(request, current_user.id)
+    response.headers.update(limit.headers)
+    if limit.limited:
+        raise limit.error()
     
     try:
+        access_token = await get_valid_access_token_async(current_user, db)
+        if not access_token:
+            raise HTTPException(status_code=401, detail="Strava authentication expired. Please reconnect.")
+
         async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://www.strava.com/api/v3/athlete",
+            athlete_response = await strava_get(
+                client,
+                f"{STRAVA_API_URL}/athlete",
                 headers={"Authorization": f"Bearer {access_token}"},
                 timeout=10.0
             )
             
-            if response.status_code != 200:
-                if response.status_code == 401:
+            if athlete_response.status_code != 200:
+                if athlete_response.status_code == 401:
                     raise HTTPException(status_code=401, detail="Strava authentication expired. Please reconnect.")
-                raise HTTPException(status_code=response.status_code, detail="Failed to fetch athlete info")
+                raise HTTPException(status_code=athlete_response.status_code, detail="Failed to fetch athlete info")
             
-            athlete_data = response.json()
+            athlete_data = athlete_response.json()
             firstname = athlete_data.get("firstname", "")
             lastname = athlete_data.get("lastname", "")
             athlete_name = f"{firstname} {lastname}".strip()
@@ -588,6 +660,10 @@ async def get_athlete_info(current_user: models.User = Depends(require_auth), db
                 "firstname": firstname,
                 "lastname": lastname
             }
+    except HTTPException:
+        raise
+    except StravaUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except httpx.HTTPStatusError as e:
         if e.response.status_code == 401:
             raise HTTPException(status_code=401, detail="Strava authentication expired. Please reconnect.")
@@ -597,9 +673,9 @@ async def get_athlete_info(current_user: models.User = Depends(require_auth), db
 
 
 @app.post("/auth/strava/disconnect")
-def strava_disconnect(db: Session = Depends(get_db)):
-    """Disconnect Strava account"""
-    user = db.query(models.User).first()
+def strava_disconnect(current_user: Optional[models.User] = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Disconnect the signed-in athlete's Strava account"""
+    user = current_user
     if user:
         user.strava_access_token = None
         user.strava_refresh_token = None
@@ -609,438 +685,284 @@ def strava_disconnect(db: Session = Depends(get_db)):
     return {"message": "Strava account disconnected"}
 
 
-# Helper function to fetch segment times from Strava
-async def fetch_segment_times_from_strava(segment_id: int, access_token: str) -> schemas.StravaSegmentTime:
-    """Fetch segment times from Strava API"""
-    async with httpx.AsyncClient() as client:
-        # Get segment details
-        segment_response = await client.get(
-            f"https://www.strava.com/api/v3/segments/{segment_id}",
-            headers={"Authorization": f"Bearer {access_token}"},
-            timeout=10.0
-        )
-        
-        if segment_response.status_code != 200:
-            if segment_response.status_code == 404:
-                raise HTTPException(status_code=404, detail="Segment not found")
-            elif segment_response.status_code == 401:
-                raise HTTPException(status_code=401, detail="Strava authentication expired. Please reconnect your Strava account.")
-            elif segment_response.status_code == 429:
-                raise HTTPException(status_code=429, detail="Rate limit exceeded. Please try again in a few minutes.")
-            else:
-                error_text = segment_response.text[:200] if segment_response.text else "Unknown error"
-                raise HTTPException(
-                    status_code=segment_response.status_code, 
-                    detail=f"Strava API error ({segment_response.status_code}): {error_text}"
-                )
-        
-        segment_data = segment_response.json()
-        segment_name = segment_data.get("name", "")
-        distance_meters = segment_data.get("distance", 0)
-        elevation_high = segment_data.get("elevation_high", 0)
-        elevation_low = segment_data.get("elevation_low", 0)
-        elevation_gain_meters = elevation_high - elevation_low if elevation_high > elevation_low else 0
-        
-        # Try to get leaderboard/KOM information (may be deprecated but worth trying)
-        crown_holder = None
-        crown_time = None
-        crown_date = None
-        crown_pace = None
-        
-        try:
-            leaderboard_response = await client.get(
-                f"https://www.strava.com/api/v3/segments/{segment_id}/leaderboard",
-                headers={"Authorization": f"Bearer {access_token}"},
-                params={"per_page": 1},  # Just get the top entry
-                timeout=5.0
-            )
-            
-            if leaderboard_response.status_code == 200:
-                leaderboard_data = leaderboard_response.json()
-                entries = leaderboard_data.get("entries", [])
-                
-                if entries:
-                    # Get the top entry (KOM/QOM)
-                    top_entry = entries[0]
-                    athlete = top_entry.get("athlete_name", "")
-                    elapsed_time = top_entry.get("elapsed_time")
-                    
-                    if athlete and elapsed_time:
-                        crown_holder = athlete
-                        
-                        # Convert seconds to MM:SS format
-                        minutes = elapsed_time // 60
-                        seconds = elapsed_time % 60
-                        crown_time = f"{int(minutes)}:{int(seconds):02d}"
-                        
-                        # Calculate pace
-                        if distance_meters > 0:
-                            distance_miles = distance_meters / 1609.34
-                            pace_seconds_per_mile = elapsed_time / distance_miles
-                            pace_minutes = int(pace_seconds_per_mile // 60)
-                            pace_seconds = int(pace_seconds_per_mile % 60)
-                            crown_pace = f"{pace_minutes}:{pace_seconds:02d}"
-                        
-                        # Get date if available
-                        start_date = top_entry.get("start_date")
-                        if start_date:
-                            try:
-                                dt = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
-                                crown_date = dt.strftime("%m/%d/%Y")
-                            except:
-                                pass
-        except Exception as e:
-            # Leaderboard endpoint may be deprecated or unavailable - that's okay
-            print(f"Could not fetch leaderboard data: {e}")
-        
-        # Get athlete's segment stats
-        stats_response = await client.get(
-            f"https://www.strava.com/api/v3/segments/{segment_id}/all_efforts",
-            headers={"Authorization": f"Bearer {access_token}"},
-            params={"per_page": 200},  # Get all efforts to find best
-        )
-        
-        personal_best_time = None
-        personal_best_pace = None
-        personal_best_grade_adjusted_pace = None
-        personal_attempts = 0
-        last_attempt_date = None
-        personal_best_activity_id = None
-        
-        if stats_response.status_code == 200:
-            efforts = stats_response.json()
-            personal_attempts = len(efforts)
-            
-            if efforts:
-                # Find best effort
-                best_effort = min(efforts, key=lambda e: e.get("elapsed_time", float('inf')))
-                elapsed_time = best_effort.get("elapsed_time")
-                
-                # Get activity ID from the best effort
-                activity = best_effort.get("activity")
-                if activity:
-                    personal_best_activity_id = activity.get("id")
-                
-                if elapsed_time and distance_meters > 0:
-                    # Convert seconds to MM:SS format
-                    minutes = elapsed_time // 60
-                    seconds = elapsed_time % 60
-                    personal_best_time = f"{int(minutes)}:{int(seconds):02d}"
-                    
-                    # Calculate pace
-                    distance_miles = distance_meters / 1609.34
-                    pace_seconds_per_mile = elapsed_time / distance_miles
-                    pace_minutes = int(pace_seconds_per_mile // 60)
-                    pace_seconds = int(pace_seconds_per_mile % 60)
-                    personal_best_pace = f"{pace_minutes}:{pace_seconds:02d}"
-                    
-                    # Calculate Grade Adjusted Pace (GAP)
-                    # GAP adjusts pace to what it would be on flat terrain
-                    # Formula: GAP = actual_pace / (1 + k * grade)
-                    # Where k ≈ 0.04 for uphill, k ≈ 0.02 for downhill
-                    # Grade = elevation_gain / distance (as decimal)
-                    if elevation_gain_meters > 0:
-                        grade = elevation_gain_meters / distance_meters  # Grade as decimal (e.g., 0.05 = 5%)
-                        # Use k = 0.04 for uphill segments (positive grade)
-                        # This is a simplified model - Strava's exact formula is proprietary
-                        k = 0.04 if grade > 0 else 0.02
-                        gap_factor = 1 + (k * grade)
-                        gap_seconds_per_mile = pace_seconds_per_mile / gap_factor
-                        gap_minutes = int(gap_seconds_per_mile // 60)
-                        gap_seconds = int(gap_seconds_per_mile % 60)
-                        personal_best_grade_adjusted_pace = f"{gap_minutes}:{gap_seconds:02d}"
-                    elif elevation_gain_meters == 0:
-                        # Flat segment - GAP equals actual pace
-                        personal_best_grade_adjusted_pace = personal_best_pace
-                
-                # Get last attempt date (most recent)
-                latest_effort = max(efforts, key=lambda e: e.get("start_date", ""))
-                start_date = latest_effort.get("start_date")
-                if start_date:
-                    try:
-                        dt = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
-                        last_attempt_date = dt.strftime("%m/%d/%Y")
-                    except:
-                        pass
-        
-        # Get polyline and start coordinates from segment data
-        polyline = None
-        start_latitude = None
-        start_longitude = None
-        
-        try:
-            segment_response = await client.get(
-                f"https://www.strava.com/api/v3/segments/{segment_id}",
-                headers={"Authorization": f"Bearer {access_token}"},
-                timeout=10.0
-            )
-            if segment_response.status_code == 200:
-                segment_data = segment_response.json()
-                polyline = segment_data.get("polyline")
-                start_latitude = segment_data.get("start_latitude")
-                start_longitude = segment_data.get("start_longitude")
-        except Exception:
-            pass  # If we can't get polyline, continue without it
-        
-        return schemas.StravaSegmentTime(
-            segment_id=segment_id,
-            segment_name=segment_name,
-            personal_best_time=personal_best_time,
-            personal_best_pace=personal_best_pace,
-            personal_best_grade_adjusted_pace=personal_best_grade_adjusted_pace,
-            personal_attempts=personal_attempts if personal_attempts > 0 else None,
-            last_attempt_date=last_attempt_date,
-            personal_best_activity_id=personal_best_activity_id,
-            polyline=polyline,
-            start_latitude=start_latitude,
-            start_longitude=start_longitude,
-            crown_holder=crown_holder,
-            crown_time=crown_time,
-            crown_date=crown_date,
-            crown_pace=crown_pace,
-        )
+@app.get("/strava/webhook")
+def strava_webhook_validate(request: Request):
+    """Answer Strava's push subscription validation handshake"""
+    params = request.query_params
+    if params.get("hub.mode") != "subscribe" or not params.get("hub.challenge"):
+        raise HTTPException(status_code=400, detail="Invalid subscription request")
+    if not strava_webhooks.STRAVA_WEBHOOK_VERIFY_TOKEN or params.get("hub.verify_token") != strava_webhooks.STRAVA_WEBHOOK_VERIFY_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid verify token")
+    return {"hub.challenge": params["hub.challenge"]}
+
+
+@app.post("/strava/webhook")
+async def strava_webhook_event(request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    """Queue a Strava webhook event and process it after responding (Strava expects a reply within 2s)"""
+    try:
+        event = await request.json()
+        if not strava_webhooks.subscription_matches(event):
+            raise HTTPException(status_code=403, detail="Unknown webhook subscription")
+        strava_webhooks.record_event(db, event)
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid webhook event: {str(e)}")
+
+    background_tasks.add_task(strava_webhooks.process_pending_events)
+    return {"message": "Event received"}
+
+
+# Hard cap per route on the Strava work behind one request; the sub-calls share what is left.
+# Past it, whatever was fetched is returned marked partial (or database data marked stale).
+SEGMENT_TIMES_DEADLINE_SECONDS = float(os.getenv("SEGMENT_TIMES_DEADLINE_SECONDS", "10"))
+SEGMENT_METADATA_DEADLINE_SECONDS = float(os.getenv("SEGMENT_METADATA_DEADLINE_SECONDS", "6"))
+
+
+def strava_is_failing(error: Exception) -> bool:
+    """Whether an error means Strava is down, slow or throttling us (as opposed to a bad request)"""
+    if isinstance(error, (StravaUnavailable, DeadlineExceeded, httpx.TransportError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+
+def stale_segment_time(db_item: models.Item, user_stats: Optional[models.UserSegmentStats], reason: str):
+    """Database-backed times response, marked stale, for when Strava can't be reached"""
+    logger.info("Returning database segment times", extra={"segment_id": db_item.strava_segment_id, "reason": reason})
+    tracing.annotate(stale_reason=reason)
+    metrics.segment_stats_lookups.inc(result="stale")
+    segment_time = stats_refresher.segment_time_from_item(db_item, user_stats)
+    segment_time.stale = True
+    return segment_time
+
+
+async def fetch_segment_times_with_own_session(segment_id: int, access_token: str, user_id: int,
+                                               deadline: float) -> schemas.StravaSegmentTime:
+    """Shared (coalesced) times fetch. It may outlive the request that started it, so it doesn't use that request's session."""
+    db = SessionLocal()
+    try:
+        return await fetch_segment_times_from_strava(segment_id, access_token, db=db, user_id=user_id, deadline=deadline)
+    finally:
+        db.close()
 
 
 @app.get("/strava/segments/{segment_id}/times", response_model=schemas.StravaSegmentTime)
-async def get_segment_times(segment_id: int, current_user: models.User = Depends(require_auth), db: Session = Depends(get_db)):
-    """Get personal best time for a segment from Strava, with database fallback for rate limits"""
+async def get_segment_times(segment_id: int, background_tasks: BackgroundTasks, request: Request, response: Response,
+                            current_user: models.User = Depends(require_auth), db: Session = Depends(get_db)):
+    """Get personal best time for a segment, from the database when its stats are fresh,
+    otherwise from Strava (saved back after responding) with database fallback while Strava is failing"""
     if not current_user.strava_access_token:
         raise HTTPException(status_code=401, detail="Strava not connected")
+    deadline = time.monotonic() + SEGMENT_TIMES_DEADLINE_SECONDS
     
-    access_token = await get_valid_access_token_async(current_user, db)
-    if not access_token:
-        raise HTTPException(status_code=401, detail="Invalid Strava token. Please reconnect.")
-    
-    # Get database data as fallback
-    db_item = db.query(models.Item).filter(models.Item.strava_segment_id == segment_id).first()
-    
-    # Log which segment we're trying to fetch
-    print(f"Fetching segment times for segment_id: {segment_id}")
+    with tracing.span("segment_stats.lookup") as span:
+        # Get database data as fallback
+        db_item = db.query(models.Item).filter(models.Item.strava_segment_id == segment_id).first()
+
+        user_stats = db.get(models.UserSegmentStats, (current_user.id, segment_id))
+
+        # Serve from the database while the background refresher keeps this athlete's stats fresh
+        fresh = False
+        if db_item:
+            stats_refresher.mark_requested(db, db_item)
+            fresh = stats_refresher.stats_are_fresh(user_stats)
+        if span is not None:
+            span.attributes["result"] = "hit" if fresh else "miss"
+    if fresh:
+        metrics.segment_stats_lookups.inc(result="hit")
+        return stats_refresher.segment_time_from_item(db_item, user_stats)
+    if db_item and not strava_breaker.allows_requests():
+        return stale_segment_time(db_item, user_stats, "Strava circuit open")
+    if admission.shedding():
+        if db_item:
+            return stale_segment_time(db_item, user_stats, "Strava routes overloaded")
+        raise admission.overloaded_error()
+    limit = await rate_limits.check(request, current_user.id)
+    response.headers.update(limit.headers)
+    if limit.limited:
+        if db_item:
+            return stale_segment_time(db_item, user_stats, "Rate limited")
+        raise limit.error()
     
     try:
-        return await fetch_segment_times_from_strava(segment_id, access_token)
-    except HTTPException as e:
-        # For rate limits (429), return database data if available
-        if e.status_code == 429 and db_item:
-            print(f"Rate limit hit for segment {segment_id}, returning database data")
-            return schemas.StravaSegmentTime(
-                segment_id=segment_id,
-                segment_name=db_item.segment_name or "",
-                personal_best_time=db_item.personal_best_time,
-                personal_best_pace=db_item.personal_best_pace,
-                personal_best_grade_adjusted_pace=None,  # Not stored in DB
-                personal_attempts=db_item.personal_attempts if db_item.personal_attempts else None,
-                last_attempt_date=db_item.last_attempt_date,
-                personal_best_activity_id=None,  # Not stored in DB
-                polyline=db_item.polyline,
-                start_latitude=db_item.start_latitude,
-                start_longitude=db_item.start_longitude,
-                crown_holder=db_item.crown_holder,
-                crown_time=db_item.crown_time,
-                crown_date=db_item.crown_date,
-                crown_pace=db_item.crown_pace,
-            )
-        # For auth errors, still raise
-        if e.status_code == 401:
-            raise
-        # Log the error for debugging
-        print(f"HTTPException fetching segment {segment_id}: {e.status_code} - {e.detail}")
-        raise
-    except httpx.HTTPStatusError as e:
-        print(f"HTTPStatusError fetching segment {segment_id}: {e.response.status_code} - {e.response.text[:200]}")
-        # For rate limits, return database data if available
-        if e.response.status_code == 429 and db_item:
-            print(f"Rate limit hit for segment {segment_id}, returning database data")
-            return schemas.StravaSegmentTime(
-                segment_id=segment_id,
-                segment_name=db_item.segment_name or "",
-                personal_best_time=db_item.personal_best_time,
-                personal_best_pace=db_item.personal_best_pace,
-                personal_best_grade_adjusted_pace=None,
-                personal_attempts=db_item.personal_attempts if db_item.personal_attempts else None,
-                last_attempt_date=db_item.last_attempt_date,
-                personal_best_activity_id=None,
-                polyline=db_item.polyline,
-                start_latitude=db_item.start_latitude,
-                start_longitude=db_item.start_longitude,
-                crown_holder=db_item.crown_holder,
-                crown_time=db_item.crown_time,
-                crown_date=db_item.crown_date,
-                crown_pace=db_item.crown_pace,
+        access_token = await get_valid_access_token_async(current_user, db, deadline)
+        if not access_token:
+            raise HTTPException(status_code=401, detail="Invalid Strava token. Please reconnect.")
+
+        logger.debug("Fetching segment times", extra={"segment_id": segment_id, "sample_rate": DEBUG_SAMPLE_RATE})
+        # Concurrent requests from the same athlete (e.g. several tabs) share one fetch
+        with tracing.span("strava.segment_times") as span:
+            segment_times, joined = await strava_fetches.run(
+                ("times", segment_id, current_user.id),
+                lambda: fetch_segment_times_with_own_session(segment_id, access_token, current_user.id, deadline),
             )
-        if e.response.status_code == 401:
-            raise HTTPException(status_code=401, detail="Strava token expired. Please reconnect.")
-        elif e.response.status_code == 404:
-            raise HTTPException(status_code=404, detail=f"Segment {segment_id} not found on Strava. It may have been deleted or made private.")
-        raise HTTPException(status_code=e.response.status_code, detail=f"Strava API error ({e.response.status_code}): {e.response.text[:200]}")
+            if span is not None:
+                span.attributes.update(coalesced=joined, partial=segment_times.partial)
+        metrics.segment_stats_lookups.inc(result="miss")
+        if joined:
+            metrics.strava_fetches_coalesced.inc(kind="times")
     except Exception as e:
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"Error fetching segment times for {segment_id}: {error_trace}")
+        # Rate limits, Strava errors, timeouts and an open circuit: answer from the database if we can
+        if strava_is_failing(e) and db_item:
+            return stale_segment_time(db_item, user_stats, f"Strava failing ({type(e).__name__})")
+        if isinstance(e, HTTPException):
+            if e.status_code != 401:
+                logger.warning("Error fetching segment times", extra={
+                    "segment_id": segment_id, "status_code": e.status_code, "detail": e.detail,
+                })
+            raise
+        if isinstance(e, StravaUnavailable):
+            raise HTTPException(status_code=503, detail=str(e))
+        if isinstance(e, (httpx.TimeoutException, DeadlineExceeded)):
+            raise HTTPException(status_code=504, detail="Request to Strava API timed out. Please try again.")
+        if isinstance(e, httpx.HTTPStatusError):
+            logger.warning("Strava error fetching segment times", extra={
+                "segment_id": segment_id, "status_code": e.response.status_code, "detail": e.response.text[:200],
+            })
+            if e.response.status_code == 401:
+                raise HTTPException(status_code=401, detail="Strava token expired. Please reconnect.")
+            elif e.response.status_code == 404:
+                raise HTTPException(status_code=404, detail=f"Segment {segment_id} not found on Strava. It may have been deleted or made private.")
+            raise HTTPException(status_code=e.response.status_code, detail=f"Strava API error ({e.response.status_code}): {e.response.text[:200]}")
+        logger.exception("Error fetching segment times", extra={"segment_id": segment_id})
         raise HTTPException(status_code=500, detail=f"Error fetching segment data: {str(e)}")
 
+    # Keep the database current for fallbacks and the fresh path, without making this request wait.
+    # A partial result only has trustworthy map data, so the athlete's stats are left for the refresher.
+    if db_item and not joined and segment_times.partial:
+        background_tasks.add_task(
+            stats_refresher.write_through, segment_id, stats_refresher.shared_item_fields(segment_times)
+        )
+    elif db_item and not joined:
+        background_tasks.add_task(
+            stats_refresher.write_through,
+            segment_id,
+            stats_refresher.shared_item_fields(segment_times),
+            current_user.id,
+            stats_refresher.times_stats_fields(segment_times),
+        )
+    return segment_times
+
+
+def stale_segment_metadata(db_item: models.Item, reason: str = "Strava failing") -> schemas.StravaSegmentMetadata:
+    """Metadata stored for a segment, marked stale, for when Strava can't be reached"""
+    logger.info("Returning database segment metadata", extra={"segment_id": db_item.strava_segment_id, "reason": reason})
+    tracing.annotate(stale_reason=reason)
+    return schemas.StravaSegmentMetadata(
+        segment_id=db_item.strava_segment_id,
+        segment_name=db_item.segment_name or "",
+        distance=db_item.distance,
+        elevation_gain=db_item.elevation_gain,
+        strava_url=db_item.strava_url or f"https://www.strava.com/segments/{db_item.strava_segment_id}",
+        polyline=db_item.polyline,
+        start_latitude=db_item.start_latitude,
+        start_longitude=db_item.start_longitude,
+        crown_holder=db_item.crown_holder,
+        crown_time=db_item.crown_time,
+        crown_date=db_item.crown_date,
+        crown_pace=db_item.crown_pace,
+        stale=True,
+    )
+
+
+def db_pool_stats() -> dict:
+    pool = engine.pool
+    stats = {}
+    for state, reading in (("checked_out", "checkedout"), ("idle", "checkedin"), ("overflow", "overflow"), ("size", "size")):
+        if hasattr(pool, reading):
+            stats[(state,)] = getattr(pool, reading)()
+    return stats
+
+
+metrics.Gauge("db_pool_connections", "Database connection pool usage, added up across workers", ("state",), collect=db_pool_stats)
+metrics.Gauge(
+    "strava_circuit_open", "1 while the circuit breaker around Strava is open or half-open", merge="max",
+    collect=lambda: {(): 0 if strava_breaker.state == strava_breaker.CLOSED else 1},
+)
+metrics.Gauge(
+    "strava_fetches_in_flight", "Distinct Strava fetches running for segment endpoints",
+    collect=lambda: {(): strava_fetches.in_flight()},
+)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    """Request, Strava, cache and pool metrics in the Prometheus text format (all workers with METRICS_DIR)"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/strava/circuit-breaker")
+def strava_circuit_breaker_status():
+    """State of the circuit breaker around Strava, for monitoring"""
+    return strava_breaker.snapshot()
+
+
+def require_profile_token(request: Request):
+    """Guard for the profiling endpoints: 404 while profiling is off, 403 without the PROFILE_TOKEN header"""
+    if not profiling.PROFILE_DIR or not profiling.PROFILE_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not profiling.token_is_valid(request.headers.get("X-Profile-Token")):
+        raise HTTPException(status_code=403, detail="Invalid profile token")
+
+
+@app.get("/debug/profiles", dependencies=[Depends(require_profile_token)])
+def list_request_profiles():
+    """Captured request profiles, newest first"""
+    return profiling.list_profiles()
+
+
+@app.get("/debug/profiles/{profile_id}", dependencies=[Depends(require_profile_token)])
+def get_request_profile(profile_id: str):
+    """Download a captured profile (pyinstrument HTML, or cProfile stats for pstats/snakeviz)"""
+    path = profiling.profile_path(profile_id)
+    if not path:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, filename=os.path.basename(path))
+
 
 @app.get("/strava/segments/{segment_id}/metadata", response_model=schemas.StravaSegmentMetadata)
-async def get_segment_metadata(segment_id: int, current_user: models.User = Depends(require_auth), db: Session = Depends(get_db)):
-    """Get segment metadata (name, distance, elevation, crown info) from Strava"""
+async def get_segment_metadata(segment_id: int, background_tasks: BackgroundTasks, request: Request, response: Response,
+                               current_user: models.User = Depends(require_auth), db: Session = Depends(get_db)):
+    """Get segment metadata (name, distance, elevation, crown info) from Strava,
+    or from the database (marked stale) while Strava is failing"""
     if not current_user.strava_access_token:
         raise HTTPException(status_code=401, detail="Strava authentication required. Please connect your Strava account.")
+    deadline = time.monotonic() + SEGMENT_METADATA_DEADLINE_SECONDS
     
-    access_token = await get_valid_access_token_async(current_user, db)
-    if not access_token:
-        raise HTTPException(status_code=401, detail="Invalid Strava token. Please reconnect your Strava account.")
+    existing_item = db.query(models.Item).filter(
+        models.Item.strava_segment_id == segment_id
+    ).first()
+    if existing_item and not strava_breaker.allows_requests():
+        return stale_segment_metadata(existing_item)
+    if admission.shedding():
+        if existing_item:
+            return stale_segment_metadata(existing_item, "Strava routes overloaded")
+        raise admission.overloaded_error()
+    limit = await rate_limits.check(request, current_user.id)
+    response.headers.update(limit.headers)
+    if limit.limited:
+        if existing_item:
+            return stale_segment_metadata(existing_item, "Rate limited")
+        raise limit.error()
     
     try:
-        async with httpx.AsyncClient() as client:
-            segment_response = await client.get(
-                f"https://www.strava.com/api/v3/segments/{segment_id}",
-                headers={"Authorization": f"Bearer {access_token}"},
-                timeout=10.0
+        access_token = await get_valid_access_token_async(current_user, db, deadline)
+        if not access_token:
+            raise HTTPException(status_code=401, detail="Invalid Strava token. Please reconnect your Strava account.")
+
+        # Metadata is the same for everyone, so concurrent requests for a segment share one fetch
+        with tracing.span("strava.segment_metadata") as span:
+            metadata, joined = await strava_fetches.run(
+                ("metadata", segment_id), lambda: fetch_segment_metadata_from_strava(segment_id, access_token, deadline=deadline)
             )
-            
-            if segment_response.status_code != 200:
-                if segment_response.status_code == 401:
-                    raise HTTPException(status_code=401, detail="Strava authentication expired. Please reconnect your Strava account.")
-                if segment_response.status_code == 404:
-                    raise HTTPException(status_code=404, detail="Segment not found")
-                error_text = segment_response.text[:200] if segment_response.text else "Unknown error"
-                raise HTTPException(status_code=segment_response.status_code, detail=f"Strava API error: {error_text}")
-            
-            segment_data = segment_response.json()
-            
-            # Convert distance from meters to miles
-            distance_meters = segment_data.get("distance", 0)
-            distance_miles = distance_meters / 1609.34 if distance_meters > 0 else None
-            
-            # Convert elevation from meters to feet
-            # Strava provides elevation_high and elevation_low, but we want total elevation gain
-            # For segments, we can use average_grade and distance to estimate, or use elevation_high - elevation_low
-            elevation_high = segment_data.get("elevation_high", 0)
-            elevation_low = segment_data.get("elevation_low", 0)
-            elevation_gain_meters = elevation_high - elevation_low if elevation_high > elevation_low else 0
-            elevation_gain_feet = elevation_gain_meters * 3.28084 if elevation_gain_meters > 0 else None
-            
-            # Get polyline and start coordinates for map display
-            # Strava API may return polyline in different formats:
-            # 1. Direct "polyline" field
-            # 2. Inside "map" object as "polyline" or "summary_polyline"
-            polyline = segment_data.get("polyline")
-            if not polyline or (isinstance(polyline, str) and polyline.strip() == ""):
-                map_obj = segment_data.get("map", {})
-                polyline = map_obj.get("polyline") or map_obj.get("summary_polyline")
-                # Convert empty strings to None
-                if polyline and isinstance(polyline, str) and polyline.strip() == "":
-                    polyline = None
-            
-            # Strava may return coordinates as:
-            # 1. Separate "start_latitude" and "start_longitude" fields
-            # 2. "start_latlng" array [latitude, longitude]
-            start_latitude = segment_data.get("start_latitude")
-            start_longitude = segment_data.get("start_longitude")
-            
-            if not start_latitude or not start_longitude:
-                start_latlng = segment_data.get("start_latlng")
-                if start_latlng and isinstance(start_latlng, list) and len(start_latlng) >= 2:
-                    start_latitude = start_latlng[0]
-                    start_longitude = start_latlng[1]
-            
-            # Convert to None if invalid (must be valid float/int and within valid lat/lng ranges)
-            if start_latitude is not None:
-                if not isinstance(start_latitude, (int, float)) or not (-90 <= start_latitude <= 90):
-                    start_latitude = None
-            if start_longitude is not None:
-                if not isinstance(start_longitude, (int, float)) or not (-180 <= start_longitude <= 180):
-                    start_longitude = None
-            
-            # Log for debugging
-            print(f"Segment {segment_id} map data: polyline={'present' if polyline else 'missing'}, "
-                  f"start_lat={start_latitude}, start_lng={start_longitude}")
-            
-            # Note: Strava deprecated the leaderboard API in 2020, so crown/KOM information
-            # is no longer available via the API. Users must manually enter this information
-            # or view it directly on Strava's website.
-            crown_holder = None
-            crown_time = None
-            crown_date = None
-            crown_pace = None
-            
-            # Attempt to fetch leaderboard data (will likely fail due to API deprecation)
-            # This is kept for potential future API changes or if Strava re-enables it
-            try:
-                leaderboard_response = await client.get(
-                    f"https://www.strava.com/api/v3/segments/{segment_id}/leaderboard",
-                    headers={"Authorization": f"Bearer {access_token}"},
-                    params={"per_page": 1},
-                    timeout=5.0
-                )
-                
-                if leaderboard_response.status_code == 200:
-                    leaderboard_data = leaderboard_response.json()
-                    entries = leaderboard_data.get("entries", [])
-                    
-                    if entries:
-                        top_entry = entries[0]
-                        athlete = top_entry.get("athlete_name", "")
-                        elapsed_time = top_entry.get("elapsed_time")
-                        
-                        if athlete and elapsed_time:
-                            crown_holder = athlete
-                            
-                            # Convert seconds to MM:SS format
-                            minutes = elapsed_time // 60
-                            seconds = elapsed_time % 60
-                            crown_time = f"{int(minutes)}:{int(seconds):02d}"
-                            
-                            # Calculate pace
-                            if distance_meters > 0:
-                                distance_miles = distance_meters / 1609.34
-                                pace_seconds_per_mile = elapsed_time / distance_miles
-                                pace_minutes = int(pace_seconds_per_mile // 60)
-                                pace_seconds = int(pace_seconds_per_mile % 60)
-                                crown_pace = f"{pace_minutes}:{pace_seconds:02d}"
-                            
-                            # Get date if available
-                            start_date = top_entry.get("start_date")
-                            if start_date:
-                                try:
-                                    dt = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
-                                    crown_date = dt.strftime("%m/%d/%Y")
-                                except:
-                                    pass
-            except Exception as e:
-                # Leaderboard endpoint is deprecated - this is expected
-                # Crown information will remain None and can be manually entered
-                pass
-            
-            metadata = schemas.StravaSegmentMetadata(
-                segment_id=segment_id,
-                segment_name=segment_data.get("name", ""),
-                distance=round(distance_miles, 2) if distance_miles else None,
-                elevation_gain=round(elevation_gain_feet, 1) if elevation_gain_feet else None,
-                strava_url=f"https://www.strava.com/segments/{segment_id}",
-                polyline=polyline,
-                start_latitude=start_latitude,
-                start_longitude=start_longitude,
-                crown_holder=crown_holder,
-                crown_time=crown_time,
-                crown_date=crown_date,
-                crown_pace=crown_pace,
-            )
-            
-            # Update existing segment in database with polyline data if it exists
-            existing_item = db.query(models.Item).filter(
-                models.Item.strava_segment_id == segment_id
-            ).first()
-            
-            if existing_item:
-                existing_item.polyline = polyline
-                existing_item.start_latitude = start_latitude
-                existing_item.start_longitude = start_longitude
-                db.commit()
-            
-            return metadata
-            
-    except HTTPException:
+            if span is not None:
+                span.attributes["coalesced"] = joined
+        if joined:
+            metrics.strava_fetches_coalesced.inc(kind="metadata")
+    except HTTPException as e:
+        if existing_item and strava_is_failing(e):
+            return stale_segment_metadata(existing_item)
         raise
     except httpx.HTTPStatusError as e:
         if e.response.status_code == 401:
@@ -1049,11 +971,23 @@ async def get_segment_metadata(segment_id: int, current_user: models.User = Depe
             raise HTTPException(status_code=404, detail="Segment not found")
         error_text = e.response.text[:200] if e.response.text else "Unknown error"
         raise HTTPException(status_code=e.response.status_code, detail=f"Strava API error: {error_text}")
-    except httpx.TimeoutException:
-        raise HTTPException(status_code=504, detail="Request to Strava API timed out. Please try again.")
+    except (StravaUnavailable, DeadlineExceeded, httpx.TransportError) as e:
+        if existing_item:
+            return stale_segment_metadata(existing_item)
+        if isinstance(e, StravaUnavailable):
+            raise HTTPException(status_code=503, detail=str(e))
+        if isinstance(e, (httpx.TimeoutException, DeadlineExceeded)):
+            raise HTTPException(status_code=504, detail="Request to Strava API timed out. Please try again.")
+        raise HTTPException(status_code=502, detail=f"Could not reach Strava: {str(e)}")
     except Exception as e:
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"Error fetching segment metadata: {error_trace}")
+        logger.exception("Error fetching segment metadata", extra={"segment_id": segment_id})
         raise HTTPException(status_code=500, detail=f"Error fetching segment metadata: {str(e)}")
 
+    # Save map and crown data on an existing segment after responding (once per shared fetch)
+    if existing_item and not joined:
+        background_tasks.add_task(
+            stats_refresher.write_through, segment_id, stats_refresher.shared_item_fields(metadata)
+        )
+    
+    return metadata
+
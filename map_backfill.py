@@ -0,0 +1,288 @@
+"""
+Resumable backfill of segment map data (polyline and start coordinates) from Strava.
+
+Used by fetch_missing_map_data.py and fetch_map_data_for_segments.py. Items are
+walked in id order, a batch at a time: each batch is fetched from Strava
+concurrently, written back in one commit, and the checkpoint in the
+backfill_checkpoints table is moved forward in that same commit. A run that
+crashes or runs out of quota picks up after the last committed batch.
+"""
+
+import asyncio
+import time
+from typing import List, Optional
+
+import httpx
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+from strava_client import STRAVA_API_URL, RateLimiter, extract_map_data, get_connected_user, get_valid_access_token_async
+
+# Items fetched (and committed) together
+BATCH_SIZE = 50
+
+# Number of Strava requests in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+
+# Attempts per segment for 429s, 5xx and network errors
+MAX_ATTEMPTS = 5
+
+MAP_FIELDS = ("polyline", "start_latitude", "start_longitude")
+
+
+class QuotaExhausted(Exception):
+    """Strava kept rate limiting us - stop and resume later from the checkpoint"""
+
+
+def _format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{(seconds % 3600) // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class Progress:
+    """Prints progress, throughput and ETA after each batch"""
+
+    def __init__(self, total: int, already_done: int = 0):
+        self.total = total
+        self.done = already_done
+        self._started_done = already_done
+        self._started = time.monotonic()
+
+    def advance(self, count: int):
+        self.done += count
+        elapsed = time.monotonic() - self._started
+        rate = (self.done - self._started_done) / elapsed if elapsed > 0 else 0
+        percent = 100 * self.done / self.total if self.total else 100
+        eta = _format_duration((self.total - self.done) / rate) if rate > 0 else "?"
+        print(f"📈 [{self.done}/{self.total}] {percent:.1f}%  {rate:.1f} segments/s  ETA {eta}")
+
+
+async def fetch_segment_map_data(client: httpx.AsyncClient, limiter: RateLimiter, segment_id: int, access_token: str):
+    """Fetch map data from Strava, backing off on rate limits and transient errors.
+
+    Returns (polyline, start_latitude, start_longitude, error). Raises QuotaExhausted
+    if Strava is still rate limiting after MAX_ATTEMPTS.
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        response = None
+        try:
+            response = await limiter.get(
+                client,
+                f"{STRAVA_API_URL}/segments/{segment_id}",
+                headers={"Authorization": f"Bearer {access_token}"},
+                timeout=10.0
+            )
+        except RuntimeError as e:
+            # Daily limit reached
+            raise QuotaExhausted(str(e))
+        except httpx.TransportError as e:
+            if attempt == MAX_ATTEMPTS:
+                return None, None, None, f"Network error for segment {segment_id}: {e}"
+
+        if response is not None:
+            if response.status_code == 200:
+                return (*extract_map_data(response.json()), None)
+            if response.status_code == 404:
+                return None, None, None, f"Segment {segment_id} not found"
+            if response.status_code == 401:
+                return None, None, None, f"Authentication failed for segment {segment_id}"
+            if response.status_code == 429 and attempt == MAX_ATTEMPTS:
+                raise QuotaExhausted(f"Rate limit exceeded for segment {segment_id}")
+            if response.status_code != 429 and response.status_code < 500:
+                return None, None, None, f"Error {response.status_code} for segment {segment_id}"
+            if response.status_code >= 500 and attempt == MAX_ATTEMPTS:
+                return None, None, None, f"Error {response.status_code} for segment {segment_id}"
+
+        delay = limiter.backoff_delay(response, attempt)
+        if response is not None and response.status_code == 429:
+            # Hold back the other workers too, not just this one
+            limiter.pause(delay)
+        await asyncio.sleep(delay)
+
+
+def _load_checkpoint(db: Session, job: str) -> models.BackfillCheckpoint:
+    checkpoint = db.query(models.BackfillCheckpoint).filter(models.BackfillCheckpoint.job == job).first()
+    if not checkpoint:
+        checkpoint = models.BackfillCheckpoint(job=job, last_item_id=0, processed=0)
+        db.add(checkpoint)
+        db.commit()
+    return checkpoint
+
+
+def _missing_map_data_filter(query):
+    return query.filter(
+        (models.Item.polyline.is_(None)) |
+        (models.Item.start_latitude.is_(None)) |
+        (models.Item.start_longitude.is_(None))
+    )
+
+
+async def run_map_backfill(job: str, segment_ids: Optional[List[int]] = None, restart: bool = False):
+    """Fill in missing map data for items with a strava_segment_id.
+
+    job names the checkpoint. With segment_ids, only those segments are considered;
+    otherwise every item missing some map data is. restart ignores a saved checkpoint.
+    """
+    db = SessionLocal()
+
+    try:
+        # Check for Strava user
+        user = get_connected_user(db)
+        if not user:
+            print("❌ Error: No Strava user found. Please connect Strava first.")
+            print("   Run the app and connect your Strava account, then run this script again.")
+            return
+
+        # Get valid access token
+        access_token = await get_valid_access_token_async(user, db)
+        if not access_token:
+            print("❌ Error: Could not get valid Strava access token.")
+            print("   Please reconnect your Strava account in the app.")
+            return
+
+        print(f"✓ Authenticated with Strava")
+
+        checkpoint = _load_checkpoint(db, job)
+        if restart and checkpoint.last_item_id:
+            checkpoint.last_item_id = 0
+            checkpoint.processed = 0
+            db.commit()
+        elif checkpoint.last_item_id:
+            print(f"↩️  Resuming '{job}' after item {checkpoint.last_item_id} "
+                  f"({checkpoint.processed} already processed)")
+
+        base_query = db.query(models.Item).filter(models.Item.strava_segment_id.isnot(None))
+        not_found_count = 0
+        if segment_ids is not None:
+            base_query = base_query.filter(models.Item.strava_segment_id.in_(segment_ids))
+            known_ids = {row[0] for row in db.query(models.Item.strava_segment_id).filter(
+                models.Item.strava_segment_id.in_(segment_ids)
+            )}
+            for segment_id in segment_ids:
+                if segment_id not in known_ids:
+                    print(f"⚠️  Segment {segment_id}: Not found in database")
+                    not_found_count += 1
+        base_query = _missing_map_data_filter(base_query)
+
+        remaining = base_query.filter(models.Item.id > checkpoint.last_item_id).count()
+        if not remaining:
+            print("✓ All segments already have map data!")
+            db.delete(checkpoint)
+            db.commit()
+            return
+
+        print(f"📋 Found {remaining} segments missing map data\n")
+        progress = Progress(total=checkpoint.processed + remaining, already_done=checkpoint.processed)
+
+        updated_count = 0
+        error_count = 0
+        no_data_count = 0
+        stopped = None
+
+        limiter = RateLimiter(max_concurrency=MAX_CONCURRENT_REQUESTS)
+        limits = httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS)
+        async with httpx.AsyncClient(limits=limits) as client:
+            while stopped is None:
+                # Keyset pagination on id - the checkpoint is the last id we finished
+                batch = (
+                    base_query.filter(models.Item.id > checkpoint.last_item_id)
+                    .order_by(models.Item.id)
+                    .limit(BATCH_SIZE)
+                    .all()
+                )
+                if not batch:
+                    break
+
+                results = await asyncio.gather(
+                    *(fetch_segment_map_data(client, limiter, item.strava_segment_id, access_token) for item in batch),
+                    return_exceptions=True,
+                )
+
+                updates = []
+                finished = []
+                for item, result in zip(batch, results):
+                    if isinstance(result, BaseException):
+                        if not isinstance(result, QuotaExhausted):
+                            raise result
+                        # Everything from here on stays pending for the next run
+                        stopped = result
+                        break
+                    finished.append(item)
+
+                    polyline, start_lat, start_lng, error = result
+                    if error:
+                        print(f"   ❌ Segment {item.strava_segment_id}: {error}")
+                        error_count += 1
+                        continue
+
+                    # Only fill in fields that are missing
+                    values = {}
+                    if polyline and not item.polyline:
+                        values["polyline"] = polyline
+                    if start_lat and not item.start_latitude:
+                        values["start_latitude"] = start_lat
+                    if start_lng and not item.start_longitude:
+                        values["start_longitude"] = start_lng
+
+                    if not values:
+                        print(f"   ⏭️  Segment {item.strava_segment_id}: No map data available from Strava")
+                        no_data_count += 1
+                        continue
+
+                    # Bulk UPDATE by primary key needs every row to set the same columns
+                    updates.append({
+                        "id": item.id,
+                        **{field: values.get(field, getattr(item, field)) for field in MAP_FIELDS},
+                    })
+                    print(f"   ✓ Segment {item.strava_segment_id} ('{item.segment_name}'): "
+                          f"Updated {', '.join(values.keys())}")
+
+                if not finished:
+                    break
+
+                # Write the batch and move the checkpoint in one transaction
+                try:
+                    if updates:
+                        db.execute(update(models.Item), updates)
+                    checkpoint.last_item_id = finished[-1].id
+                    checkpoint.processed += len(finished)
+                    db.commit()
+                except Exception as e:
+                    db.rollback()
+                    print(f"❌ Database error, stopping (run again to resume): {str(e)}")
+                    raise
+
+                updated_count += len(updates)
+                progress.advance(len(finished))
+
+        if stopped is None:
+            # Finished - the next run starts from the beginning again
+            db.delete(checkpoint)
+            db.commit()
+
+        print(f"\n{'='*60}")
+        print(f"📊 Summary:")
+        print(f"   ✓ Updated: {updated_count}")
+        print(f"   ⏭️  No data available: {no_data_count}")
+        if segment_ids is not None:
+            print(f"   ⚠️  Not in database: {not_found_count}")
+        print(f"   ❌ Errors: {error_count}")
+        print(f"   📋 Total processed: {progress.done}/{progress.total}")
+        print(f"{'='*60}")
+
+        if stopped is not None:
+            print(f"\n⏸️  Stopped: {stopped}")
+            print(f"   Progress is saved - run the script again to resume.")
+
+    except Exception as e:
+        print(f"❌ Fatal error: {e}")
+        import traceback
+        traceback.print_exc()
+    finally:
+        db.close()
@@ -0,0 +1,298 @@
+"""
+In-process metrics, served in the Prometheus text format at GET /metrics.
+
+Recording is a dict lookup and an add under a lock, so it is cheap enough for
+every request and every Strava call. Each uvicorn worker keeps its own values;
+with METRICS_DIR set (an empty directory shared by the workers, cleared on
+deploy) every worker writes a snapshot there and /metrics adds them all up.
+Lambda containers can't be scraped, so there the snapshot is logged as one log
+line (at most every METRICS_LOG_INTERVAL_SECONDS) for CloudWatch to aggregate.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Directory the workers of one deployment share their snapshots through (unset: single process)
+METRICS_DIR = os.getenv("METRICS_DIR")
+
+# How often each worker writes its snapshot to METRICS_DIR
+METRICS_FLUSH_SECONDS = 5.0
+
+# Snapshots not written for this long belong to a dead worker; its gauges are ignored
+STALE_SNAPSHOT_SECONDS = 60.0
+
+METRICS_LOG_INTERVAL_SECONDS = float(os.getenv("METRICS_LOG_INTERVAL_SECONDS", "60"))
+
+logger = logging.getLogger("metrics")
+
+# Seconds - from a fast database read up to a request that waits out its Strava deadline
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def values(self) -> List[list]:
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """A current value. `merge` says how workers' values combine: sum, min or max."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (), merge: str = "sum",
+                 collect: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        super().__init__(name, help_text, labels)
+        self.merge = merge
+        self._collect = collect  # Read at snapshot time instead of being set
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def values(self) -> List[list]:
+        if self._collect:
+            try:
+                collected = {tuple(key): float(value) for key, value in self._collect().items()}
+            except Exception:
+                collected = {}  # A broken collector shouldn't take /metrics down
+            with self._lock:
+                self._values.update(collected)
+        return super().values()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [per-bucket counts (not cumulative), sum, count]
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def values(self) -> List[list]:
+        with self._lock:
+            return [[list(key), [list(entry[0]), entry[1], entry[2]]] for key, entry in self._values.items()]
+
+
+REGISTRY: Dict[str, _Metric] = {}
+
+
+def snapshot() -> dict:
+    """This process's metrics as plain JSON-able data"""
+    return {
+        name: {"values": metric.values()}
+        for name, metric in REGISTRY.items()
+    }
+
+
+def _merge(into: Dict[tuple, object], metric: _Metric, values: List[list]):
+    for labels, value in values:
+        key = tuple(labels)
+        current = into.get(key)
+        if current is None:
+            into[key] = value
+        elif isinstance(metric, Histogram):
+            into[key] = [[a + b for a, b in zip(current[0], value[0])], current[1] + value[1], current[2] + value[2]]
+        elif isinstance(metric, Gauge) and metric.merge in ("min", "max"):
+            into[key] = min(current, value) if metric.merge == "min" else max(current, value)
+        else:
+            into[key] = current + value
+
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"metrics-{pid}.json")
+
+
+def write_snapshot():
+    """Save this worker's snapshot to METRICS_DIR (written to a temp file, then swapped in)"""
+    if not METRICS_DIR:
+        return
+    path = _snapshot_path(os.getpid())
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _all_snapshots() -> List[Tuple[dict, bool]]:
+    """(snapshot, is_live) for every worker - just this one without METRICS_DIR"""
+    if not METRICS_DIR:
+        return [(snapshot(), True)]
+    write_snapshot()
+    snapshots = []
+    now = time.time()
+    for filename in os.listdir(METRICS_DIR):
+        if not (filename.startswith("metrics-") and filename.endswith(".json")):
+            continue
+        path = os.path.join(METRICS_DIR, filename)
+        try:
+            with open(path) as f:
+                snapshots.append((json.load(f), now - os.path.getmtime(path) < STALE_SNAPSHOT_SECONDS))
+        except (OSError, ValueError):
+            continue  # Being replaced right now
+    return snapshots
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render() -> str:
+    """Every worker's metrics, combined, in the Prometheus text exposition format"""
+    snapshots = _all_snapshots()
+    lines = []
+    for name, metric in REGISTRY.items():
+        merged: Dict[tuple, object] = {}
+        for data, is_live in snapshots:
+            if isinstance(metric, Gauge) and not is_live:
+                continue
+            _merge(merged, metric, data.get(name, {}).get("values", []))
+
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for key, value in sorted(merged.items()):
+            if isinstance(metric, Histogram):
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets, counts):
+                    cumulative += bucket_count
+                    le = 'le="%s"' % bound
+                    lines.append(f"{name}_bucket{_format_labels(metric.labels, key, le)} {cumulative}")
+                le = 'le="+Inf"'
+                lines.append(f"{name}_bucket{_format_labels(metric.labels, key, le)} {count}")
+                lines.append(f"{name}_sum{_format_labels(metric.labels, key)} {_format_number(total)}")
+                lines.append(f"{name}_count{_format_labels(metric.labels, key)} {count}")
+            else:
+                lines.append(f"{name}{_format_labels(metric.labels, key)} {_format_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request until its response is fully sent.
+
+    Requests are labelled with the matched route's path template (e.g.
+    /strava/segments/{segment_id}/times), so IDs don't become separate series.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        response = {"status": 500, "recorded": False}
+
+        def record():
+            response["recorded"] = True
+            http_request_duration.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                route=getattr(scope.get("route"), "path", "unmatched"),
+                status=response["status"],
+            )
+
+        async def send_and_record(message):
+            await send(message)
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                # Background tasks (write-through, webhook processing) run after this and aren't counted
+                record()
+
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            if not response["recorded"]:
+                record()
+
+
+_last_logged = 0.0
+
+
+def maybe_log_snapshot():
+    """Log the snapshot if it hasn't been for METRICS_LOG_INTERVAL_SECONDS (for Lambda)"""
+    global _last_logged
+    now = time.monotonic()
+    if now - _last_logged < METRICS_LOG_INTERVAL_SECONDS:
+        return
+    _last_logged = now
+    logger.info("metrics snapshot", extra={"metrics": snapshot(), "pid": os.getpid()})
+
+
+# --- What the app records ---
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Time to send the full response, by route template",
+    ("method", "route", "status"),
+)
+strava_request_duration = Histogram(
+    "strava_request_duration_seconds", "Strava API call latency, by endpoint (IDs replaced with {id})",
+    ("method", "endpoint", "status"),
+)
+strava_rate_limit_remaining = Gauge(
+    "strava_rate_limit_remaining", "Strava requests left in the current window, from the last response",
+    ("window",), merge="min",
+)
+strava_token_refreshes = Counter(
+    "strava_token_refreshes_total", "Strava access token refreshes", ("result",),
+)
+segment_stats_lookups = Counter(
+    "segment_stats_lookups_total",
+    "Segment times requests: hit (fresh database data), miss (fetched from Strava) or stale (database fallback)",
+    ("result",),
+)
+strava_fetches_coalesced = Counter(
+    "strava_fetches_coalesced_total", "Requests that shared an identical in-flight Strava fetch", ("kind",),
+)
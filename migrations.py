@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+"""
+Versioned schema migrations for the Strava Segment Tracker database.
+
+Every schema change is a numbered migration below. Applied versions are recorded
+in the schema_migrations table, so startup only needs a single primary-key read
+to know whether anything is pending.
+
+Migrations are written so deploys don't block reads on the items table:
+- DDL runs with a short lock_timeout and is retried instead of queueing readers
+- indexes are built with CREATE INDEX CONCURRENTLY
+- data backfills run in small batches, each in its own transaction
+
+Usage:
+    python migrations.py           # Apply pending migrations
+    python migrations.py --status  # Show applied and pending migrations
+"""
+
+import sys
+import time
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import DBAPIError, OperationalError, ProgrammingError
+
+VERSION_TABLE = "schema_migrations"
+
+# Arbitrary constant used with pg_advisory_lock so only one instance migrates at a time
+MIGRATION_LOCK_ID = 72_616_001
+
+# How long DDL may wait for a lock before giving up (and retrying)
+DDL_LOCK_TIMEOUT = "3s"
+DDL_RETRIES = 5
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def _is_postgres(bind) -> bool:
+    return bind.dialect.name == "postgresql"
+
+
+# Helpers used by the migrations
+
+def _run_ddl(engine: Engine, *statements: str):
+    """Run DDL in one short transaction, retrying if the lock can't be taken quickly.
+
+    A plain ALTER TABLE waits behind long-running reads and every read that arrives
+    after it waits behind the ALTER. With a lock_timeout we give up quickly instead,
+    let the readers through, and try again.
+    """
+    for attempt in range(1, DDL_RETRIES + 1):
+        try:
+            with engine.begin() as conn:
+                if _is_postgres(conn):
+                    conn.execute(text(f"SET LOCAL lock_timeout = '{DDL_LOCK_TIMEOUT}'"))
+                for statement in statements:
+                    conn.execute(text(statement))
+            return
+        except OperationalError as e:
+            if attempt == DDL_RETRIES or "lock timeout" not in str(e).lower():
+                raise
+            print(f"   ⏳ Lock not available, retrying ({attempt}/{DDL_RETRIES})...")
+            time.sleep(attempt)
+
+
+def _add_column(engine: Engine, table: str, column: str, ddl: str):
+    """Add a column if it is missing. ddl is the column type and constraints."""
+    if _is_postgres(engine):
+        _run_ddl(engine, f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {ddl}")
+        return
+
+    # Other dialects (SQLite for local testing) have no ADD COLUMN IF NOT EXISTS
+    with engine.connect() as conn:
+        existing = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+    if column not in existing:
+        _run_ddl(engine, f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def _serial(engine: Engine) -> str:
+    """Column type for an auto-incrementing integer primary key"""
+    # On SQLite an INTEGER PRIMARY KEY is the rowid, which already auto-increments
+    return "SERIAL" if _is_postgres(engine) else "INTEGER"
+
+
+def _drop_column(engine: Engine, table: str, column: str):
+    if _is_postgres(engine):
+        _run_ddl(engine, f"ALTER TABLE {table} DROP COLUMN IF EXISTS {column}")
+        return
+
+    with engine.connect() as conn:
+        existing = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+    if column in existing:
+        _run_ddl(engine, f"ALTER TABLE {table} DROP COLUMN {column}")
+
+
+def _create_index(engine: Engine, name: str, table: str, columns: str, unique: bool = False, where: str = None):
+    """Create an index without taking a write lock on the table (CONCURRENTLY)"""
+    unique_sql = "UNIQUE " if unique else ""
+    where_sql = f" WHERE {where}" if where else ""
+
+    if not _is_postgres(engine):
+        _run_ddl(engine, f"CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON {table} ({columns}){where_sql}")
+        return
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        # A failed concurrent build leaves an INVALID index behind that IF NOT EXISTS
+        # would happily skip, so drop it and build again
+        invalid = conn.execute(text("""
+            SELECT 1 FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = :name AND NOT i.indisvalid
+        """), {"name": name}).first()
+        if invalid:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+        conn.execute(text(
+            f"CREATE {unique_sql}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns}){where_sql}"
+        ))
+
+
+def _backfill(engine: Engine, statement: str, batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """Run an UPDATE in batches until it stops matching rows.
+
+    statement must limit itself with LIMIT :batch_size and stop matching rows it has
+    already updated. Each batch commits on its own so row locks are held briefly.
+    """
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            updated = conn.execute(text(statement), {"batch_size": batch_size}).rowcount
+        total += updated
+        if updated < batch_size:
+            return total
+
+
+# Migrations
+#
+# Never edit a migration that has already shipped - add a new one instead.
+
+def _0001_baseline(engine: Engine):
+    """Create the users and items tables"""
+    # IF NOT EXISTS: databases created before migrations already have these tables.
+    # Columns added since then come from the migrations that follow.
+    _run_ddl(
+        engine,
+        f"""
+        CREATE TABLE IF NOT EXISTS users (
+            id {_serial(engine)} NOT NULL PRIMARY KEY,
+            strava_id INTEGER,
+            strava_access_token VARCHAR,
+            strava_refresh_token VARCHAR,
+            token_expires_at TIMESTAMP,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_users_id ON users (id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_strava_id ON users (strava_id)",
+        f"""
+        CREATE TABLE IF NOT EXISTS items (
+            id {_serial(engine)} NOT NULL PRIMARY KEY,
+            segment_name VARCHAR,
+            distance DOUBLE PRECISION,
+            elevation_gain DOUBLE PRECISION,
+            elevation_loss DOUBLE PRECISION,
+            crown_holder VARCHAR,
+            crown_date VARCHAR,
+            crown_time VARCHAR,
+            crown_pace VARCHAR,
+            personal_best_time VARCHAR,
+            personal_best_pace VARCHAR,
+            personal_attempts INTEGER,
+            overall_attempts INTEGER,
+            last_attempt_date VARCHAR,
+            strava_url VARCHAR
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_items_id ON items (id)",
+        "CREATE INDEX IF NOT EXISTS ix_items_segment_name ON items (segment_name)",
+    )
+
+
+def _0002_map_columns(engine: Engine):
+    """Add polyline and start coordinate columns to items"""
+    _add_column(engine, "items", "polyline", "TEXT")
+    _add_column(engine, "items", "start_latitude", "DOUBLE PRECISION")
+    _add_column(engine, "items", "start_longitude", "DOUBLE PRECISION")
+
+
+def _0003_completed_column(engine: Engine):
+    """Add items.completed"""
+    # With a constant default this is a catalog-only change on PostgreSQL 11+
+    _add_column(engine, "items", "completed", "BOOLEAN NOT NULL DEFAULT FALSE")
+    _create_index(engine, "ix_items_completed", "items", "completed")
+
+
+def _0004_dibs_column(engine: Engine):
+    """Add items.dibs"""
+    _add_column(engine, "items", "dibs", "VARCHAR")
+
+
+def _0005_strava_segment_id(engine: Engine):
+    """Add items.strava_segment_id and fill it in from strava_url"""
+    _add_column(engine, "items", "strava_segment_id", "INTEGER")
+    _create_index(engine, "ix_items_strava_segment_id", "items", "strava_segment_id")
+
+    if _is_postgres(engine):
+        updated = _backfill(engine, r"""
+            UPDATE items
+            SET strava_segment_id = CAST(substring(strava_url FROM '/segments/(\d+)') AS INTEGER)
+            WHERE id IN (
+                SELECT id FROM items
+                WHERE strava_segment_id IS NULL AND strava_url ~ '/segments/\d+'
+                LIMIT :batch_size
+            )
+        """)
+        print(f"   ✓ Backfilled strava_segment_id for {updated} item(s)")
+
+
+def _0006_drop_difficulty(engine: Engine):
+    """Remove the unused items.difficulty column"""
+    _drop_column(engine, "items", "difficulty")
+
+
+def _0007_backfill_checkpoints(engine: Engine):
+    """Create the backfill_checkpoints table"""
+    _run_ddl(engine, """
+        CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+            job VARCHAR NOT NULL PRIMARY KEY,
+            last_item_id INTEGER NOT NULL,
+            processed INTEGER NOT NULL,
+            updated_at TIMESTAMP
+        )
+    """)
+
+
+def _0008_stats_refresh_columns(engine: Engine):
+    """Add stored stats and refresh bookkeeping columns to items"""
+    _add_column(engine, "items", "personal_best_grade_adjusted_pace", "VARCHAR")
+    _add_column(engine, "items", "personal_best_activity_id", "BIGINT")
+    _add_column(engine, "items", "stats_refreshed_at", "TIMESTAMP")
+    _add_column(engine, "items", "stats_requested_at", "TIMESTAMP")
+    _create_index(engine, "ix_items_stats_refreshed_at", "items", "stats_refreshed_at")
+
+
+def _0009_strava_webhook_events(engine: Engine):
+    """Create the strava_webhook_events queue table"""
+    # The new table is empty, so its indexes can be built in the same transaction
+    _run_ddl(
+        engine,
+        f"""
+        CREATE TABLE IF NOT EXISTS strava_webhook_events (
+            id {_serial(engine)} NOT NULL PRIMARY KEY,
+            object_type VARCHAR NOT NULL,
+            object_id BIGINT NOT NULL,
+            aspect_type VARCHAR NOT NULL,
+            owner_id BIGINT NOT NULL,
+            event_time INTEGER,
+            updates VARCHAR,
+            received_at TIMESTAMP,
+            processed_at TIMESTAMP,
+            error VARCHAR
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_strava_webhook_events_id ON strava_webhook_events (id)",
+        "CREATE INDEX IF NOT EXISTS ix_strava_webhook_events_object_id ON strava_webhook_events (object_id)",
+        # Workers only ever look for queued events, so keep that index small
+        "CREATE INDEX IF NOT EXISTS ix_strava_webhook_events_pending ON strava_webhook_events (id)"
+        " WHERE processed_at IS NULL",
+    )
+
+
+def _0010_segment_efforts(engine: Engine):
+    """Create the segment_efforts table"""
+    _run_ddl(
+        engine,
+        """
+        CREATE TABLE IF NOT EXISTS segment_efforts (
+            id BIGINT NOT NULL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            segment_id BIGINT NOT NULL,
+            activity_id BIGINT,
+            start_date TIMESTAMP NOT NULL,
+            start_date_local TIMESTAMP,
+            elapsed_time INTEGER NOT NULL
+        )
+        """,
+        # PB lookups walk this index in elapsed_time order
+        "CREATE INDEX IF NOT EXISTS ix_segment_efforts_user_segment_elapsed"
+        " ON segment_efforts (user_id, segment_id, elapsed_time)",
+        # The sync's high-water mark is the newest stored effort
+        "CREATE INDEX IF NOT EXISTS ix_segment_efforts_user_segment_start"
+        " ON segment_efforts (user_id, segment_id, start_date)",
+        "CREATE INDEX IF NOT EXISTS ix_segment_efforts_activity_id ON segment_efforts (activity_id)",
+    )
+
+
+def _0011_user_segment_stats(engine: Engine):
+    """Create the per-athlete user_segment_stats table"""
+    # Not backfilled from items - those values belong to whichever athlete refreshed
+    # them last. The background refresher fills it in for every connected athlete.
+    _run_ddl(engine, """
+        CREATE TABLE IF NOT EXISTS user_segment_stats (
+            user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            segment_id BIGINT NOT NULL,
+            personal_best_time VARCHAR,
+            personal_best_pace VARCHAR,
+            personal_best_grade_adjusted_pace VARCHAR,
+            personal_attempts INTEGER NOT NULL,
+            last_attempt_date VARCHAR,
+            personal_best_activity_id BIGINT,
+            refreshed_at TIMESTAMP,
+            PRIMARY KEY (user_id, segment_id)
+        )
+    """)
+
+
+def _0012_activities_synced_through(engine: Engine):
+    """Add users.activities_synced_through for the activity-driven sync"""
+    _add_column(engine, "users", "activities_synced_through", "TIMESTAMP")
+
+
+def _0013_rate_limit_buckets(engine: Engine):
+    """Create the rate_limit_buckets table for the postgres rate limit backend"""
+    _run_ddl(engine, """
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            key VARCHAR NOT NULL PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at DOUBLE PRECISION NOT NULL
+        )
+    """)
+
+
+def _0014_webhook_event_claims(engine: Engine):
+    """Add strava_webhook_events.claimed_at so drains don't hold row locks while processing"""
+    _add_column(engine, "strava_webhook_events", "claimed_at", "TIMESTAMP")
+
+
+def _0015_checkpoint_resume_after(engine: Engine):
+    """Add backfill_checkpoints.resume_after so activity history syncs can resume"""
+    _add_column(engine, "backfill_checkpoints", "resume_after", "TIMESTAMP")
+
+
+MIGRATIONS: List[Tuple[int, Callable[[Engine], None]]] = [
+    (1, _0001_baseline),
+    (2, _0002_map_columns),
+    (3, _0003_completed_column),
+    (4, _0004_dibs_column),
+    (5, _0005_strava_segment_id),
+    (6, _0006_drop_difficulty),
+    (7, _0007_backfill_checkpoints),
+    (8, _0008_stats_refresh_columns),
+    (9, _0009_strava_webhook_events),
+    (10, _0010_segment_efforts),
+    (11, _0011_user_segment_stats),
+    (12, _0012_activities_synced_through),
+    (13, _0013_rate_limit_buckets),
+    (14, _0014_webhook_event_claims),
+    (15, _0015_checkpoint_resume_after),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# Runner
+
+def get_current_version(engine: Engine) -> Optional[int]:
+    """Return the latest applied version, or None if the version table doesn't exist yet"""
+    try:
+        with engine.connect() as conn:
+            # max() over the primary key is answered from the index
+            return conn.execute(text(f"SELECT max(version) FROM {VERSION_TABLE}")).scalar() or 0
+    except (ProgrammingError, OperationalError):
+        return None
+
+
+def _ensure_version_table(conn: Connection):
+    conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (
+            version INTEGER PRIMARY KEY,
+            description VARCHAR NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+
+
+def run_migrations(engine: Engine) -> int:
+    """Apply all pending migrations in order. Returns how many were applied."""
+    with engine.connect() as lock_conn:
+        if _is_postgres(engine):
+            # Several instances can start at once during a deploy - only one migrates
+            lock_conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+            lock_conn.commit()
+
+        try:
+            with engine.begin() as conn:
+                _ensure_version_table(conn)
+
+            current = get_current_version(engine) or 0
+            applied = 0
+            for version, migration in MIGRATIONS:
+                if version <= current:
+                    continue
+
+                description = (migration.__doc__ or migration.__name__).strip()
+                print(f"🔄 Applying migration {version}: {description}")
+                migration(engine)
+
+                with engine.begin() as conn:
+                    conn.execute(
+                        text(f"INSERT INTO {VERSION_TABLE} (version, description) VALUES (:version, :description)"),
+                        {"version": version, "description": description},
+                    )
+                applied += 1
+
+            return applied
+        finally:
+            if _is_postgres(engine):
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+                lock_conn.commit()
+
+
+def ensure_schema(engine: Engine):
+    """Startup check: one indexed read, and migrate only if something is pending"""
+    current = get_current_version(engine)
+    if current is not None and current >= LATEST_VERSION:
+        return
+
+    try:
+        applied = run_migrations(engine)
+    except DBAPIError as e:
+        print(f"❌ Error applying migrations: {e}")
+        raise
+    if applied:
+        print(f"✓ Applied {applied} migration(s), schema is at version {LATEST_VERSION}")
+
+
+def print_status(engine: Engine):
+    current = get_current_version(engine) or 0
+    print(f"Schema version: {current} (latest: {LATEST_VERSION})")
+    for version, migration in MIGRATIONS:
+        status = "✓" if version <= current else "…"
+        description = (migration.__doc__ or migration.__name__).strip()
+        print(f"  {status} {version:04d} {description}")
+
+
+if __name__ == "__main__":
+    from database import engine
+
+    if "--status" in sys.argv[1:]:
+        print_status(engine)
+    else:
+        applied = run_migrations(engine)
+        if applied:
+            print(f"\n✓ Applied {applied} migration(s). Schema is at version {LATEST_VERSION}.")
+        else:
+            print(f"✓ Schema is up to date (version {LATEST_VERSION}).")
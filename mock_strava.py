@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+"""
+A fake Strava API for local development and load tests, so the Strava-facing
+code can be exercised without real accounts or burning quota.
+
+Covers what the app and scripts call: segments, leaderboard, all_efforts,
+athlete, athlete/activities, activities/{id}, push_subscriptions, and
+oauth/authorize and oauth/token. Data is synthetic but deterministic: the same
+segment or activity ID always gets the same response. The athlete's efforts are
+generated once from the activities, so all_efforts, effort counts and detailed
+activities agree on every effort's ID and activity, as they do on real Strava.
+
+Point the app at it with STRAVA_BASE_URL:
+
+    python mock_strava.py --port 8090 --latency lognormal:80:0.6 --error-rate 0.02
+    STRAVA_BASE_URL=http://localhost:8090 uvicorn main:app
+
+Behaviour settings (command line, or MOCK_STRAVA_* environment variables when
+run as `uvicorn mock_strava:app`), changeable at runtime with PUT /_mock/config:
+
+    latency        fixed:MS, uniform:MIN_MS:MAX_MS or lognormal:MEDIAN_MS:SIGMA (default lognormal:80:0.5)
+    error_rate     share of requests answered with a 500 or 503 (default 0)
+    timeout_rate   share of requests that hang for hang_seconds, past any client timeout (default 0)
+    hang_seconds   how long those requests hang (default 30)
+    rate_limit     "SHORT,DAILY" request limits reported in X-RateLimit-* headers and enforced
+                   with 429s, or "off" (default 100,1000 like Strava)
+    rate_window    seconds in the short rate limit window (default 900, on the clock like Strava's)
+    segments       "FIRST-LAST" segment IDs that activities have efforts on (default 12345-12352)
+    activities     how many activities the athlete has (default 200)
+
+GET /_mock/stats returns request counts; POST /_mock/reset clears them and the rate limit usage.
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlencode
+
+from fastapi import FastAPI, Form, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, RedirectResponse
+
+ATHLETE_ID = int(os.getenv("MOCK_STRAVA_ATHLETE_ID", "1000001"))
+
+# Synthetic efforts and activities are dated back from here, so responses don't change day to day
+EPOCH = datetime(2025, 1, 1, 8, 0, tzinfo=timezone.utc)
+
+# Activity IDs count up from here; an activity's efforts are numbered activity ID * 10 + k
+ACTIVITY_ID_BASE = 5 * 10 ** 10
+
+
+def parse_latency(spec: str):
+    """A function returning one latency sample in seconds, from a spec like lognormal:80:0.5"""
+    kind, _, rest = spec.partition(":")
+    values = [float(v) for v in rest.split(":") if v] if rest else []
+    if kind == "fixed" or (not rest and kind.replace(".", "", 1).isdigit()):
+        ms = values[0] if values else float(kind)
+        return lambda: ms / 1000
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1]) / 1000
+    if kind == "lognormal" and len(values) == 2:
+        return lambda: random.lognormvariate(math.log(max(values[0], 0.001)), values[1]) / 1000
+    raise ValueError(f"Bad latency spec {spec!r} (use fixed:MS, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA)")
+
+
+def parse_rate_limit(spec: str):
+    """(short, daily) limits, or None for "off\""""
+    if spec.strip().lower() in ("off", "none", ""):
+        return None
+    short, daily = (int(v) for v in spec.split(","))
+    return short, daily
+
+
+def parse_segments(spec: str) -> range:
+    first, _, last = spec.partition("-")
+    return range(int(first), int(last or first) + 1)
+
+
+class Settings:
+    def __init__(self):
+        self.update({
+            "latency": os.getenv("MOCK_STRAVA_LATENCY", "lognormal:80:0.5"),
+            "error_rate": os.getenv("MOCK_STRAVA_ERROR_RATE", "0"),
+            "timeout_rate": os.getenv("MOCK_STRAVA_TIMEOUT_RATE", "0"),
+            "hang_seconds": os.getenv("MOCK_STRAVA_HANG_SECONDS", "30"),
+            "rate_limit": os.getenv("MOCK_STRAVA_RATE_LIMIT", "100,1000"),
+            "rate_window": os.getenv("MOCK_STRAVA_RATE_WINDOW_SECONDS", "900"),
+            "segments": os.getenv("MOCK_STRAVA_SEGMENTS", "12345-12352"),
+            "activities": os.getenv("MOCK_STRAVA_ACTIVITIES", "200"),
+        })
+
+    def update(self, values: dict):
+        """Apply (and validate) any of the settings; raises ValueError on bad input"""
+        if "latency" in values:
+            self._latency_sample = parse_latency(str(values["latency"]))
+            self.latency = str(values["latency"])
+        if "error_rate" in values:
+            self.error_rate = float(values["error_rate"])
+        if "timeout_rate" in values:
+            self.timeout_rate = float(values["timeout_rate"])
+        if "hang_seconds" in values:
+            self.hang_seconds = float(values["hang_seconds"])
+        if "rate_limit" in values:
+            self.rate_limit = parse_rate_limit(str(values["rate_limit"]))
+        if "rate_window" in values:
+            self.rate_window = int(values["rate_window"])
+        if "segments" in values:
+            self.segments = parse_segments(str(values["segments"]))
+        if "activities" in values:
+            self.activities = int(values["activities"])
+
+    def latency_sample(self) -> float:
+        return max(self._latency_sample(), 0.0)
+
+    def as_dict(self) -> dict:
+        return {
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "timeout_rate": self.timeout_rate,
+            "hang_seconds": self.hang_seconds,
+            "rate_limit": ",".join(map(str, self.rate_limit)) if self.rate_limit else "off",
+            "rate_window": self.rate_window,
+            "segments": f"{self.segments.start}-{self.segments.stop - 1}",
+            "activities": self.activities,
+        }
+
+
+class RateLimitWindows:
+    """Request counts in the current short (on the clock, like Strava's 15 minutes) and daily windows"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._short_window = self._daily_window = None
+            self.short = self.daily = 0
+
+    def record(self, window_seconds: int) -> tuple:
+        """Count a request; returns (short usage, daily usage, seconds until the short window resets)"""
+        now = time.time()
+        short_window = int(now // window_seconds)
+        daily_window = int(now // 86400)
+        with self._lock:
+            if short_window != self._short_window:
+                self._short_window, self.short = short_window, 0
+            if daily_window != self._daily_window:
+                self._daily_window, self.daily = daily_window, 0
+            self.short += 1
+            self.daily += 1
+            return self.short, self.daily, (short_window + 1) * window_seconds - now
+
+
+settings = Settings()
+usage = RateLimitWindows()
+stats = {"requests": 0, "errors": 0, "timeouts": 0, "rate_limited": 0, "by_endpoint": {}}
+
+app = FastAPI(title="Mock Strava API")
+
+
+@app.middleware("http")
+async def simulate_strava(request: Request, call_next):
+    """Latency, injected failures and rate limiting for every API call"""
+    path = request.url.path
+    if path.startswith("/_mock"):
+        return await call_next(request)
+
+    stats["requests"] += 1
+    endpoint = "/".join("{id}" if part.isdigit() else part for part in path.split("/"))
+    stats["by_endpoint"][f"{request.method} {endpoint}"] = stats["by_endpoint"].get(f"{request.method} {endpoint}", 0) + 1
+
+    await asyncio.sleep(settings.latency_sample())
+
+    headers = {}
+    if settings.rate_limit:
+        short_usage, daily_usage, reset_in = usage.record(settings.rate_window)
+        headers = {
+            "X-RateLimit-Limit": f"{settings.rate_limit[0]},{settings.rate_limit[1]}",
+            "X-RateLimit-Usage": f"{short_usage},{daily_usage}",
+        }
+        if short_usage > settings.rate_limit[0] or daily_usage > settings.rate_limit[1]:
+            stats["rate_limited"] += 1
+            retry_after = reset_in if short_usage > settings.rate_limit[0] else 86400 - time.time() % 86400
+            return JSONResponse(
+                {"message": "Rate Limit Exceeded", "errors": [{"resource": "Application", "code": "exceeded"}]},
+                status_code=429, headers={**headers, "Retry-After": str(math.ceil(retry_after))},
+            )
+
+    roll = random.random()
+    if roll < settings.timeout_rate:
+        stats["timeouts"] += 1
+        await asyncio.sleep(settings.hang_seconds)
+    elif roll < settings.timeout_rate + settings.error_rate:
+        stats["errors"] += 1
+        return JSONResponse({"message": "Internal Server Error"}, status_code=random.choice([500, 503]), headers=headers)
+
+    response = await call_next(request)
+    response.headers.update(headers)
+    return response
+
+
+def _require_token(authorization: Optional[str]):
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Authorization Error")
+
+
+def _iso(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _polyline(rng: random.Random) -> str:
+    return "".join(rng.choice("?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`abcdefghijklmnopqrstuvwxyz{|}~") for _ in range(80))
+
+
+def _segment_base(segment_id: int) -> dict:
+    rng = random.Random(segment_id)
+    distance = round(rng.uniform(200, 5000), 1)
+    elevation_low = round(rng.uniform(0, 300), 1)
+    elevation_high = round(elevation_low + rng.uniform(0, 150), 1)
+    start = [round(rng.uniform(37.2, 37.9), 6), round(rng.uniform(-122.6, -121.8), 6)]
+    polyline = _polyline(rng)
+    return {
+        "id": segment_id,
+        "resource_state": 3,
+        "name": f"Mock segment {segment_id}",
+        "activity_type": "Run",
+        "distance": distance,
+        "average_grade": round((elevation_high - elevation_low) / distance * 100, 1),
+        "elevation_high": elevation_high,
+        "elevation_low": elevation_low,
+        "start_latlng": start,
+        "end_latlng": [start[0] + 0.01, start[1] + 0.01],
+        "map": {"id": f"s{segment_id}", "polyline": polyline, "resource_state": 3},
+        "effort_count": rng.randint(100, 50000),
+        "athlete_count": rng.randint(10, 5000),
+    }
+
+
+def make_segment(segment_id: int) -> dict:
+    return {**_segment_base(segment_id), "athlete_segment_stats": {"effort_count": len(make_efforts(segment_id))}}
+
+
+@lru_cache(maxsize=4)
+def _effort_table(segments: range, activity_count: int) -> Tuple[Dict[int, list], Dict[int, list]]:
+    """Every effort the athlete has, by activity ID and by segment ID, oldest first.
+
+    Detailed activities, all_efforts and each segment's effort_count all come from
+    here, so an effort has the same ID everywhere and belongs to the activity it names.
+    """
+    by_activity, by_segment = {}, {}
+    for index in reversed(range(activity_count)):  # Index 0 is the newest activity
+        activity = make_activity(index)
+        started = _parse_time(activity["start_date"])
+        rng = random.Random(activity["id"] * 7919)
+        segment_ids = rng.sample(list(segments), min(len(segments), rng.randint(1, 5)))
+        efforts = []
+        for k, segment_id in enumerate(segment_ids):
+            segment = _segment_base(segment_id)
+            elapsed = int(segment["distance"] / 3.5 * rng.uniform(0.85, 1.4))  # About a 7:40/mile pace
+            effort_start = _iso(started + timedelta(minutes=5 * k))
+            effort = {
+                "id": activity["id"] * 10 + k,
+                "resource_state": 2,
+                "name": segment["name"],
+                "elapsed_time": elapsed,
+                "moving_time": elapsed,
+                "start_date": effort_start,
+                "start_date_local": effort_start,
+                "distance": segment["distance"],
+                "segment": {"id": segment_id},
+                "activity": {"id": activity["id"]},
+                "athlete": {"id": ATHLETE_ID},
+            }
+            efforts.append(effort)
+            by_segment.setdefault(segment_id, []).append(effort)
+        by_activity[activity["id"]] = efforts
+    return by_activity, by_segment
+
+
+def make_efforts(segment_id: int) -> list:
+    """The athlete's efforts on a segment, oldest first"""
+    return _effort_table(settings.segments, settings.activities)[1].get(segment_id, [])
+
+
+def make_activity(index: int, detailed: bool = False) -> dict:
+    activity_id = ACTIVITY_ID_BASE + index
+    rng = random.Random(activity_id)
+    started = EPOCH - timedelta(days=index, minutes=rng.randint(0, 600))
+    activity = {
+        "id": activity_id,
+        "resource_state": 3 if detailed else 2,
+        "name": f"Mock run {index}",
+        "type": "Run",
+        "sport_type": "Run",
+        "distance": round(rng.uniform(3000, 20000), 1),
+        "elapsed_time": rng.randint(900, 7200),
+        "start_date": _iso(started),
+        "start_date_local": _iso(started),
+        "start_latlng": [round(rng.uniform(37.2, 37.9), 6), round(rng.uniform(-122.6, -121.8), 6)],
+        "manual": False,
+        "athlete": {"id": ATHLETE_ID},
+    }
+    if detailed:
+        activity["segment_efforts"] = _effort_table(settings.segments, settings.activities)[0][activity_id]
+    return activity
+
+
+def _page(items: list, page: int, per_page: int) -> list:
+    per_page = max(1, min(per_page, 200))
+    return items[(page - 1) * per_page:page * per_page]
+
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=timezone.utc)
+
+
+@app.get("/api/v3/segments/{segment_id}")
+def get_segment(segment_id: int, authorization: Optional[str] = Header(None)):
+    _require_token(authorization)
+    return make_segment(segment_id)
+
+
+@app.get("/api/v3/segments/{segment_id}/leaderboard")
+def get_leaderboard(segment_id: int, per_page: int = 10, authorization: Optional[str] = Header(None)):
+    _require_token(authorization)
+    segment = make_segment(segment_id)
+    rng = random.Random(segment_id * 31)
+    fastest = int(segment["distance"] / 5.5)
+    entries = [{
+        "athlete_name": f"Mock Runner {rank}",
+        "elapsed_time": fastest + rank * rng.randint(1, 5),
+        "start_date": _iso(EPOCH - timedelta(days=rng.randint(1, 900))),
+        "rank": rank,
+    } for rank in range(1, max(1, min(per_page, 200)) + 1)]
+    return {"effort_count": segment["effort_count"], "entry_count": segment["athlete_count"], "entries": entries}
+
+
+@app.get("/api/v3/segments/{segment_id}/all_efforts")
+def get_all_efforts(segment_id: int, page: int = 1, per_page: int = 30, start_date_local: Optional[str] = None,
+                    end_date_local: Optional[str] = None, authorization: Optional[str] = Header(None)):
+    _require_token(authorization)
+    efforts = make_efforts(segment_id)
+    since, until = _parse_time(start_date_local), _parse_time(end_date_local)
+    if since or until:
+        efforts = [
+            effort for effort in efforts
+            if (not since or _parse_time(effort["start_date_local"]) >= since)
+            and (not until or _parse_time(effort["start_date_local"]) <= until)
+        ]
+    return _page(efforts, page, per_page)
+
+
+@app.get("/api/v3/athlete")
+def get_athlete(authorization: Optional[str] = Header(None)):
+    _require_token(authorization)
+    return {"id": ATHLETE_ID, "resource_state": 3, "firstname": "Mock", "lastname": "Athlete", "city": "San Francisco"}
+
+
+@app.get("/api/v3/athlete/activities")
+def list_activities(page: int = 1, per_page: int = 30, after: Optional[int] = None, before: Optional[int] = None,
+                    authorization: Optional[str] = Header(None)):
+    _require_token(authorization)
+    activities = [make_activity(index) for index in range(settings.activities)]  # Newest first
+    if after is not None or before is not None:
+        activities = [
+            activity for activity in activities
+            if (after is None or _parse_time(activity["start_date"]).timestamp() > after)
+            and (before is None or _parse_time(activity["start_date"]).timestamp() < before)
+        ]
+    return _page(activities, page, per_page)
+
+
+@app.get("/api/v3/activities/{activity_id}")
+def get_activity(activity_id: int, authorization: Optional[str] = Header(None)):
+    _require_token(authorization)
+    index = activity_id - ACTIVITY_ID_BASE
+    if not 0 <= index < settings.activities:
+        raise HTTPException(status_code=404, detail="Record Not Found")
+    return make_activity(index, detailed=True)
+
+
+@app.get("/api/v3/push_subscriptions")
+def list_push_subscriptions():
+    return []
+
+
+@app.post("/api/v3/push_subscriptions")
+def create_push_subscription(callback_url: str = Form(...)):
+    return {"id": 1, "callback_url": callback_url}
+
+
+@app.get("/oauth/authorize")
+def authorize(redirect_uri: str, state: Optional[str] = None, scope: str = "read"):
+    """Approves straight away, like a user who clicked Authorize"""
+    params = {"code": "mock-authorization-code", "scope": scope}
+    if state:
+        params["state"] = state
+    separator = "&" if "?" in redirect_uri else "?"
+    return RedirectResponse(f"{redirect_uri}{separator}{urlencode(params)}")
+
+
+@app.post("/oauth/token")
+def token(grant_type: str = Form(...), code: Optional[str] = Form(None), refresh_token: Optional[str] = Form(None)):
+    if grant_type == "authorization_code" and not code:
+        raise HTTPException(status_code=400, detail="Bad Request: code")
+    if grant_type == "refresh_token" and not refresh_token:
+        raise HTTPException(status_code=400, detail="Bad Request: refresh_token")
+    if grant_type not in ("authorization_code", "refresh_token"):
+        raise HTTPException(status_code=400, detail="Bad Request: grant_type")
+    response = {
+        "token_type": "Bearer",
+        "access_token": f"mock-access-{random.getrandbits(64):016x}",
+        "refresh_token": refresh_token or f"mock-refresh-{random.getrandbits(64):016x}",
+        "expires_at": int(time.time()) + 6 * 3600,
+        "expires_in": 6 * 3600,
+    }
+    if grant_type == "authorization_code":
+        response["athlete"] = {"id": ATHLETE_ID, "firstname": "Mock", "lastname": "Athlete"}
+    return response
+
+
+@app.get("/_mock/config")
+def get_config():
+    return settings.as_dict()
+
+
+@app.put("/_mock/config")
+async def put_config(request: Request):
+    try:
+        settings.update(await request.json())
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return settings.as_dict()
+
+
+@app.get("/_mock/stats")
+def get_stats():
+    return {**stats, "rate_limit_usage": {"short": usage.short, "daily": usage.daily}}
+
+
+@app.post("/_mock/reset")
+def reset_stats():
+    usage.reset()
+    stats.update({"requests": 0, "errors": 0, "timeouts": 0, "rate_limited": 0, "by_endpoint": {}})
+    return get_stats()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run a fake Strava API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    for name in ("latency", "error_rate", "timeout_rate", "hang_seconds", "rate_limit", "rate_window", "segments", "activities"):
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, help=f"See the module docstring (default {settings.as_dict()[name]})")
+    args = parser.parse_args()
+    try:
+        settings.update({name: value for name, value in vars(args).items() if value is not None and name not in ("host", "port")})
+    except ValueError as e:
+        parser.error(str(e))
+
+    print(f"🏃 Mock Strava on http://{args.host}:{args.port} ({settings.as_dict()})")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
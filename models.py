@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, Float, Date, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, Float, Date, DateTime, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
@@ -15,6 +15,7 @@ class User(Base):
     token_expires_at = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    activities_synced_through = Column(DateTime, nullable=True)  # Activities before this were read by activity_sync.py
 
 
 class Item(Base):
@@ -41,4 +42,76 @@ class Item(Base):
     polyline = Column(String, nullable=True)  # Encoded polyline for map display
     start_latitude = Column(Float, nullable=True)  # Start point latitude
     start_longitude = Column(Float, nullable=True)  # Start point longitude
+    personal_best_grade_adjusted_pace = Column(String, nullable=True)  # format: MM:SS per mile
+    personal_best_activity_id = Column(BigInteger, nullable=True)  # Strava activity of the PB effort
+    stats_refreshed_at = Column(DateTime, nullable=True, index=True)  # Last background refresh from Strava
+    stats_requested_at = Column(DateTime, nullable=True)  # Last time a user asked for this segment's times
 
+
+
+class BackfillCheckpoint(Base):
+    __tablename__ = "backfill_checkpoints"
+
+    job = Column(String, primary_key=True)  # Name of the backfill run, e.g. "missing_map_data"
+    last_item_id = Column(Integer, nullable=False, default=0)  # Items with id <= this are done
+    processed = Column(Integer, nullable=False, default=0)
+    resume_after = Column(DateTime, nullable=True)  # Jobs walking activities by start time: those before this are done
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class StravaWebhookEvent(Base):
+    __tablename__ = "strava_webhook_events"
+
+    id = Column(Integer, primary_key=True, index=True)
+    object_type = Column(String, nullable=False)  # "activity" or "athlete"
+    object_id = Column(BigInteger, nullable=False, index=True)  # Activity or athlete ID
+    aspect_type = Column(String, nullable=False)  # "create", "update" or "delete"
+    owner_id = Column(BigInteger, nullable=False)  # Strava athlete ID
+    event_time = Column(Integer, nullable=True)  # Unix timestamp from Strava
+    updates = Column(String, nullable=True)  # JSON of changed fields, if any
+    received_at = Column(DateTime, default=datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)  # NULL while the event is still queued
+    claimed_at = Column(DateTime, nullable=True)  # Set while a drain is processing the event
+    error = Column(String, nullable=True)
+
+
+class SegmentEffort(Base):
+    __tablename__ = "segment_efforts"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=False)  # Strava effort ID
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    segment_id = Column(BigInteger, nullable=False)  # Strava segment ID
+    activity_id = Column(BigInteger, nullable=True)  # Strava activity the effort belongs to
+    start_date = Column(DateTime, nullable=False)  # UTC
+    start_date_local = Column(DateTime, nullable=True)  # Athlete's local time
+    elapsed_time = Column(Integer, nullable=False)  # seconds
+
+    __table_args__ = (
+        # PB lookups walk this index in elapsed_time order
+        Index("ix_segment_efforts_user_segment_elapsed", "user_id", "segment_id", "elapsed_time"),
+        Index("ix_segment_efforts_user_segment_start", "user_id", "segment_id", "start_date"),
+        Index("ix_segment_efforts_activity_id", "activity_id"),
+    )
+
+
+class UserSegmentStats(Base):
+    __tablename__ = "user_segment_stats"
+
+    # Composite primary key: one row per athlete per segment, looked up by (user, segment)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    segment_id = Column(BigInteger, primary_key=True)  # Strava segment ID
+    personal_best_time = Column(String, nullable=True)  # format: MM:SS:00
+    personal_best_pace = Column(String, nullable=True)  # format: MM:SS per mile
+    personal_best_grade_adjusted_pace = Column(String, nullable=True)  # format: MM:SS per mile
+    personal_attempts = Column(Integer, nullable=False, default=0)
+    last_attempt_date = Column(String, nullable=True)
+    personal_best_activity_id = Column(BigInteger, nullable=True)
+    refreshed_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class RateLimitBucket(Base):
+    __tablename__ = "rate_limit_buckets"
+
+    key = Column(String, primary_key=True)  # "user:<id>" or "ip:<address>"
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)  # Unix time (database clock) tokens was computed at
@@ -0,0 +1,180 @@
+"""
+Opt-in CPU profiles of individual requests, for finding where time goes under
+real traffic without redeploying.
+
+Off unless PROFILE_DIR is set. A request is profiled when it carries an
+X-Profile-Token header matching PROFILE_TOKEN, or at random with probability
+PROFILE_SAMPLE_RATE. The profile goes to PROFILE_DIR, and the response says
+which file in an X-Profile-Id header. GET /debug/profiles lists the captured
+profiles (the newest PROFILE_MAX_FILES are kept).
+
+pyinstrument (a sampling profiler, low overhead) is used when it is installed,
+writing an HTML report. Without it cProfile writes a .prof file for pstats or
+snakeviz. Only one request per process is profiled at a time. Profiles cover
+the event loop thread: async endpoints, Strava response parsing and response
+serialization. Sync endpoints run in the threadpool and show up as a wait.
+"""
+
+import cProfile
+import json
+import os
+import random
+import re
+import secrets
+import threading
+import time
+from typing import List, Optional
+
+try:
+    from pyinstrument import Profiler as SamplingProfiler
+except ImportError:  # Optional - cProfile is always there
+    SamplingProfiler = None
+
+import app_logging
+
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+
+# pyinstrument's sampling interval (seconds)
+SAMPLE_INTERVAL = 0.001
+
+# Profile ids are generated here; anything else asked for by name is refused
+PROFILE_ID_PATTERN = re.compile(r"^[0-9]{8}T[0-9]{6}-[0-9a-f]{8}$")
+
+_busy = threading.Lock()
+
+
+def token_is_valid(token: Optional[str]) -> bool:
+    return bool(PROFILE_TOKEN and token and secrets.compare_digest(token, PROFILE_TOKEN))
+
+
+def _new_profile_id() -> str:
+    return f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{secrets.token_hex(4)}"
+
+
+class _Capture:
+    """One running profile, with whichever profiler is available"""
+
+    def __init__(self):
+        if SamplingProfiler is not None:
+            self.format = "html"
+            self._profiler = SamplingProfiler(interval=SAMPLE_INTERVAL, async_mode="enabled")
+        else:
+            self.format = "prof"
+            self._profiler = cProfile.Profile()
+
+    def start(self):
+        if self.format == "html":
+            self._profiler.start()
+        else:
+            self._profiler.enable()
+
+    def stop(self):
+        if self.format == "html":
+            self._profiler.stop()
+        else:
+            self._profiler.disable()
+
+    def save(self, path: str):
+        if self.format == "html":
+            with open(path, "w") as f:
+                f.write(self._profiler.output_html())
+        else:
+            self._profiler.dump_stats(path)
+
+
+def _prune():
+    """Delete all but the newest PROFILE_MAX_FILES profiles"""
+    for entry in list_profiles()[PROFILE_MAX_FILES:]:
+        for filename in (entry["file"], f"{entry['id']}.json"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, filename))
+            except OSError:
+                pass
+
+
+def list_profiles() -> List[dict]:
+    """Captured profiles, newest first"""
+    if not PROFILE_DIR or not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for filename in os.listdir(PROFILE_DIR):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, filename)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # Being written or pruned right now
+    return sorted(profiles, key=lambda entry: entry.get("created", 0), reverse=True)
+
+
+def profile_path(profile_id: str) -> Optional[str]:
+    """Path of a captured profile's report, if it exists"""
+    if not PROFILE_DIR or not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    for ext in ("html", "prof"):
+        path = os.path.join(PROFILE_DIR, f"{profile_id}.{ext}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling the requests picked by header or sampling"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not PROFILE_DIR or scope["path"].startswith("/debug/"):
+            return await self.app(scope, receive, send)
+
+        token = dict(scope["headers"]).get(b"x-profile-token", b"").decode("latin-1")
+        by_header = token_is_valid(token)
+        wanted = by_header or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE)
+        # One profile at a time - a second profiler would take over the first one's thread
+        if not wanted or not _busy.acquire(blocking=False):
+            return await self.app(scope, receive, send)
+
+        profile_id = _new_profile_id()
+        capture = _Capture()
+        response = {"status": 500}
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            capture.start()
+            try:
+                await self.app(scope, receive, send_with_id)
+            finally:
+                capture.stop()
+            duration = time.perf_counter() - started
+
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            filename = f"{profile_id}.{capture.format}"
+            capture.save(os.path.join(PROFILE_DIR, filename))
+            with open(os.path.join(PROFILE_DIR, f"{profile_id}.json"), "w") as f:
+                json.dump({
+                    "id": profile_id,
+                    "created": time.time(),
+                    "file": filename,
+                    "format": capture.format,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "route": getattr(scope.get("route"), "path", None),
+                    "status": response["status"],
+                    "duration_ms": round(duration * 1000, 1),
+                    "request_id": app_logging.request_id_var.get(),
+                    "triggered_by": "header" if by_header else "sampling",
+                }, f)
+            _prune()
+        finally:
+            _busy.release()
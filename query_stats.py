@@ -0,0 +1,157 @@
+"""
+SQL query instrumentation: statement counts and database time per request, and
+slow query logging.
+
+SQLAlchemy cursor events time every statement. QueryStatsMiddleware gives each
+request its own tally; with SQL_DEBUG=1 it is returned in X-DB-Query-Count and
+X-DB-Time-Ms response headers, and per-route query counts always go to /metrics.
+Statements slower than SLOW_QUERY_MS are logged with their parameters.
+
+query_budget() is for tests: it fails if the code inside runs more statements than
+allowed, so an N+1 regression shows up as a failing check instead of a slow page.
+"""
+
+import contextvars
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import metrics
+import tracing
+
+SQL_DEBUG = os.getenv("SQL_DEBUG", "").lower() in ("1", "true", "yes")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+
+# Logged statements and parameters are cut to this many characters
+MAX_LOGGED_CHARS = 2000
+# Statements are cut shorter on trace spans, which are kept for every traced request
+TRACED_STATEMENT_CHARS = 200
+
+logger = logging.getLogger("query_stats")
+
+queries_per_request = metrics.Histogram(
+    "http_request_db_queries", "SQL statements run per request, by route template",
+    ("route",), buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100),
+)
+slow_queries = metrics.Counter("db_slow_queries_total", "Statements slower than SLOW_QUERY_MS")
+
+
+class QueryStats:
+    def __init__(self, keep_statements: bool = False):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements: Optional[List[str]] = [] if keep_statements else None
+
+    def add(self, statement: str, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        if self.statements is not None:
+            self.statements.append(statement)
+
+
+_request_stats = contextvars.ContextVar("query_stats", default=None)
+
+# Open query_budget() blocks. Process-wide rather than per context, since test
+# clients run the app on another thread.
+_budgets: List[QueryStats] = []
+
+
+def current() -> Optional[QueryStats]:
+    """Tally for the request being handled, if any"""
+    return _request_stats.get()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info["query_started"].pop()
+
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.add(statement, seconds)
+    for budget in _budgets:
+        budget.add(statement, seconds)
+    if tracing.ENABLED:
+        end_ns = time.time_ns()
+        tracing.record_span("db.query", end_ns - int(seconds * 1e9), end_ns, statement=statement[:TRACED_STATEMENT_CHARS])
+
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        slow_queries.inc()
+        # Token columns must not end up in the logs
+        logged_parameters = "[redacted]" if "token" in statement.lower() else repr(parameters)[:MAX_LOGGED_CHARS]
+        logger.warning("Slow query", extra={
+            "duration_ms": round(seconds * 1000, 1),
+            "statement": statement[:MAX_LOGGED_CHARS],
+            "parameters": logged_parameters,
+            "executemany": executemany,
+        })
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute; drop its start time
+    started = exception_context.connection.info.get("query_started") if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+def install(engine: Engine):
+    """Time every statement run on this engine (safe to call more than once)"""
+    if event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+class QueryStatsMiddleware:
+    """ASGI middleware keeping a per-request query tally (and returning it as headers with SQL_DEBUG)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = QueryStats()
+
+        async def send_with_stats(message):
+            if message["type"] == "http.response.start" and SQL_DEBUG:
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"x-db-query-count", str(stats.count).encode()),
+                    (b"x-db-time-ms", f"{stats.seconds * 1000:.1f}".encode()),
+                ]
+            await send(message)
+
+        token = _request_stats.set(stats)
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            _request_stats.reset(token)
+            queries_per_request.observe(stats.count, route=getattr(scope.get("route"), "path", "unmatched"))
+
+
+@contextmanager
+def query_budget(max_queries: int):
+    """Fail with AssertionError if more than `max_queries` statements run inside the block.
+
+        with query_budget(3):
+            client.get("/items/")
+    """
+    stats = QueryStats(keep_statements=True)
+    _budgets.append(stats)
+    try:
+        yield stats
+    finally:
+        _budgets.remove(stats)
+    if stats.count > max_queries:
+        listing = "\n".join(f"  {i}. {statement}" for i, statement in enumerate(stats.statements, 1))
+        raise AssertionError(f"Expected at most {max_queries} queries, ran {stats.count}:\n{listing}")
@@ -0,0 +1,228 @@
+"""
+Per-user and per-IP rate limits on the routes that call Strava, so one athlete
+refreshing over and over can't spend the app-wide Strava quota for everyone.
+
+Each user and each client IP has a token bucket: up to <BURST> requests at once,
+refilling at <PER_MINUTE> per minute. Only requests that are about to call
+Strava take a token. Answers served from the database don't.
+
+Responses from the limited routes carry RateLimit-Limit, RateLimit-Remaining and
+RateLimit-Reset headers for the tighter of the two buckets. When a bucket is
+empty, the times and metadata routes answer from the database (marked stale)
+where they can. Otherwise they return 429 with Retry-After.
+
+Backends (RATE_LIMIT_BACKEND):
+    memory    per process (the default); fine for a single instance
+    postgres  the rate_limit_buckets table, so limits hold across instances
+
+The client IP is the connection's address. Behind proxies, set TRUSTED_PROXY_COUNT
+to how many of them append to X-Forwarded-For (1 behind App Runner's load balancer).
+Entries added before them come from the client and are ignored.
+"""
+
+import math
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+from database import engine
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_USER_BURST = int(os.getenv("RATE_LIMIT_USER_BURST", "30"))
+RATE_LIMIT_USER_PER_MINUTE = float(os.getenv("RATE_LIMIT_USER_PER_MINUTE", "10"))
+RATE_LIMIT_IP_BURST = int(os.getenv("RATE_LIMIT_IP_BURST", "60"))
+RATE_LIMIT_IP_PER_MINUTE = float(os.getenv("RATE_LIMIT_IP_PER_MINUTE", "30"))
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "0"))
+
+# The in-memory backend drops full buckets once it holds this many
+MAX_MEMORY_BUCKETS = 10_000
+# How often the postgres backend deletes buckets that have refilled completely
+PRUNE_INTERVAL_SECONDS = 600
+
+rate_limited_requests = metrics.Counter(
+    "rate_limited_requests_total", "Strava-bound requests refused by the per-user or per-IP rate limit", ("scope",),
+)
+
+
+class Limit:
+    def __init__(self, scope: str, burst: int, per_minute: float):
+        self.scope = scope
+        self.burst = burst
+        self.rate = per_minute / 60  # tokens per second
+
+    @property
+    def enabled(self) -> bool:
+        return self.burst > 0 and self.rate > 0
+
+    @property
+    def refill_seconds(self) -> float:
+        """Time for an empty bucket to fill up again"""
+        return self.burst / self.rate if self.enabled else 0
+
+
+USER_LIMIT = Limit("user", RATE_LIMIT_USER_BURST, RATE_LIMIT_USER_PER_MINUTE)
+IP_LIMIT = Limit("ip", RATE_LIMIT_IP_BURST, RATE_LIMIT_IP_PER_MINUTE)
+
+
+class MemoryBackend:
+    """Buckets in a dict: (tokens, monotonic time of the last update)"""
+
+    blocking = False
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, limit: Limit) -> Tuple[bool, float]:
+        """Take a token if there is one. Returns (allowed, tokens left)."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (limit.burst, now))
+            tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            if key not in self._buckets and len(self._buckets) >= MAX_MEMORY_BUCKETS:
+                self._prune(now)
+            self._buckets[key] = (tokens, now)
+        return allowed, tokens
+
+    def give_back(self, key: str, limit: Limit):
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated = self._buckets[key]
+                self._buckets[key] = (min(limit.burst, tokens + 1), updated)
+
+    def _prune(self, now: float):
+        # A bucket idle long enough to have refilled is the same as no bucket
+        idle = max(USER_LIMIT.refill_seconds, IP_LIMIT.refill_seconds)
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if now - bucket[1] < idle}
+
+
+class PostgresBackend:
+    """Buckets in the rate_limit_buckets table, on the database's clock so instances agree"""
+
+    blocking = True  # Database round trips; check() runs them in the threadpool
+
+    # The WHERE on DO UPDATE leaves an empty bucket alone and returns no row
+    TAKE = text("""
+        INSERT INTO rate_limit_buckets AS bucket (key, tokens, updated_at)
+        VALUES (:key, :burst - 1, EXTRACT(EPOCH FROM now()))
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = LEAST(:burst, bucket.tokens + (EXTRACT(EPOCH FROM now()) - bucket.updated_at) * :rate) - 1,
+            updated_at = EXTRACT(EPOCH FROM now())
+        WHERE LEAST(:burst, bucket.tokens + (EXTRACT(EPOCH FROM now()) - bucket.updated_at) * :rate) >= 1
+        RETURNING tokens
+    """)
+    PEEK = text("""
+        SELECT LEAST(:burst, tokens + (EXTRACT(EPOCH FROM now()) - updated_at) * :rate)
+        FROM rate_limit_buckets WHERE key = :key
+    """)
+    GIVE_BACK = text("UPDATE rate_limit_buckets SET tokens = LEAST(:burst, tokens + 1) WHERE key = :key")
+    PRUNE = text("DELETE FROM rate_limit_buckets WHERE updated_at < EXTRACT(EPOCH FROM now()) - :idle")
+
+    def __init__(self, bind: Engine):
+        self.engine = bind
+        self._pruned_at = time.monotonic()
+
+    def take(self, key: str, limit: Limit) -> Tuple[bool, float]:
+        """Take a token if there is one. Returns (allowed, tokens left)."""
+        params = {"key": key, "burst": limit.burst, "rate": limit.rate}
+        # Its own short transaction: the request's session may have been open for a while
+        with self.engine.begin() as conn:
+            tokens = conn.execute(self.TAKE, params).scalar()
+            if tokens is not None:
+                allowed = True
+            else:
+                allowed = False
+                tokens = conn.execute(self.PEEK, params).scalar() or 0.0
+            if time.monotonic() - self._pruned_at > PRUNE_INTERVAL_SECONDS:
+                self._pruned_at = time.monotonic()
+                idle = max(USER_LIMIT.refill_seconds, IP_LIMIT.refill_seconds)
+                conn.execute(self.PRUNE, {"idle": idle})
+        return allowed, tokens
+
+    def give_back(self, key: str, limit: Limit):
+        with self.engine.begin() as conn:
+            conn.execute(self.GIVE_BACK, {"key": key, "burst": limit.burst})
+
+
+def _create_backend():
+    if RATE_LIMIT_BACKEND == "memory":
+        return MemoryBackend()
+    if RATE_LIMIT_BACKEND == "postgres":
+        if engine.dialect.name != "postgresql":
+            raise ValueError("RATE_LIMIT_BACKEND=postgres needs a PostgreSQL DATABASE_URL")
+        return PostgresBackend(engine)
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND {RATE_LIMIT_BACKEND!r} (expected memory or postgres)")
+
+
+backend = _create_backend()
+
+
+class Decision:
+    """Outcome of a rate limit check, with the headers to send back"""
+
+    def __init__(self, limited: bool, limit: Optional[Limit] = None, tokens: float = 0.0):
+        self.limited = limited
+        self.headers: Dict[str, str] = {}
+        if limit is not None:
+            self.headers = {
+                "RateLimit-Limit": str(limit.burst),
+                "RateLimit-Remaining": str(math.floor(tokens)),
+                "RateLimit-Reset": str(math.ceil((limit.burst - tokens) / limit.rate)),
+            }
+            if limited:
+                self.headers["Retry-After"] = str(max(1, math.ceil((1 - tokens) / limit.rate)))
+
+    def error(self) -> HTTPException:
+        return HTTPException(
+            status_code=429, detail="Too many Strava requests. Please wait a moment and try again.",
+            headers=self.headers,
+        )
+
+
+def client_ip(request: Request, trusted_proxies: int = TRUSTED_PROXY_COUNT) -> str:
+    """The address the request came from, read past the given number of trusted proxies"""
+    if trusted_proxies > 0:
+        # Each proxy appends the address it received the request from; the client can write anything before that
+        forwarded = [entry.strip() for entry in request.headers.get("x-forwarded-for", "").split(",") if entry.strip()]
+        if len(forwarded) >= trusted_proxies:
+            return forwarded[-trusted_proxies]
+    return request.client.host if request.client else "unknown"
+
+
+async def check(request: Request, user_id: int) -> Decision:
+    """Take a token from the user's and the client IP's buckets before calling Strava"""
+    if backend.blocking:
+        return await run_in_threadpool(check_blocking, request, user_id)
+    return check_blocking(request, user_id)
+
+
+def check_blocking(request: Request, user_id: int) -> Decision:
+    """check() for code already running off the event loop (sync endpoints, the threadpool)"""
+    tightest: Optional[Tuple[Limit, float]] = None
+    taken = []
+    for limit, key in ((USER_LIMIT, f"user:{user_id}"), (IP_LIMIT, f"ip:{client_ip(request)}")):
+        if not limit.enabled:
+            continue
+        allowed, tokens = backend.take(key, limit)
+        if not allowed:
+            # The request isn't going to Strava, so it shouldn't cost the other bucket anything
+            for taken_key, taken_limit in taken:
+                backend.give_back(taken_key, taken_limit)
+            rate_limited_requests.inc(scope=limit.scope)
+            return Decision(True, limit, tokens)
+        taken.append((key, limit))
+        if tightest is None or tokens < tightest[1]:
+            tightest = (limit, tokens)
+    if tightest is None:
+        return Decision(False)
+    return Decision(False, *tightest)
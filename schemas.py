@@ -79,6 +79,8 @@ class StravaSegmentTime(BaseModel):
     crown_time: Optional[str] = None  # KOM/QOM time
     crown_date: Optional[str] = None  # KOM/QOM date
     crown_pace: Optional[str] = None  # KOM/QOM pace
+    stale: bool = False  # Served from the database because Strava couldn't be reached
+    partial: bool = False  # The request deadline passed before every field was fetched
 
 
 class StravaSegmentMetadata(BaseModel):
@@ -94,4 +96,6 @@ class StravaSegmentMetadata(BaseModel):
     crown_time: Optional[str] = None  # KOM/QOM time
     crown_date: Optional[str] = None  # KOM/QOM date
     crown_pace: Optional[str] = None  # KOM/QOM pace
+    stale: bool = False  # Served from the database because Strava couldn't be reached
+    partial: bool = False  # The request deadline passed before every field was fetched
 
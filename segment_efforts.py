@@ -0,0 +1,216 @@
+"""
+Local store of each athlete's Strava segment efforts.
+
+Efforts are upserted in bulk as they are fetched (all_efforts syncs, webhook
+activities), and personal bests, attempt counts and last attempt dates are
+derived from them with SQL instead of from a throwaway list on every request.
+"""
+
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from sqlalchemy import delete, func, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+import models
+
+# Rows per multi-row INSERT ... ON CONFLICT statement
+UPSERT_BATCH_SIZE = 1000
+
+# Per-athlete fields kept in user_segment_stats (same names as on items)
+USER_STATS_FIELDS = (
+    "personal_best_time",
+    "personal_best_pace",
+    "personal_best_grade_adjusted_pace",
+    "personal_attempts",
+    "last_attempt_date",
+    "personal_best_activity_id",
+)
+
+
+class EffortStats(NamedTuple):
+    attempts: int
+    best_elapsed_time: Optional[int]
+    best_activity_id: Optional[int]
+    last_attempt_date: Optional[str]  # MM/DD/YYYY
+    synced_through: Optional[datetime]  # start_date_local of the newest effort stored
+
+
+def parse_strava_time(value: Optional[str]) -> Optional[datetime]:
+    """Strava timestamp as a naive datetime (start_date is UTC, start_date_local is local time marked with a Z)"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+def effort_local_time(effort: dict) -> Optional[datetime]:
+    """An effort's start_date_local as a naive datetime"""
+    return parse_strava_time(effort.get("start_date_local") or effort.get("start_date"))
+
+
+def effort_rows(user_id: int, efforts: Iterable[dict], segment_id: Optional[int] = None) -> List[dict]:
+    """Turn Strava effort objects into segment_efforts rows, skipping incomplete ones"""
+    rows = []
+    for effort in efforts:
+        effort_segment_id = segment_id or (effort.get("segment") or {}).get("id")
+        start_date = parse_strava_time(effort.get("start_date"))
+        if not effort.get("id") or not effort_segment_id or not start_date or not effort.get("elapsed_time"):
+            continue
+        rows.append({
+            "id": effort["id"],
+            "user_id": user_id,
+            "segment_id": effort_segment_id,
+            "activity_id": (effort.get("activity") or {}).get("id"),
+            "start_date": start_date,
+            "start_date_local": effort_local_time(effort),
+            "elapsed_time": effort["elapsed_time"],
+        })
+    return rows
+
+
+def _dialect_insert(db: Session, model):
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    return dialect.insert(model)
+
+
+def upsert_efforts(db: Session, user_id: int, efforts: Iterable[dict], segment_id: Optional[int] = None) -> int:
+    """Insert or update efforts in one multi-row statement. Doesn't commit."""
+    rows = effort_rows(user_id, efforts, segment_id)
+
+    # Chunked to stay under the bind parameter limit
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        statement = _dialect_insert(db, models.SegmentEffort).values(rows[start:start + UPSERT_BATCH_SIZE])
+        statement = statement.on_conflict_do_update(
+            index_elements=[models.SegmentEffort.id],
+            set_={
+                "activity_id": statement.excluded.activity_id,
+                "start_date": statement.excluded.start_date,
+                "start_date_local": statement.excluded.start_date_local,
+                "elapsed_time": statement.excluded.elapsed_time,
+            },
+        )
+        db.execute(statement)
+    return len(rows)
+
+
+def prune_efforts(db: Session, user_id: int, segment_id: int, keep_ids: Iterable[int]) -> int:
+    """After a full sync, remove stored efforts Strava no longer has. Doesn't commit."""
+    return db.execute(
+        delete(models.SegmentEffort)
+        .where(models.SegmentEffort.user_id == user_id)
+        .where(models.SegmentEffort.segment_id == segment_id)
+        .where(models.SegmentEffort.id.notin_(list(keep_ids)))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def delete_activity_efforts(db: Session, user_id: int, activity_id: int) -> List[int]:
+    """Remove the efforts of a deleted activity. Returns the affected segment IDs. Doesn't commit."""
+    segment_ids = [row[0] for row in db.execute(
+        select(models.SegmentEffort.segment_id.distinct())
+        .where(models.SegmentEffort.user_id == user_id)
+        .where(models.SegmentEffort.activity_id == activity_id)
+    )]
+    if segment_ids:
+        db.execute(
+            delete(models.SegmentEffort)
+            .where(models.SegmentEffort.user_id == user_id)
+            .where(models.SegmentEffort.activity_id == activity_id)
+            .execution_options(synchronize_session=False)
+        )
+    return segment_ids
+
+
+def synced_segment_ids(db: Session, user_id: int, segment_ids: Iterable[int]) -> set:
+    """Segments that already have stored efforts for this user"""
+    return {row[0] for row in db.execute(
+        select(models.SegmentEffort.segment_id.distinct())
+        .where(models.SegmentEffort.user_id == user_id)
+        .where(models.SegmentEffort.segment_id.in_(list(segment_ids)))
+    )}
+
+
+def synced_through(db: Session, user_id: int, segment_id: int) -> Optional[datetime]:
+    """High-water mark for incremental syncs: the newest stored effort's local start time"""
+    return db.execute(
+        select(func.max(models.SegmentEffort.start_date_local))
+        .where(models.SegmentEffort.user_id == user_id)
+        .where(models.SegmentEffort.segment_id == segment_id)
+    ).scalar()
+
+
+def effort_stats(db: Session, user_id: int, segment_ids: Iterable[int]) -> Dict[int, EffortStats]:
+    """PB, attempts and last attempt per segment for one user, in one query.
+
+    Each segment's efforts are ranked by elapsed time with a window function; the
+    top-ranked row carries the PB plus the per-segment count and latest dates.
+    """
+    effort = models.SegmentEffort
+    per_segment = {"partition_by": effort.segment_id}
+    ranked = (
+        select(
+            effort.segment_id,
+            effort.elapsed_time,
+            effort.activity_id,
+            func.row_number().over(order_by=(effort.elapsed_time, effort.start_date), **per_segment).label("rank"),
+            func.count().over(**per_segment).label("attempts"),
+            func.max(effort.start_date).over(**per_segment).label("last_attempt"),
+            func.max(effort.start_date_local).over(**per_segment).label("synced_through"),
+        )
+        .where(effort.user_id == user_id)
+        .where(effort.segment_id.in_(list(segment_ids)))
+        .subquery()
+    )
+
+    stats = {}
+    for row in db.execute(select(ranked).where(ranked.c.rank == 1)):
+        stats[row.segment_id] = EffortStats(
+            attempts=row.attempts,
+            best_elapsed_time=row.elapsed_time,
+            best_activity_id=row.activity_id,
+            last_attempt_date=row.last_attempt.strftime("%m/%d/%Y") if row.last_attempt else None,
+            synced_through=row.synced_through,
+        )
+    return stats
+
+
+def upsert_user_stats(db: Session, user_id: int, stats_by_segment: Dict[int, dict], now: Optional[datetime] = None,
+                      only_changed: bool = False, refreshed_before: Optional[datetime] = None):
+    """Save per-athlete stats ({segment_id: {field: value}}) in one statement. Doesn't commit.
+
+    With only_changed, existing rows are left alone (refreshed_at included) unless a value
+    differs, or their refreshed_at is missing or older than refreshed_before.
+    """
+    if not stats_by_segment:
+        return
+    now = now or datetime.utcnow()
+    rows = [
+        {
+            "user_id": user_id,
+            "segment_id": segment_id,
+            **{field: fields.get(field) for field in USER_STATS_FIELDS},
+            "personal_attempts": fields.get("personal_attempts") or 0,
+            "refreshed_at": now,
+        }
+        for segment_id, fields in stats_by_segment.items()
+    ]
+    statement = _dialect_insert(db, models.UserSegmentStats).values(rows)
+    changed = None
+    if only_changed:
+        conditions = [
+            getattr(models.UserSegmentStats, field).is_distinct_from(statement.excluded[field])
+            for field in USER_STATS_FIELDS
+        ]
+        if refreshed_before is not None:
+            conditions += [models.UserSegmentStats.refreshed_at.is_(None),
+                           models.UserSegmentStats.refreshed_at < refreshed_before]
+        changed = or_(*conditions)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[models.UserSegmentStats.user_id, models.UserSegmentStats.segment_id],
+        set_={field: statement.excluded[field] for field in (*USER_STATS_FIELDS, "refreshed_at")},
+        where=changed,
+    ))
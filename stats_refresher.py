@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+"""
+Background refresher that keeps each segment's Strava stats current in the
+database - crown and map data on items, each connected athlete's personal best
+and attempts in user_segment_stats - so the API can answer times requests from
+Postgres instead of waiting on Strava.
+
+Segments are refreshed in order of user interest (claimed with dibs but not
+completed, or recently looked at) and then staleness. It can run:
+- in-process: set STATS_REFRESH_INTERVAL_SECONDS and the API starts it on startup
+- as a CLI:   python stats_refresher.py [--once] [--limit N] [--interval SECONDS]
+- on Lambda:  schedule lambda_handler.refresh_handler with EventBridge
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import httpx
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from sqlalchemy import case, or_, and_, text, update
+from sqlalchemy.orm import Session
+
+import app_logging
+import models
+import schemas
+from database import SessionLocal, engine
+from segment_efforts import USER_STATS_FIELDS, EffortStats, effort_stats, upsert_user_stats
+from strava_client import (
+    StravaUnavailable,
+    fetch_segment_times_from_strava,
+    format_duration,
+    format_personal_best,
+    get_valid_access_token_async,
+    strava_breaker,
+    token_needs_refresh,
+)
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger("stats_refresher")
+
+# items stores distance in miles and elevation in feet
+METERS_PER_MILE = 1609.34
+FEET_PER_METER = 3.28084
+
+# Segments looked at per run
+REFRESH_BATCH_SIZE = int(os.getenv("STATS_REFRESH_BATCH_SIZE", "20"))
+MAX_CONCURRENT_REFRESHES = 4
+
+# Refreshing one athlete's stats for a segment costs up to this many Strava calls.
+# Runs stop scheduling refreshes at MAX_STRAVA_CALLS_PER_RUN, which should stay well
+# inside the 15-minute quota to leave room for user requests.
+CALLS_PER_REFRESH = 4
+MAX_STRAVA_CALLS_PER_RUN = int(os.getenv("STATS_REFRESH_MAX_STRAVA_CALLS", "80"))
+
+# Arbitrary constant used with pg_try_advisory_lock so only one worker or instance refreshes at a time
+REFRESH_LOCK_ID = 72_616_002
+
+# How old stats may get before a segment is due again
+INTERESTED_MAX_AGE = timedelta(hours=1)
+DEFAULT_MAX_AGE = timedelta(hours=6)
+COMPLETED_MAX_AGE = timedelta(hours=24)
+
+# A segment counts as "interesting" if someone asked for its times within this window
+RECENT_REQUEST_WINDOW = timedelta(days=1)
+
+# Don't record a request for a segment more often than this
+REQUEST_MARK_INTERVAL = timedelta(minutes=10)
+
+# Shared (not per-athlete) Strava data kept on items
+SHARED_ITEM_FIELDS = ("crown_holder", "crown_time", "crown_date", "crown_pace",
+                      "polyline", "start_latitude", "start_longitude")
+
+# A write-through of unchanged stats still bumps the athlete's refreshed_at, at most this often
+WRITE_THROUGH_INTERVAL = timedelta(minutes=10)
+
+# Times requests are answered from the database when the stats are at least this fresh
+STATS_MAX_AGE = timedelta(seconds=int(os.getenv("STATS_MAX_AGE_SECONDS", "3600")))
+
+
+def segment_time_from_item(db_item: models.Item,
+                           user_stats: Optional[models.UserSegmentStats] = None) -> schemas.StravaSegmentTime:
+    """Build a times response from the stats stored on an item.
+
+    Pass the requesting athlete's user_segment_stats row to answer with their own
+    PB and attempts instead of the values entered on the item.
+    """
+    segment_time = schemas.StravaSegmentTime(
+        segment_id=db_item.strava_segment_id,
+        segment_name=db_item.segment_name or "",
+        personal_best_time=db_item.personal_best_time,
+        personal_best_pace=db_item.personal_best_pace,
+        personal_best_grade_adjusted_pace=db_item.personal_best_grade_adjusted_pace,
+        personal_attempts=db_item.personal_attempts if db_item.personal_attempts else None,
+        last_attempt_date=db_item.last_attempt_date,
+        personal_best_activity_id=db_item.personal_best_activity_id,
+        polyline=db_item.polyline,
+        start_latitude=db_item.start_latitude,
+        start_longitude=db_item.start_longitude,
+        crown_holder=db_item.crown_holder,
+        crown_time=db_item.crown_time,
+        crown_date=db_item.crown_date,
+        crown_pace=db_item.crown_pace,
+    )
+    if user_stats:
+        for field in USER_STATS_FIELDS:
+            setattr(segment_time, field, getattr(user_stats, field))
+        segment_time.personal_attempts = user_stats.personal_attempts or None
+    return segment_time
+
+
+def effort_stats_fields(db_item: models.Item, stats: EffortStats) -> dict:
+    """user_segment_stats fields for an item's segment, worked out from segment_efforts stats"""
+    personal_best_time, personal_best_pace, personal_best_grade_adjusted_pace = format_personal_best(
+        stats.best_elapsed_time,
+        (db_item.distance or 0) * METERS_PER_MILE,
+        (db_item.elevation_gain or 0) / FEET_PER_METER,
+    )
+    if personal_best_time is None and stats.best_elapsed_time:
+        # No distance stored, so no pace - the time is still worth showing
+        personal_best_time = format_duration(stats.best_elapsed_time)
+    return {
+        "personal_best_time": personal_best_time,
+        "personal_best_pace": personal_best_pace,
+        "personal_best_grade_adjusted_pace": personal_best_grade_adjusted_pace,
+        "personal_attempts": stats.attempts or None,
+        "last_attempt_date": stats.last_attempt_date,
+        "personal_best_activity_id": stats.best_activity_id,
+    }
+
+
+def recompute_user_stats(db: Session, user_id: int, segment_ids: list) -> int:
+    """Rebuild an athlete's user_segment_stats for tracked segments from segment_efforts.
+
+    Returns the number of items updated. Doesn't commit.
+    """
+    if not segment_ids:
+        return 0
+    stats = effort_stats(db, user_id, segment_ids)
+    items = db.query(models.Item).filter(models.Item.strava_segment_id.in_(segment_ids)).all()
+    upsert_user_stats(db, user_id, {
+        db_item.strava_segment_id: effort_stats_fields(
+            db_item, stats.get(db_item.strava_segment_id) or EffortStats(0, None, None, None, None)
+        )
+        for db_item in items
+    })
+    return len(items)
+
+
+def stats_are_fresh(user_stats: Optional[models.UserSegmentStats], now: Optional[datetime] = None) -> bool:
+    """Whether an athlete's stored stats for a segment are recent enough to answer from.
+
+    Freshness is per athlete: another athlete's refresh of the same segment says
+    nothing about this athlete's row.
+    """
+    if not user_stats or not user_stats.refreshed_at:
+        return False
+    return (now or datetime.utcnow()) - user_stats.refreshed_at < STATS_MAX_AGE
+
+
+def mark_user_stats_stale(db: Session, user_id: int, segment_ids: list):
+    """Make an athlete's stored stats for these segments count as stale until refreshed. Doesn't commit."""
+    if segment_ids:
+        db.query(models.UserSegmentStats).filter(
+            models.UserSegmentStats.user_id == user_id, models.UserSegmentStats.segment_id.in_(segment_ids)
+        ).update({models.UserSegmentStats.refreshed_at: None}, synchronize_session=False)
+
+
+def mark_requested(db: Session, db_item: models.Item, now: Optional[datetime] = None):
+    """Record that a user looked at this segment (throttled to one write per interval)"""
+    now = now or datetime.utcnow()
+    if db_item.stats_requested_at and now - db_item.stats_requested_at < REQUEST_MARK_INTERVAL:
+        return
+    db_item.stats_requested_at = now
+    db.commit()
+
+
+def shared_item_fields(data) -> dict:
+    """Crown and map fields worth saving on an item from a times or metadata response.
+
+    Crown info and map data are often missing from Strava (the leaderboard API is
+    deprecated) - missing values are left out so hand-entered ones aren't wiped.
+    """
+    values = {}
+    for field in SHARED_ITEM_FIELDS:
+        value = getattr(data, field)
+        if value is not None:
+            values[field] = value
+    return values
+
+
+def apply_segment_times(db_item: models.Item, times: schemas.StravaSegmentTime):
+    """Copy freshly fetched shared Strava data (crown, map) onto an item.
+
+    Personal stats belong to the athlete whose token fetched them and go to
+    user_segment_stats instead (see times_stats_fields), along with their freshness.
+    """
+    for field, value in shared_item_fields(times).items():
+        setattr(db_item, field, value)
+
+
+def times_stats_fields(times: schemas.StravaSegmentTime) -> dict:
+    """user_segment_stats fields from a times response"""
+    return {field: getattr(times, field) for field in USER_STATS_FIELDS}
+
+
+def write_through(segment_id: int, item_fields: dict, user_id: Optional[int] = None,
+                  user_stats: Optional[dict] = None):
+    """Save what a request just fetched from Strava, after the response has gone out.
+
+    The item is updated in one UPDATE that only matches if a value changed. The
+    athlete's stats are upserted where they differ, or where their refreshed_at
+    is due a bump. Runs in its own session as a background task.
+    """
+    db = SessionLocal()
+    now = datetime.utcnow()
+    item = models.Item
+
+    try:
+        changed = [getattr(item, field).is_distinct_from(value) for field, value in item_fields.items()]
+        if changed:
+            db.execute(
+                update(item)
+                .where(item.strava_segment_id == segment_id)
+                .where(or_(*changed))
+                .values(**item_fields)
+                .execution_options(synchronize_session=False)
+            )
+
+        if user_id is not None and user_stats is not None:
+            upsert_user_stats(db, user_id, {segment_id: user_stats}, now, only_changed=True,
+                              refreshed_before=now - WRITE_THROUGH_INTERVAL)
+
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning("Error saving fetched Strava data", extra={"segment_id": segment_id, "error": str(e)})
+    finally:
+        db.close()
+
+
+def due_items_query(db: Session, now: datetime):
+    """Items whose stats are due for a refresh, most wanted first"""
+    item = models.Item
+    interested = or_(
+        and_(item.dibs.isnot(None), item.completed.is_(False)),
+        item.stats_requested_at >= now - RECENT_REQUEST_WINDOW,
+    )
+    refresh_before = case(
+        (interested, now - INTERESTED_MAX_AGE),
+        (item.completed.is_(True), now - COMPLETED_MAX_AGE),
+        else_=now - DEFAULT_MAX_AGE,
+    )
+    return (
+        db.query(item)
+        .filter(item.strava_segment_id.isnot(None))
+        .filter(or_(item.stats_refreshed_at.is_(None), item.stats_refreshed_at < refresh_before))
+        .order_by(
+            case((interested, 0), else_=1),
+            item.stats_refreshed_at.asc().nulls_first(),
+        )
+    )
+
+
+def _connected_athletes(db: Session) -> List[models.User]:
+    """Every user with a Strava token"""
+    return db.query(models.User).filter(models.User.strava_access_token.isnot(None)).order_by(models.User.id).all()
+
+
+async def _access_tokens(db: Session, users: List[models.User]) -> Dict[int, str]:
+    """A usable Strava token for each of these users that has one, by user id"""
+    tokens = {}
+    for user in users:
+        access_token = await get_valid_access_token_async(user, db)
+        if access_token:
+            tokens[user.id] = access_token
+        else:
+            logger.warning("Stats refresh: could not get a valid Strava token", extra={"strava_id": user.strava_id})
+    return tokens
+
+
+async def refresh_stale_items(limit: int = REFRESH_BATCH_SIZE) -> int:
+    """Refresh up to `limit` due segments for the connected athletes whose stats are stale.
+    Returns how many segments are now up to date for everyone.
+
+    Only one worker or instance refreshes at a time (a Postgres advisory lock), and a run
+    makes at most about MAX_STRAVA_CALLS_PER_RUN Strava calls, whatever the number of athletes.
+    """
+    if not strava_breaker.allows_requests():
+        logger.info("Stats refresh skipped: Strava circuit is open")
+        return 0
+
+    with engine.connect() as lock_conn:
+        if engine.dialect.name == "postgresql":
+            locked = lock_conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": REFRESH_LOCK_ID}).scalar()
+            lock_conn.commit()
+            if not locked:
+                logger.info("Stats refresh skipped: another worker or instance is refreshing")
+                return 0
+            try:
+                return await _refresh_due_items(limit)
+            finally:
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": REFRESH_LOCK_ID})
+                lock_conn.commit()
+        return await _refresh_due_items(limit)
+
+
+async def _refresh_due_items(limit: int) -> int:
+    db = SessionLocal()
+
+    try:
+        athletes = _connected_athletes(db)
+        if not athletes:
+            logger.info("Stats refresh skipped: no Strava user connected")
+            return 0
+
+        now = datetime.utcnow()
+        items = due_items_query(db, now).limit(limit).all()
+        if not items:
+            return 0
+
+        stored = {
+            (row.user_id, row.segment_id): row
+            for row in db.query(models.UserSegmentStats).filter(
+                models.UserSegmentStats.segment_id.in_([db_item.strava_segment_id for db_item in items])
+            )
+        }
+
+        # One job per athlete whose stats for the segment are stale, stalest first, until the call budget
+        # is spent. An athlete's token refresh is one more call, paid by their first job.
+        calls = 0
+        jobs = []  # (item, Strava segment id, athlete)
+        scheduled = {}  # user id -> athlete with at least one job
+        needed = {}  # item id -> athletes that need a refresh
+        for position, db_item in enumerate(items):
+            rows = {user.id: stored.get((user.id, db_item.strava_segment_id)) for user in athletes}
+            stale = [user for user in athletes if not stats_are_fresh(rows[user.id], now)]
+            stale.sort(key=lambda user: (rows[user.id] and rows[user.id].refreshed_at) or datetime.min)
+            needed[db_item.id] = len(stale)
+            budget_spent = False
+            for user in stale:
+                cost = CALLS_PER_REFRESH
+                if user.id not in scheduled and token_needs_refresh(user):
+                    cost += 1
+                if jobs and calls + cost > MAX_STRAVA_CALLS_PER_RUN:
+                    budget_spent = True
+                    break
+                calls += cost
+                scheduled[user.id] = user
+                jobs.append((db_item, db_item.strava_segment_id, user))
+            if budget_spent:
+                items = items[:position + 1]
+                break
+
+        # Only athletes with a job spend a token refresh; one that fails leaves its segments due
+        tokens = await _access_tokens(db, list(scheduled.values()))
+        jobs = [(db_item, segment_id, user) for db_item, segment_id, user in jobs if user.id in tokens]
+
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REFRESHES)
+
+        async with httpx.AsyncClient() as client:
+            async def refresh(segment_id: int, user_id: int):
+                async with semaphore:
+                    # A session per job: syncing efforts commits and rolls back between awaits
+                    job_db = SessionLocal()
+                    try:
+                        return await fetch_segment_times_from_strava(segment_id, tokens[user_id], client, job_db, user_id)
+                    finally:
+                        job_db.close()
+
+            results = await asyncio.gather(
+                *(refresh(segment_id, user.id) for _, segment_id, user in jobs), return_exceptions=True,
+            )
+
+        succeeded = {db_item.id: 0 for db_item in items}
+        gone = set()
+        rate_limited = False
+        user_stats = {}
+        for (db_item, segment_id, user), result in zip(jobs, results):
+            if isinstance(result, HTTPException):
+                if result.status_code == 429:
+                    rate_limited = True
+                elif result.status_code == 404:
+                    # Gone from Strava - don't keep retrying it every run
+                    gone.add(db_item.id)
+                else:
+                    logger.warning("Stats refresh failed for a segment", extra={
+                        "segment_id": segment_id, "status_code": result.status_code, "detail": result.detail,
+                    })
+                continue
+            if isinstance(result, StravaUnavailable):
+                rate_limited = True
+                continue
+            if isinstance(result, Exception):
+                logger.warning("Stats refresh failed for a segment", extra={
+                    "segment_id": segment_id, "error": str(result),
+                })
+                continue
+
+            apply_segment_times(db_item, result)
+            user_stats.setdefault(user.id, {})[segment_id] = times_stats_fields(result)
+            succeeded[db_item.id] += 1
+
+        # A segment is done only once every athlete who needed it was refreshed; the rest stay due
+        refreshed = 0
+        for db_item in items:
+            if db_item.id in gone or succeeded[db_item.id] == needed[db_item.id]:
+                db_item.stats_refreshed_at = now
+                refreshed += 1
+
+        for user_id, stats_by_segment in user_stats.items():
+            upsert_user_stats(db, user_id, stats_by_segment, now)
+        db.commit()
+        if rate_limited:
+            logger.info("Stats refresh hit the Strava rate limit or an open circuit, remaining segments wait for the next run")
+        logger.info("Refreshed segment stats", extra={
+            "refreshed": refreshed, "due": len(items), "jobs": len(jobs), "athletes": len(scheduled),
+            "strava_call_budget": calls,
+        })
+        return refreshed
+    finally:
+        db.close()
+
+
+async def run_forever(interval_seconds: int, limit: int = REFRESH_BATCH_SIZE):
+    """Refresh due segments every `interval_seconds` until cancelled"""
+    while True:
+        try:
+            await refresh_stale_items(limit)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Error refreshing segment stats")
+        await asyncio.sleep(interval_seconds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh segment stats from Strava")
+    parser.add_argument("--once", action="store_true", help="Run a single refresh and exit")
+    parser.add_argument("--limit", type=int, default=REFRESH_BATCH_SIZE, help="Segments per run")
+    parser.add_argument("--interval", type=int, default=900, help="Seconds between runs")
+    args = parser.parse_args()
+    app_logging.configure_logging(fmt="text")
+
+    if args.once:
+        asyncio.run(refresh_stale_items(args.limit))
+    else:
+        asyncio.run(run_forever(args.interval, args.limit))
@@ -0,0 +1,930 @@
+"""
+Shared helpers for calling the Strava API from the app, the ETL and backfill scripts
+and the background stats refresher.
+"""
+
+import asyncio
+import logging
+import math
+import os
+import random
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import httpx
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+import metrics
+import models
+import schemas
+import segment_efforts
+import tracing
+from app_logging import DEBUG_SAMPLE_RATE
+from segment_efforts import EffortStats, effort_local_time
+
+logger = logging.getLogger("strava_client")
+
+# Point this at a fake Strava (e.g. mock_strava.py) for local development and load tests
+STRAVA_BASE_URL = os.getenv("STRAVA_BASE_URL", "https://www.strava.com").rstrip("/")
+STRAVA_API_URL = f"{STRAVA_BASE_URL}/api/v3"
+STRAVA_TOKEN_URL = f"{STRAVA_BASE_URL}/oauth/token"
+STRAVA_AUTHORIZE_URL = f"{STRAVA_BASE_URL}/oauth/authorize"
+
+# all_efforts paging: Strava's maximum page size, and a cap of 10,000 efforts per segment
+EFFORTS_PER_PAGE = 200
+MAX_EFFORT_PAGES = 50
+MAX_CONCURRENT_EFFORT_PAGES = 4
+
+# Strava's short-term rate limit resets every 15 minutes on the clock (:00, :15, :30, :45)
+RATE_LIMIT_WINDOW_SECONDS = 15 * 60
+
+# Circuit breaker: consecutive failures (429, 5xx, timeouts) before Strava calls stop,
+# and how long they stay stopped before a probe request is let through
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("STRAVA_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("STRAVA_BREAKER_COOLDOWN_SECONDS", "30"))
+
+# Retries for idempotent calls: attempts in total, and the exponential backoff base and cap
+# (seconds). A Retry-After longer than the cap is not waited out - the failure is returned.
+RETRY_ATTEMPTS = int(os.getenv("STRAVA_RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = float(os.getenv("STRAVA_RETRY_MAX_DELAY_SECONDS", "8"))
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# httpx's timeout when a call doesn't set one
+DEFAULT_TIMEOUT_SECONDS = 5.0
+
+
+class StravaUnavailable(RuntimeError):
+    """Strava is failing and the circuit breaker is open - answer from the database instead"""
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """The caller's deadline passed before Strava answered"""
+
+
+class CircuitBreaker:
+    """Stops calling Strava while it is failing, so requests don't each wait out a timeout.
+
+    closed:    calls go through; `failure_threshold` failures in a row open the circuit
+    open:      calls raise StravaUnavailable straight away for `cooldown` seconds
+    half_open: one probe call goes through; success closes the circuit, failure reopens it
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, cooldown: float = BREAKER_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at = None  # time.monotonic() when the circuit last opened
+        self.times_opened = 0
+        self.last_failure = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allows_requests(self) -> bool:
+        state = self.state
+        return state == self.CLOSED or (state == self.HALF_OPEN and not self._probe_in_flight)
+
+    def before_call(self) -> bool:
+        """Raise StravaUnavailable unless a call may go out. Returns True for the half-open probe."""
+        state = self.state
+        if state == self.CLOSED:
+            return False
+        if state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        raise StravaUnavailable("Strava is unavailable (circuit open), try again shortly")
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Strava is responding again, circuit closed")
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self, reason: str):
+        self.consecutive_failures += 1
+        self.last_failure = reason
+        was_probe = self._probe_in_flight
+        self._probe_in_flight = False
+        if was_probe or self.consecutive_failures >= self.failure_threshold:
+            if self.opened_at is None or was_probe:
+                logger.warning("Strava circuit opened", extra={
+                    "consecutive_failures": self.consecutive_failures, "reason": reason,
+                })
+                self.times_opened += 1
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        """The probe ended without telling us anything (e.g. cancelled) - let another one through"""
+        self._probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        """State for monitoring"""
+        state = self.state
+        return {
+            "state": state,
+            "consecutive_failures": self.consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "cooldown_seconds": self.cooldown,
+            "retry_in_seconds": round(max(self.cooldown - (time.monotonic() - self.opened_at), 0), 1)
+            if state == self.OPEN else 0,
+            "times_opened": self.times_opened,
+            "last_failure": self.last_failure,
+        }
+
+
+# Shared by every Strava call in the process
+strava_breaker = CircuitBreaker()
+
+
+def _endpoint(url: str) -> str:
+    """URL path with IDs replaced, for metric labels"""
+    return re.sub(r"/\d+", "/{id}", httpx.URL(url).path)
+
+
+async def _timed_request(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+    """client.request, recording its latency, outcome and the rate limit it reports"""
+    started = time.perf_counter()
+    status = "error"
+    endpoint = _endpoint(url)
+    with tracing.span(f"strava {method} {endpoint}", kind="client") as span:
+        try:
+            response = await client.request(method, url, **kwargs)
+            status = response.status_code
+        except BaseException as e:
+            status = type(e).__name__
+            raise
+        finally:
+            metrics.strava_request_duration.observe(
+                time.perf_counter() - started, method=method, endpoint=endpoint, status=status
+            )
+            if span is not None:
+                span.attributes["http.status_code"] = status
+
+    limit = _parse_rate_limit_header(response.headers.get("X-RateLimit-Limit"))
+    usage = _parse_rate_limit_header(response.headers.get("X-RateLimit-Usage"))
+    if limit and usage:
+        metrics.strava_rate_limit_remaining.set(limit[0] - usage[0], window="15min")
+        metrics.strava_rate_limit_remaining.set(limit[1] - usage[1], window="daily")
+    return response
+
+
+async def _strava_attempt(client: httpx.AsyncClient, method: str, url: str, deadline_bound: bool = False,
+                          **kwargs) -> httpx.Response:
+    is_probe = strava_breaker.before_call()
+    try:
+        response = await _timed_request(client, method, url, **kwargs)
+    except httpx.TimeoutException as e:
+        if deadline_bound:
+            # Our deadline cut the timeout short - that says nothing about Strava's health
+            if is_probe:
+                strava_breaker.release_probe()
+            raise DeadlineExceeded(f"Deadline reached calling {url}") from e
+        strava_breaker.record_failure(f"{type(e).__name__} calling {url}")
+        raise
+    except httpx.TransportError as e:
+        strava_breaker.record_failure(f"{type(e).__name__} calling {url}")
+        raise
+    except BaseException:
+        if is_probe:
+            strava_breaker.release_probe()
+        raise
+
+    if response.status_code == 429 or response.status_code >= 500:
+        strava_breaker.record_failure(f"{response.status_code} from {url}")
+    else:
+        strava_breaker.record_success()
+    return response
+
+
+def retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    """The Retry-After header in seconds (it may be a number or an HTTP date)"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(response: Optional[httpx.Response], attempt: int) -> float:
+    """Wait before retry number `attempt`: what Strava asks for, else capped exponential backoff with full jitter"""
+    if response is not None:
+        retry_after = retry_after_seconds(response)
+        if retry_after is not None:
+            return retry_after
+        if response.status_code == 429:
+            # Short-term quota used up: nothing succeeds before the next 15-minute window
+            limit = _parse_rate_limit_header(response.headers.get("X-RateLimit-Limit"))
+            usage = _parse_rate_limit_header(response.headers.get("X-RateLimit-Usage"))
+            if limit and usage and usage[0] >= limit[0]:
+                return RATE_LIMIT_WINDOW_SECONDS - (time.time() % RATE_LIMIT_WINDOW_SECONDS) + 1
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+async def strava_request(client: httpx.AsyncClient, method: str, url: str, retry: bool = False,
+                         deadline: Optional[float] = None, **kwargs) -> httpx.Response:
+    """Call Strava through the circuit breaker.
+
+    429s, 5xx responses and timeouts/network errors count as failures; anything
+    else (including 401/404) means Strava is up. Raises StravaUnavailable while
+    the circuit is open.
+
+    With retry (only for idempotent calls), 429/5xx responses and network errors
+    are retried up to RETRY_ATTEMPTS times with backoff. No retry is started that
+    couldn't finish its wait before `deadline` (a time.monotonic() value); the
+    last response is returned, or the last error raised, instead. Each attempt's
+    timeout is cut to the time left, and DeadlineExceeded is raised once it runs out.
+    """
+    attempts = RETRY_ATTEMPTS if retry else 1
+    for attempt in range(1, attempts + 1):
+        attempt_kwargs, deadline_bound = kwargs, False
+        if deadline is not None:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise DeadlineExceeded(f"Deadline reached before calling {url}")
+            if left < kwargs.get("timeout", DEFAULT_TIMEOUT_SECONDS):
+                attempt_kwargs, deadline_bound = {**kwargs, "timeout": left}, True
+
+        response, error = None, None
+        try:
+            response = await _strava_attempt(client, method, url, deadline_bound, **attempt_kwargs)
+        except httpx.TransportError as e:
+            if attempt == attempts:
+                raise
+            error = e
+        if response is not None and (response.status_code not in RETRY_STATUS_CODES or attempt == attempts):
+            return response
+
+        delay = retry_delay(response, attempt)
+        too_long = delay > RETRY_MAX_DELAY or (deadline is not None and time.monotonic() + delay >= deadline)
+        if too_long:
+            if response is not None:
+                return response
+            raise error
+        logger.info("Retrying Strava request", extra={
+            "method": method,
+            "endpoint": _endpoint(url),
+            "delay_seconds": round(delay, 2),
+            "status": response.status_code if response is not None else type(error).__name__,
+        })
+        await asyncio.sleep(delay)
+
+
+async def strava_get(client: httpx.AsyncClient, url: str, retry: bool = True, **kwargs) -> httpx.Response:
+    """GET through the circuit breaker, retrying transient failures (GETs are safe to repeat)"""
+    return await strava_request(client, "GET", url, retry=retry, **kwargs)
+
+
+async def within_deadline(awaitable, deadline: Optional[float]):
+    """Await something, giving up with DeadlineExceeded (and cancelling it) at the deadline.
+
+    httpx timeouts apply per connect/read/write, so a slowly trickling response can
+    outlast one; this is the hard cap.
+    """
+    if deadline is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(deadline - time.monotonic(), 0))
+    except asyncio.TimeoutError as e:
+        raise DeadlineExceeded("Deadline reached") from e
+
+
+def get_connected_user(db: Session) -> Optional[models.User]:
+    """The most recently active athlete with a Strava token, for jobs that only need API access"""
+    return (
+        db.query(models.User)
+        .filter(models.User.strava_access_token.isnot(None))
+        .order_by(models.User.updated_at.desc())
+        .first()
+    )
+
+
+async def refresh_strava_token_async(user: models.User, db: Session, deadline: Optional[float] = None):
+    """Refresh Strava access token"""
+    if not user.strava_refresh_token:
+        return None
+
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await strava_request(
+                client,
+                "POST",
+                STRAVA_TOKEN_URL,
+                retry=True,  # Repeating a refresh just returns the current token again
+                deadline=deadline,
+                data={
+                    "client_id": os.getenv("STRAVA_CLIENT_ID"),
+                    "client_secret": os.getenv("STRAVA_CLIENT_SECRET"),
+                    "grant_type": "refresh_token",
+                    "refresh_token": user.strava_refresh_token,
+                },
+                timeout=10.0
+            )
+
+            if response.status_code != 200:
+                logger.warning("Token refresh failed", extra={
+                    "status_code": response.status_code, "detail": response.text[:200],
+                })
+                metrics.strava_token_refreshes.inc(result="rejected")
+                return None
+
+            token_data = response.json()
+
+            if "access_token" in token_data:
+                user.strava_access_token = token_data["access_token"]
+                user.strava_refresh_token = token_data.get("refresh_token", user.strava_refresh_token)
+                expires_in = token_data.get("expires_at", 0)
+                user.token_expires_at = datetime.fromtimestamp(expires_in) if expires_in else None
+                db.commit()
+                metrics.strava_token_refreshes.inc(result="success")
+                return user.strava_access_token
+    except (StravaUnavailable, DeadlineExceeded):
+        metrics.strava_token_refreshes.inc(result="error")
+        raise
+    except Exception as e:
+        logger.warning("Error refreshing token", extra={"error": str(e)})
+        metrics.strava_token_refreshes.inc(result="error")
+        return None
+
+    return None
+
+
+def token_needs_refresh(user: models.User) -> bool:
+    """Whether the access token is expired or expires soon (within 5 minutes)"""
+    return bool(user.token_expires_at and user.token_expires_at <= datetime.utcnow() + timedelta(minutes=5))
+
+
+async def get_valid_access_token_async(user: models.User, db: Session, deadline: Optional[float] = None):
+    """Get valid access token, refreshing if needed"""
+    if not user.strava_access_token:
+        return None
+
+    if token_needs_refresh(user):
+        return await tracing.traced("strava.token_refresh", refresh_strava_token_async(user, db, deadline))
+
+    return user.strava_access_token
+
+
+def extract_map_data(segment_data: dict):
+    """Pull (polyline, start_latitude, start_longitude) out of a Strava segment response"""
+    # Strava API may return polyline in different formats:
+    # 1. Direct "polyline" field
+    # 2. Inside "map" object as "polyline" or "summary_polyline"
+    polyline = segment_data.get("polyline")
+    if not polyline or (isinstance(polyline, str) and polyline.strip() == ""):
+        map_obj = segment_data.get("map", {})
+        polyline = map_obj.get("polyline") or map_obj.get("summary_polyline")
+        # Convert empty strings to None
+        if polyline and isinstance(polyline, str) and polyline.strip() == "":
+            polyline = None
+
+    # Strava may return coordinates as:
+    # 1. Separate "start_latitude" and "start_longitude" fields
+    # 2. "start_latlng" array [latitude, longitude]
+    start_latitude = segment_data.get("start_latitude")
+    start_longitude = segment_data.get("start_longitude")
+
+    if not start_latitude or not start_longitude:
+        start_latlng = segment_data.get("start_latlng")
+        if start_latlng and isinstance(start_latlng, list) and len(start_latlng) >= 2:
+            start_latitude = start_latlng[0]
+            start_longitude = start_latlng[1]
+
+    # Convert to None if invalid (must be valid float/int and within valid lat/lng ranges)
+    if start_latitude is not None:
+        if not isinstance(start_latitude, (int, float)) or not (-90 <= start_latitude <= 90):
+            start_latitude = None
+    if start_longitude is not None:
+        if not isinstance(start_longitude, (int, float)) or not (-180 <= start_longitude <= 180):
+            start_longitude = None
+
+    return polyline, start_latitude, start_longitude
+
+
+def format_duration(seconds) -> str:
+    """Format seconds as M:SS (minutes aren't rolled over into hours)"""
+    minutes = seconds // 60
+    seconds = seconds % 60
+    return f"{int(minutes)}:{int(seconds):02d}"
+
+
+def format_pace(elapsed_time, distance_meters) -> Optional[str]:
+    """Pace in M:SS per mile"""
+    if not elapsed_time or not distance_meters or distance_meters <= 0:
+        return None
+    distance_miles = distance_meters / 1609.34
+    pace_seconds_per_mile = elapsed_time / distance_miles
+    pace_minutes = int(pace_seconds_per_mile // 60)
+    pace_seconds = int(pace_seconds_per_mile % 60)
+    return f"{pace_minutes}:{pace_seconds:02d}"
+
+
+def format_personal_best(elapsed_time, distance_meters, elevation_gain_meters):
+    """(time, pace, grade adjusted pace) strings for a personal best effort"""
+    if not elapsed_time or not distance_meters or distance_meters <= 0:
+        return None, None, None
+
+    personal_best_time = format_duration(elapsed_time)
+    personal_best_pace = format_pace(elapsed_time, distance_meters)
+    personal_best_grade_adjusted_pace = None
+
+    # Calculate Grade Adjusted Pace (GAP)
+    # GAP adjusts pace to what it would be on flat terrain
+    # Formula: GAP = actual_pace / (1 + k * grade)
+    # Where k ≈ 0.04 for uphill, k ≈ 0.02 for downhill
+    # Grade = elevation_gain / distance (as decimal)
+    if elevation_gain_meters > 0:
+        pace_seconds_per_mile = elapsed_time / (distance_meters / 1609.34)
+        grade = elevation_gain_meters / distance_meters  # Grade as decimal (e.g., 0.05 = 5%)
+        # Use k = 0.04 for uphill segments (positive grade)
+        # This is a simplified model - Strava's exact formula is proprietary
+        k = 0.04 if grade > 0 else 0.02
+        gap_factor = 1 + (k * grade)
+        gap_seconds_per_mile = pace_seconds_per_mile / gap_factor
+        gap_minutes = int(gap_seconds_per_mile // 60)
+        gap_seconds = int(gap_seconds_per_mile % 60)
+        personal_best_grade_adjusted_pace = f"{gap_minutes}:{gap_seconds:02d}"
+    elif elevation_gain_meters == 0:
+        # Flat segment - GAP equals actual pace
+        personal_best_grade_adjusted_pace = personal_best_pace
+
+    return personal_best_time, personal_best_pace, personal_best_grade_adjusted_pace
+
+
+def format_strava_date(start_date: Optional[str]) -> Optional[str]:
+    """Convert a Strava ISO timestamp to MM/DD/YYYY"""
+    if not start_date:
+        return None
+    try:
+        dt = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
+        return dt.strftime("%m/%d/%Y")
+    except ValueError:
+        return None
+
+
+def parse_duration(value: Optional[str]) -> Optional[int]:
+    """Parse a stored time string back into seconds.
+
+    Strava-derived times are M:SS; hand-entered ones may be MM:SS:00 (hundredths).
+    """
+    if not value:
+        return None
+    try:
+        parts = [int(part) for part in value.strip().split(":")]
+    except ValueError:
+        return None
+    if len(parts) == 2:
+        return parts[0] * 60 + parts[1]
+    if len(parts) == 3:
+        return parts[0] * 60 + parts[1]
+    return None
+
+
+def parse_attempt_date(value: Optional[str]) -> Optional[datetime]:
+    """Parse a stored MM/DD/YYYY date"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value.strip(), "%m/%d/%Y")
+    except ValueError:
+        return None
+
+
+async def _fetch_efforts_page(client: httpx.AsyncClient, segment_id: int, access_token: str,
+                              page: int, params: dict, deadline: Optional[float] = None) -> Optional[list]:
+    response = await strava_get(
+        client,
+        f"{STRAVA_API_URL}/segments/{segment_id}/all_efforts",
+        headers={"Authorization": f"Bearer {access_token}"},
+        params={**params, "per_page": EFFORTS_PER_PAGE, "page": page},
+        timeout=10.0,
+        deadline=deadline,
+    )
+    if response.status_code != 200:
+        return None
+    return response.json()
+
+
+async def fetch_all_efforts(client: httpx.AsyncClient, segment_id: int, access_token: str,
+                            total: Optional[int] = None, since: Optional[datetime] = None,
+                            deadline: Optional[float] = None) -> Optional[list]:
+    """Fetch every effort on a segment (optionally only those starting after `since`).
+
+    When the total is known (athlete_segment_stats.effort_count), the remaining pages
+    are fetched concurrently after the first. Returns None if any page fails, since
+    a partial list would give wrong attempt counts.
+    """
+    params = {}
+    if since:
+        params["start_date_local"] = since.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    first_page = await _fetch_efforts_page(client, segment_id, access_token, 1, params, deadline)
+    if first_page is None:
+        return None
+    pages = [first_page]
+
+    if len(first_page) == EFFORTS_PER_PAGE and total and not since:
+        page_count = min(math.ceil(total / EFFORTS_PER_PAGE), MAX_EFFORT_PAGES)
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_EFFORT_PAGES)
+
+        async def fetch_page(page: int):
+            async with semaphore:
+                return await _fetch_efforts_page(client, segment_id, access_token, page, params, deadline)
+
+        rest = await asyncio.gather(*(fetch_page(page) for page in range(2, page_count + 1)))
+        if any(page is None for page in rest):
+            return None
+        pages.extend(rest)
+
+    # Unknown total (or new efforts since it was reported): keep going until a short page
+    while len(pages[-1]) == EFFORTS_PER_PAGE and len(pages) < MAX_EFFORT_PAGES:
+        page = await _fetch_efforts_page(client, segment_id, access_token, len(pages) + 1, params, deadline)
+        if page is None:
+            return None
+        pages.append(page)
+
+    # Pages can shift while we read them; count each effort once
+    efforts = {}
+    for page in pages:
+        for effort in page:
+            efforts[effort.get("id", id(effort))] = effort
+    return list(efforts.values())
+
+
+def _effort_stats(efforts: list) -> EffortStats:
+    if not efforts:
+        return EffortStats(0, None, None, None, None)
+
+    best_effort = min(efforts, key=lambda e: e.get("elapsed_time", float('inf')))
+    latest_effort = max(efforts, key=lambda e: e.get("start_date", ""))
+    local_times = [t for t in (effort_local_time(e) for e in efforts) if t]
+    return EffortStats(
+        attempts=len(efforts),
+        best_elapsed_time=best_effort.get("elapsed_time"),
+        best_activity_id=(best_effort.get("activity") or {}).get("id"),
+        last_attempt_date=format_strava_date(latest_effort.get("start_date")),
+        synced_through=max(local_times) if local_times else None,
+    )
+
+
+async def sync_segment_efforts(client: httpx.AsyncClient, segment_id: int, access_token: str,
+                               effort_count: Optional[int] = None, db: Optional[Session] = None,
+                               user_id: Optional[int] = None, deadline: Optional[float] = None) -> Optional[EffortStats]:
+    """Sync a user's efforts on a segment into segment_efforts and return their stats.
+
+    If efforts are already stored, only those after the newest one are fetched. If
+    the stored count then doesn't match Strava's effort_count (a missed or deleted
+    effort), everything is fetched again and efforts Strava no longer has are
+    removed. Without a db/user_id the stats are worked out in memory instead.
+    """
+    if db is None or user_id is None:
+        efforts = await fetch_all_efforts(client, segment_id, access_token, total=effort_count, deadline=deadline)
+        return _effort_stats(efforts) if efforts is not None else None
+
+    since = segment_efforts.synced_through(db, user_id, segment_id)
+    if since:
+        new_efforts = await fetch_all_efforts(client, segment_id, access_token, since=since, deadline=deadline)
+        if new_efforts is not None:
+            segment_efforts.upsert_efforts(db, user_id, new_efforts, segment_id)
+            stats = segment_efforts.effort_stats(db, user_id, [segment_id]).get(segment_id)
+            if effort_count is None or (stats and stats.attempts == effort_count):
+                db.commit()
+                return stats
+            db.rollback()
+
+    efforts = await fetch_all_efforts(client, segment_id, access_token, total=effort_count, deadline=deadline)
+    if efforts is None:
+        return None
+    segment_efforts.upsert_efforts(db, user_id, efforts, segment_id)
+    segment_efforts.prune_efforts(db, user_id, segment_id, [effort["id"] for effort in efforts if effort.get("id")])
+    db.commit()
+    return segment_efforts.effort_stats(db, user_id, [segment_id]).get(segment_id) or EffortStats(0, None, None, None, None)
+
+
+async def fetch_crown(client: httpx.AsyncClient, segment_id: int, access_token: str, distance_meters,
+                      deadline: Optional[float] = None):
+    """(holder, time, date, pace) of the segment's top leaderboard entry, all None when unavailable"""
+    # Strava deprecated the leaderboard API in 2020, so this usually comes back empty
+    try:
+        leaderboard_response = await strava_get(
+            client,
+            f"{STRAVA_API_URL}/segments/{segment_id}/leaderboard",
+            headers={"Authorization": f"Bearer {access_token}"},
+            params={"per_page": 1},  # Just get the top entry
+            timeout=5.0,
+            deadline=deadline,
+        )
+        
+        if leaderboard_response.status_code == 200:
+            entries = leaderboard_response.json().get("entries", [])
+            
+            if entries:
+                # Get the top entry (KOM/QOM)
+                top_entry = entries[0]
+                athlete = top_entry.get("athlete_name", "")
+                elapsed_time = top_entry.get("elapsed_time")
+                
+                if athlete and elapsed_time:
+                    return (
+                        athlete,
+                        format_duration(elapsed_time),
+                        format_strava_date(top_entry.get("start_date")),
+                        format_pace(elapsed_time, distance_meters),
+                    )
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        # Leaderboard endpoint may be deprecated or unavailable - that's okay
+        logger.debug("Could not fetch leaderboard data", extra={"error": str(e), "sample_rate": DEBUG_SAMPLE_RATE})
+    return None, None, None, None
+
+
+def _raise_for_segment_response(response: httpx.Response):
+    if response.status_code == 404:
+        raise HTTPException(status_code=404, detail="Segment not found")
+    elif response.status_code == 401:
+        raise HTTPException(status_code=401, detail="Strava authentication expired. Please reconnect your Strava account.")
+    elif response.status_code == 429:
+        raise HTTPException(status_code=429, detail="Rate limit exceeded. Please try again in a few minutes.")
+    else:
+        error_text = response.text[:200] if response.text else "Unknown error"
+        raise HTTPException(
+            status_code=response.status_code, 
+            detail=f"Strava API error ({response.status_code}): {error_text}"
+        )
+
+
+async def fetch_segment_metadata_from_strava(segment_id: int, access_token: str,
+                                             client: Optional[httpx.AsyncClient] = None,
+                                             deadline: Optional[float] = None) -> schemas.StravaSegmentMetadata:
+    """Fetch segment metadata (name, distance, elevation, map and crown info) from Strava API.
+
+    If the deadline passes after the segment itself was fetched, the crown fields
+    are left empty and the result is marked partial.
+    """
+    if client is None:
+        async with httpx.AsyncClient() as client:
+            return await fetch_segment_metadata_from_strava(segment_id, access_token, client, deadline)
+
+    segment_response = await within_deadline(strava_get(
+        client,
+        f"{STRAVA_API_URL}/segments/{segment_id}",
+        headers={"Authorization": f"Bearer {access_token}"},
+        timeout=10.0,
+        deadline=deadline,
+    ), deadline)
+    if segment_response.status_code != 200:
+        _raise_for_segment_response(segment_response)
+    
+    segment_data = segment_response.json()
+    
+    # Strava gives elevation_high and elevation_low; gain is the difference
+    distance_meters = segment_data.get("distance", 0)
+    distance_miles = distance_meters / 1609.34 if distance_meters > 0 else None
+    elevation_high = segment_data.get("elevation_high", 0)
+    elevation_low = segment_data.get("elevation_low", 0)
+    elevation_gain_meters = elevation_high - elevation_low if elevation_high > elevation_low else 0
+    elevation_gain_feet = elevation_gain_meters * 3.28084 if elevation_gain_meters > 0 else None
+    
+    polyline, start_latitude, start_longitude = extract_map_data(segment_data)
+    logger.debug("Segment map data", extra={
+        "segment_id": segment_id,
+        "has_polyline": bool(polyline),
+        "start_latitude": start_latitude,
+        "start_longitude": start_longitude,
+        "sample_rate": DEBUG_SAMPLE_RATE,
+    })
+    
+    partial = False
+    try:
+        crown_holder, crown_time, crown_date, crown_pace = await within_deadline(
+            fetch_crown(client, segment_id, access_token, distance_meters, deadline), deadline
+        )
+    except DeadlineExceeded:
+        crown_holder = crown_time = crown_date = crown_pace = None
+        partial = True
+    
+    return schemas.StravaSegmentMetadata(
+        segment_id=segment_id,
+        segment_name=segment_data.get("name", ""),
+        distance=round(distance_miles, 2) if distance_miles else None,
+        elevation_gain=round(elevation_gain_feet, 1) if elevation_gain_feet else None,
+        strava_url=f"https://www.strava.com/segments/{segment_id}",
+        polyline=polyline,
+        start_latitude=start_latitude,
+        start_longitude=start_longitude,
+        crown_holder=crown_holder,
+        crown_time=crown_time,
+        crown_date=crown_date,
+        crown_pace=crown_pace,
+        partial=partial,
+    )
+
+
+async def fetch_segment_times_from_strava(segment_id: int, access_token: str, client: Optional[httpx.AsyncClient] = None,
+                                          db: Optional[Session] = None, user_id: Optional[int] = None,
+                                          deadline: Optional[float] = None) -> schemas.StravaSegmentTime:
+    """Fetch segment times from Strava API.
+
+    With db and user_id, the user's efforts are synced into segment_efforts
+    (incrementally after the first time) and the stats come from there.
+
+    Every call is bounded by `deadline` (a time.monotonic() value). The segment
+    itself is required, but if the deadline passes while the crown or efforts are
+    being fetched, the fields already known are returned (personal stats from what
+    is stored) and the result is marked partial.
+    """
+    if client is None:
+        async with httpx.AsyncClient() as client:
+            return await fetch_segment_times_from_strava(segment_id, access_token, client, db, user_id, deadline)
+
+    # Get segment details (name, distance and map data come from here)
+    segment_response = await within_deadline(strava_get(
+        client,
+        f"{STRAVA_API_URL}/segments/{segment_id}",
+        headers={"Authorization": f"Bearer {access_token}"},
+        timeout=10.0,
+        deadline=deadline,
+    ), deadline)
+    
+    if segment_response.status_code != 200:
+        _raise_for_segment_response(segment_response)
+    
+    segment_data = segment_response.json()
+    segment_name = segment_data.get("name", "")
+    distance_meters = segment_data.get("distance", 0)
+    elevation_high = segment_data.get("elevation_high", 0)
+    elevation_low = segment_data.get("elevation_low", 0)
+    elevation_gain_meters = elevation_high - elevation_low if elevation_high > elevation_low else 0
+    polyline, start_latitude, start_longitude = extract_map_data(segment_data)
+    
+    # Leaderboard and athlete's efforts (only those since the last sync when some are stored)
+    # don't depend on each other, so they share what is left of the deadline
+    effort_count = (segment_data.get("athlete_segment_stats") or {}).get("effort_count")
+    crown, effort_stats = await asyncio.gather(
+        within_deadline(tracing.traced(
+            "strava.crown", fetch_crown(client, segment_id, access_token, distance_meters, deadline)
+        ), deadline),
+        within_deadline(tracing.traced(
+            "strava.efforts_sync", sync_segment_efforts(client, segment_id, access_token, effort_count, db, user_id, deadline)
+        ), deadline),
+        return_exceptions=True,
+    )
+    
+    partial = False
+    if isinstance(crown, DeadlineExceeded):
+        crown, partial = (None, None, None, None), True
+    elif isinstance(crown, BaseException):
+        raise crown
+    crown_holder, crown_time, crown_date, crown_pace = crown
+    
+    if isinstance(effort_stats, DeadlineExceeded):
+        effort_stats, partial = None, True
+        if db is not None and user_id is not None:
+            db.rollback()
+            effort_stats = segment_efforts.effort_stats(db, user_id, [segment_id]).get(segment_id)
+    elif isinstance(effort_stats, BaseException):
+        raise effort_stats
+    
+    personal_best_time = None
+    personal_best_pace = None
+    personal_best_grade_adjusted_pace = None
+    personal_attempts = 0
+    last_attempt_date = None
+    personal_best_activity_id = None
+    
+    if effort_stats:
+        personal_attempts = effort_stats.attempts
+        personal_best_activity_id = effort_stats.best_activity_id
+        last_attempt_date = effort_stats.last_attempt_date
+        personal_best_time, personal_best_pace, personal_best_grade_adjusted_pace = format_personal_best(
+            effort_stats.best_elapsed_time, distance_meters, elevation_gain_meters
+        )
+    
+    return schemas.StravaSegmentTime(
+        segment_id=segment_id,
+        segment_name=segment_name,
+        personal_best_time=personal_best_time,
+        personal_best_pace=personal_best_pace,
+        personal_best_grade_adjusted_pace=personal_best_grade_adjusted_pace,
+        personal_attempts=personal_attempts if personal_attempts > 0 else None,
+        last_attempt_date=last_attempt_date,
+        personal_best_activity_id=personal_best_activity_id,
+        polyline=polyline,
+        start_latitude=start_latitude,
+        start_longitude=start_longitude,
+        crown_holder=crown_holder,
+        crown_time=crown_time,
+        crown_date=crown_date,
+        crown_pace=crown_pace,
+        partial=partial,
+    )
+
+
+def _parse_rate_limit_header(value: Optional[str]):
+    """Parse an "X-RateLimit-*" header ("short,daily") into a tuple of ints"""
+    if not value:
+        return None
+    try:
+        short_term, daily = (int(part.strip()) for part in value.split(",")[:2])
+        return short_term, daily
+    except ValueError:
+        return None
+
+
+class RateLimiter:
+    """Bounds concurrent Strava requests and pauses when the quota is nearly used up.
+
+    Strava reports usage on every response in the X-RateLimit-Limit and
+    X-RateLimit-Usage headers. Once the remaining short-term quota drops to
+    `reserve`, new requests wait for the next 15-minute window instead of
+    collecting 429s.
+    """
+
+    def __init__(self, max_concurrency: int = 8, reserve: int = 5):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.reserve = reserve
+        self.limit = None  # (short_term, daily)
+        self.usage = None  # (short_term, daily)
+        self._paused_until = 0.0
+
+    @property
+    def remaining(self) -> Optional[int]:
+        """Requests left in the current short-term window, if known"""
+        if not self.limit or not self.usage:
+            return None
+        return min(self.limit[0] - self.usage[0], self.limit[1] - self.usage[1])
+
+    def update(self, response: httpx.Response):
+        limit = _parse_rate_limit_header(response.headers.get("X-RateLimit-Limit"))
+        usage = _parse_rate_limit_header(response.headers.get("X-RateLimit-Usage"))
+        if limit and usage:
+            self.limit, self.usage = limit, usage
+
+    def seconds_until_window_reset(self) -> float:
+        return RATE_LIMIT_WINDOW_SECONDS - (time.time() % RATE_LIMIT_WINDOW_SECONDS) + 1
+
+    def pause(self, seconds: float):
+        """Hold back every new request for `seconds` (e.g. after a 429)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def backoff_delay(self, response: Optional[httpx.Response], attempt: int, cap: float = 60.0) -> float:
+        """How long to wait before retrying a failed request.
+
+        Uses Retry-After when Strava sends it, waits for the next window when the
+        quota is known to be used up, and otherwise backs off exponentially with
+        jitter so concurrent workers don't retry in lockstep.
+        """
+        if response is not None:
+            retry_after = retry_after_seconds(response)
+            if retry_after is not None:
+                return retry_after
+            if response.status_code == 429 and self.remaining is not None and self.remaining <= 0:
+                return self.seconds_until_window_reset()
+        return random.uniform(0, min(cap, 2 ** attempt))
+
+    async def _wait_for_quota(self):
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+        remaining = self.remaining
+        if remaining is None or remaining > self.reserve:
+            return
+        if self.limit[1] - self.usage[1] <= self.reserve:
+            raise RuntimeError("Strava daily rate limit reached. Try again tomorrow.")
+
+        wait_seconds = self.seconds_until_window_reset()
+        logger.info(f"⏳ Strava rate limit nearly reached, waiting {int(wait_seconds)}s for the next window...",
+                    extra={"wait_seconds": int(wait_seconds)})
+        await asyncio.sleep(wait_seconds)
+        # The new window starts fresh - the next response will tell us the real usage
+        self.usage = (0, self.usage[1])
+
+    async def get(self, client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Response:
+        """GET through the limiter, recording the rate limit headers from the response"""
+        async with self._semaphore:
+            await self._wait_for_quota()
+            # Callers retry themselves, pausing every worker on a 429
+            response = await strava_get(client, url, retry=False, **kwargs)
+            self.update(response)
+            return response
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Strava webhook (push subscription) handling.
+
+Strava POSTs an event whenever a connected athlete creates, updates or deletes an
+activity, or deauthorizes the app. The API stores each event in the
+strava_webhook_events table and answers straight away; the queue is drained
+after the response is sent. Processing an activity event fetches that one
+activity and updates PB, attempts and last attempt date for only the segments
+it touched (stored in segment_efforts), so Strava calls scale with activity
+volume rather than page loads.
+
+Usage:
+    python strava_webhooks.py process                         # Drain queued events
+    python strava_webhooks.py send --activity 123 --owner 456 # Send a fake event to a local API
+    python strava_webhooks.py subscribe --callback-url https://api.example.com/strava/webhook
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import httpx
+from dotenv import load_dotenv
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+import app_logging
+import models
+from database import SessionLocal
+import segment_efforts
+import stats_refresher
+from strava_client import STRAVA_API_URL, StravaUnavailable, get_valid_access_token_async, strava_get
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger("strava_webhooks")
+
+# Token Strava echoes back during the subscription handshake
+STRAVA_WEBHOOK_VERIFY_TOKEN = os.getenv("STRAVA_WEBHOOK_VERIFY_TOKEN")
+# ID of our push subscription (printed by `subscribe`); events carrying any other ID are refused
+STRAVA_WEBHOOK_SUBSCRIPTION_ID = os.getenv("STRAVA_WEBHOOK_SUBSCRIPTION_ID")
+
+# Events handled per drain
+PROCESS_BATCH_SIZE = 50
+
+# A claim older than this belongs to a drain that died; another drain takes the event over
+CLAIM_TIMEOUT_SECONDS = 600
+
+# Only one drain at a time per process; other processes are kept apart by claims (claimed_at)
+_drain_lock = asyncio.Lock()
+
+
+def subscription_matches(event) -> bool:
+    """Strava sends our subscription's ID with every event, so anything else didn't come from Strava"""
+    if not STRAVA_WEBHOOK_SUBSCRIPTION_ID or not isinstance(event, dict):
+        return False
+    return str(event.get("subscription_id")) == STRAVA_WEBHOOK_SUBSCRIPTION_ID
+
+
+def record_event(db: Session, event: dict) -> models.StravaWebhookEvent:
+    """Queue an incoming webhook event"""
+    updates = event.get("updates")
+    db_event = models.StravaWebhookEvent(
+        object_type=event["object_type"],
+        object_id=event["object_id"],
+        aspect_type=event["aspect_type"],
+        owner_id=event["owner_id"],
+        event_time=event.get("event_time"),
+        updates=json.dumps(updates) if updates else None,
+    )
+    db.add(db_event)
+    db.commit()
+    return db_event
+
+
+def apply_activity_efforts(db: Session, user_id: int, efforts: list) -> int:
+    """Merge segment efforts from one activity into the athlete's segment_efforts and stats.
+
+    Only segments in the items table are touched, in one IN query. Efforts are
+    upserted by ID, so a repeated or updated activity is never counted twice.
+    Segments whose efforts were never synced are left for the background refresher
+    to sync in full. Returns the number of items updated.
+    """
+    segment_ids = {(effort.get("segment") or {}).get("id") for effort in efforts} - {None}
+    if not segment_ids:
+        return 0
+
+    tracked = [row[0] for row in db.query(models.Item.strava_segment_id).filter(
+        models.Item.strava_segment_id.in_(list(segment_ids))
+    )]
+    synced = segment_efforts.synced_segment_ids(db, user_id, tracked)
+
+    segment_efforts.upsert_efforts(db, user_id, [
+        effort for effort in efforts if (effort.get("segment") or {}).get("id") in synced
+    ])
+
+    # Without stored history a PB from this activity alone could be wrong
+    unsynced = [segment_id for segment_id in tracked if segment_id not in synced]
+    if unsynced:
+        db.query(models.Item).filter(models.Item.strava_segment_id.in_(unsynced)).update(
+            {models.Item.stats_refreshed_at: None}, synchronize_session=False
+        )
+        stats_refresher.mark_user_stats_stale(db, user_id, unsynced)
+
+    return stats_refresher.recompute_user_stats(db, user_id, list(synced)) + len(unsynced)
+
+
+async def _process_activity_event(db: Session, db_event: models.StravaWebhookEvent, client: httpx.AsyncClient):
+    user = db.query(models.User).filter(models.User.strava_id == db_event.owner_id).first()
+    if not user:
+        return  # Not one of our athletes
+
+    if db_event.aspect_type == "delete":
+        # Stored efforts say which segments the activity was on
+        segment_ids = segment_efforts.delete_activity_efforts(db, user.id, db_event.object_id)
+        updated = stats_refresher.recompute_user_stats(db, user.id, segment_ids)
+        logger.info(f"Webhook: deleted activity {db_event.object_id} updated {updated} tracked segment(s)",
+                    extra={"activity_id": db_event.object_id, "updated": updated})
+        return
+
+    user_id = user.id
+    access_token = await get_valid_access_token_async(user, db)
+    if not access_token:
+        raise RuntimeError(f"No valid Strava token for athlete {db_event.owner_id}")
+
+    # Nothing is written yet; don't sit in a transaction while Strava answers
+    db.commit()
+    response = await strava_get(
+        client,
+        f"{STRAVA_API_URL}/activities/{db_event.object_id}",
+        headers={"Authorization": f"Bearer {access_token}"},
+        params={"include_all_efforts": "true"},
+        timeout=10.0,
+    )
+    if response.status_code == 404:
+        return  # Deleted or made private since the event was sent
+    response.raise_for_status()
+
+    efforts = response.json().get("segment_efforts") or []
+    updated = apply_activity_efforts(db, user_id, efforts)
+    logger.info(f"Webhook: activity {db_event.object_id} updated {updated} tracked segment(s)",
+                extra={"activity_id": db_event.object_id, "updated": updated})
+
+
+async def _access_revoked(db: Session, user: models.User, client: httpx.AsyncClient) -> bool:
+    """Ask Strava whether the athlete's tokens have stopped working"""
+    access_token = await get_valid_access_token_async(user, db)
+    if not access_token:
+        return True  # Strava refused the refresh token
+    db.commit()
+    response = await strava_get(
+        client,
+        f"{STRAVA_API_URL}/athlete",
+        headers={"Authorization": f"Bearer {access_token}"},
+        timeout=10.0,
+    )
+    if response.status_code == 401:
+        return True
+    response.raise_for_status()
+    return False
+
+
+async def _process_athlete_event(db: Session, db_event: models.StravaWebhookEvent, client: httpx.AsyncClient):
+    updates = json.loads(db_event.updates) if db_event.updates else {}
+    if str(updates.get("authorized", "")).lower() != "false":
+        return
+
+    user = db.query(models.User).filter(models.User.strava_id == db_event.owner_id).first()
+    if not user or not user.strava_access_token:
+        return
+    # Only forget the tokens once Strava confirms they were revoked
+    if not await _access_revoked(db, user, client):
+        logger.warning(f"Webhook: deauthorization for athlete {db_event.owner_id} not confirmed by Strava",
+                       extra={"owner_id": db_event.owner_id})
+        return
+    user.strava_access_token = None
+    user.strava_refresh_token = None
+    user.token_expires_at = None
+
+
+def _claim_events(db: Session, limit: int) -> List[int]:
+    """Mark up to limit queued events as taken by this drain. Commits, so no row locks
+    are held while the events are processed."""
+    abandoned = datetime.utcnow() - timedelta(seconds=CLAIM_TIMEOUT_SECONDS)
+    # SKIP LOCKED lets several instances claim at once without waiting on each other
+    events = (
+        db.query(models.StravaWebhookEvent)
+        .filter(
+            models.StravaWebhookEvent.processed_at.is_(None),
+            or_(models.StravaWebhookEvent.claimed_at.is_(None), models.StravaWebhookEvent.claimed_at < abandoned),
+        )
+        .order_by(models.StravaWebhookEvent.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    claimed_at = datetime.utcnow()
+    for db_event in events:
+        db_event.claimed_at = claimed_at
+    event_ids = [db_event.id for db_event in events]
+    db.commit()
+    return event_ids
+
+
+def _release_claims(db: Session, event_ids: List[int]):
+    db.query(models.StravaWebhookEvent).filter(models.StravaWebhookEvent.id.in_(event_ids)).update(
+        {models.StravaWebhookEvent.claimed_at: None}, synchronize_session=False
+    )
+    db.commit()
+
+
+async def process_pending_events(limit: int = PROCESS_BATCH_SIZE) -> int:
+    """Process queued webhook events in arrival order. Returns how many were handled.
+
+    Each event commits on its own, together with what it wrote; an event that fails
+    part-way is rolled back and only its error is kept.
+    """
+    async with _drain_lock:
+        db = SessionLocal()
+        try:
+            event_ids = _claim_events(db, limit)
+
+            handled = 0
+            async with httpx.AsyncClient() as client:
+                for position, event_id in enumerate(event_ids):
+                    db_event = db.get(models.StravaWebhookEvent, event_id)
+                    try:
+                        if db_event.object_type == "activity":
+                            await _process_activity_event(db, db_event, client)
+                        elif db_event.object_type == "athlete":
+                            await _process_athlete_event(db, db_event, client)
+                    except StravaUnavailable:
+                        # Leave this and later events queued until Strava recovers
+                        db.rollback()
+                        _release_claims(db, event_ids[position:])
+                        logger.warning("Webhook: Strava unavailable, leaving remaining events queued")
+                        break
+                    except Exception as e:
+                        db.rollback()
+                        logger.warning(f"Webhook: error processing event {event_id}",
+                                       extra={"event_id": event_id, "error": str(e)})
+                        db_event.error = str(e)[:500]
+                    db_event.processed_at = datetime.utcnow()
+                    # Later events for the same activity need to see this one's efforts
+                    db.commit()
+                    handled += 1
+
+            return handled
+        finally:
+            db.close()
+
+
+async def send_fake_event(api_url: str, object_id: int, owner_id: int,
+                          object_type: str = "activity", aspect_type: str = "create",
+                          updates: Optional[dict] = None):
+    """POST an event shaped like Strava's to a running API, for local testing"""
+    event = {
+        "object_type": object_type,
+        "object_id": object_id,
+        "aspect_type": aspect_type,
+        "owner_id": owner_id,
+        "subscription_id": int(STRAVA_WEBHOOK_SUBSCRIPTION_ID or 0),
+        "event_time": int(time.time()),
+        "updates": updates or {},
+    }
+    async with httpx.AsyncClient() as client:
+        response = await client.post(f"{api_url}/strava/webhook", json=event, timeout=10.0)
+    print(f"{response.status_code} {response.text}")
+
+
+async def create_subscription(callback_url: str):
+    """Register the webhook callback with Strava (one subscription per app)"""
+    async with httpx.AsyncClient() as client:
+        response = await client.post(
+            f"{STRAVA_API_URL}/push_subscriptions",
+            data={
+                "client_id": os.getenv("STRAVA_CLIENT_ID"),
+                "client_secret": os.getenv("STRAVA_CLIENT_SECRET"),
+                "callback_url": callback_url,
+                "verify_token": STRAVA_WEBHOOK_VERIFY_TOKEN,
+            },
+            timeout=30.0,
+        )
+    print(f"{response.status_code} {response.text}")
+    if response.status_code in (200, 201):
+        print("Set STRAVA_WEBHOOK_SUBSCRIPTION_ID to the id above so the API accepts its events")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Strava webhook tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("process", help="Process queued webhook events")
+
+    send_parser = subparsers.add_parser("send", help="Send a fake webhook event to a local API")
+    send_parser.add_argument("--url", default=os.getenv("BACKEND_URL", "http://localhost:8000"))
+    send_parser.add_argument("--activity", type=int, help="Activity ID (activity events)")
+    send_parser.add_argument("--owner", type=int, required=True, help="Strava athlete ID")
+    send_parser.add_argument("--aspect", default="create", choices=["create", "update", "delete"])
+    send_parser.add_argument("--deauthorize", action="store_true", help="Send an athlete deauthorization event")
+
+    subscribe_parser = subparsers.add_parser("subscribe", help="Create the Strava push subscription")
+    subscribe_parser.add_argument("--callback-url", required=True)
+
+    args = parser.parse_args()
+    app_logging.configure_logging(fmt="text")
+
+    if args.command == "process":
+        handled = asyncio.run(process_pending_events())
+        print(f"Processed {handled} event(s)")
+    elif args.command == "send":
+        if args.deauthorize:
+            asyncio.run(send_fake_event(args.url, args.owner, args.owner, "athlete", "update", {"authorized": "false"}))
+        elif args.activity:
+            asyncio.run(send_fake_event(args.url, args.activity, args.owner, aspect_type=args.aspect))
+        else:
+            parser.error("send needs --activity or --deauthorize")
+    elif args.command == "subscribe":
+        if not STRAVA_WEBHOOK_VERIFY_TOKEN:
+            parser.error("Set STRAVA_WEBHOOK_VERIFY_TOKEN first")
+        asyncio.run(create_subscription(args.callback_url))
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# The app reads DATABASE_URL at import time; tests get a throwaway SQLite file unless one is set
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/test.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,92 @@
+"""
+SingleFlight: concurrent callers share one call, its result and its errors, and
+cancelling callers never leaks a cancelled call to a caller that arrives later.
+"""
+
+import asyncio
+
+import pytest
+
+from coalescing import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return {"segment": 1}
+
+    async def main():
+        return await asyncio.gather(*(flight.run("segment:1", fetch) for _ in range(3)))
+
+    results = asyncio.run(main())
+    assert calls == 1
+    assert [result for result, _ in results] == [{"segment": 1}] * 3
+    assert [joined for _, joined in results] == [False, True, True]
+    assert flight.snapshot() == {"in_flight": 0, "started": 1, "joined": 2}
+
+
+def test_errors_reach_every_caller_and_are_not_kept():
+    flight = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        raise RuntimeError("Strava said no")
+
+    async def main():
+        results = await asyncio.gather(*(flight.run("k", fetch) for _ in range(2)), return_exceptions=True)
+        # The key is forgotten once the call fails, so the next caller tries again
+        retry = await asyncio.gather(flight.run("k", fetch), return_exceptions=True)
+        return results + retry
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert calls == 2
+
+
+def test_cancelled_caller_leaves_others_waiting():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return "times"
+
+    async def main():
+        first = asyncio.ensure_future(flight.run("k", fetch))
+        second = asyncio.ensure_future(flight.run("k", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == ("times", True)
+
+
+def test_caller_after_last_waiter_cancelled_starts_a_new_call():
+    flight = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return calls
+
+    async def main():
+        first = asyncio.ensure_future(flight.run("k", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        # The abandoned call's cancellation hasn't landed yet; this caller must not join it
+        return await flight.run("k", fetch)
+
+    assert asyncio.run(main()) == (2, False)
@@ -0,0 +1,49 @@
+"""
+SQL statement budgets for the hot endpoints. A change that adds a query (an N+1,
+a lazy load, an extra lookup) fails here and lists the statements that ran.
+"""
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from query_stats import query_budget
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture(scope="module")
+def item_id(client):
+    for i in range(3):
+        response = client.post("/items/", json={"segment_name": f"Budget segment {i}", "distance": 1.2})
+        assert response.status_code == 200
+    return response.json()["id"]
+
+
+def test_list_items(client, item_id):
+    with query_budget(1):
+        response = client.get("/items/")
+    assert response.status_code == 200
+    assert len(response.json()) >= 3
+
+
+def test_read_item(client, item_id):
+    with query_budget(1):
+        response = client.get(f"/items/{item_id}")
+    assert response.status_code == 200
+
+
+def test_create_item(client):
+    with query_budget(4):
+        response = client.post("/items/", json={"segment_name": "Budget segment new"})
+    assert response.status_code == 200
+
+
+def test_budget_lists_the_statements_when_exceeded(client, item_id):
+    with pytest.raises(AssertionError, match=r"Expected at most 0 queries, ran 1:\n  1\. SELECT"):
+        with query_budget(0):
+            client.get(f"/items/{item_id}")
@@ -0,0 +1,111 @@
+"""
+Rate limit buckets and client IP detection. The postgres backend tests need a
+PostgreSQL database to create rate_limit_buckets in: set TEST_POSTGRES_URL.
+"""
+
+import asyncio
+import os
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+from starlette.requests import Request
+
+import rate_limits
+from rate_limits import Limit, MemoryBackend, PostgresBackend
+
+TEST_POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+
+
+def make_request(client_host="10.0.0.1", forwarded=None) -> Request:
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers, "client": (client_host, 1234)})
+
+
+@pytest.fixture
+def postgres_backend():
+    if not TEST_POSTGRES_URL:
+        pytest.skip("TEST_POSTGRES_URL not set")
+    import migrations
+    engine = create_engine(TEST_POSTGRES_URL)
+    migrations.ensure_schema(engine)
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM rate_limit_buckets"))
+    yield PostgresBackend(engine)
+    engine.dispose()
+
+
+@pytest.fixture(params=["memory", "postgres"])
+def backend(request):
+    if request.param == "memory":
+        return MemoryBackend()
+    return request.getfixturevalue("postgres_backend")
+
+
+def test_bucket_allows_burst_then_refuses(backend):
+    limit = Limit("user", 3, 1)
+    results = [backend.take("user:1", limit) for _ in range(4)]
+    assert [allowed for allowed, _ in results] == [True, True, True, False]
+    assert results[2][1] == pytest.approx(0, abs=0.01)
+    # Other keys have their own bucket
+    assert backend.take("user:2", limit)[0]
+
+
+def test_bucket_refills_over_time(backend):
+    limit = Limit("user", 1, 600)  # 10 tokens a second
+    assert backend.take("user:1", limit)[0]
+    assert not backend.take("user:1", limit)[0]
+    time.sleep(0.15)
+    assert backend.take("user:1", limit)[0]
+
+
+def test_give_back_returns_a_token(backend):
+    limit = Limit("user", 1, 1)
+    assert backend.take("user:1", limit)[0]
+    backend.give_back("user:1", limit)
+    assert backend.take("user:1", limit)[0]
+
+
+def test_postgres_buckets_are_shared_between_instances(postgres_backend):
+    other_instance = PostgresBackend(postgres_backend.engine)
+    limit = Limit("ip", 2, 1)
+    assert postgres_backend.take("ip:10.0.0.1", limit)[0]
+    assert other_instance.take("ip:10.0.0.1", limit)[0]
+    assert not postgres_backend.take("ip:10.0.0.1", limit)[0]
+
+
+def test_check_runs_a_blocking_backend_in_the_threadpool(monkeypatch, postgres_backend):
+    monkeypatch.setattr(rate_limits, "backend", postgres_backend)
+    monkeypatch.setattr(rate_limits, "USER_LIMIT", Limit("user", 1, 1))
+    monkeypatch.setattr(rate_limits, "IP_LIMIT", Limit("ip", 5, 1))
+
+    first = asyncio.run(rate_limits.check(make_request(), 7))
+    second = asyncio.run(rate_limits.check(make_request(), 7))
+    assert not first.limited
+    assert first.headers["RateLimit-Remaining"] == "0"
+    assert second.limited
+    assert second.error().status_code == 429
+    assert "Retry-After" in second.headers
+
+
+def test_refused_request_gives_back_the_user_token(monkeypatch):
+    monkeypatch.setattr(rate_limits, "backend", MemoryBackend())
+    monkeypatch.setattr(rate_limits, "USER_LIMIT", Limit("user", 5, 1))
+    monkeypatch.setattr(rate_limits, "IP_LIMIT", Limit("ip", 1, 1))
+
+    assert not rate_limits.check_blocking(make_request(), 1).limited
+    assert rate_limits.check_blocking(make_request(), 1).limited  # IP bucket empty
+    allowed, tokens = rate_limits.backend.take("user:1", rate_limits.USER_LIMIT)
+    assert allowed and tokens == pytest.approx(3, abs=0.01)
+
+
+def test_client_ip_ignores_forwarded_for_without_trusted_proxies():
+    assert rate_limits.client_ip(make_request(forwarded="1.2.3.4"), trusted_proxies=0) == "10.0.0.1"
+
+
+def test_client_ip_reads_past_trusted_proxies_only():
+    request = make_request(forwarded="6.6.6.6, 1.2.3.4")  # Client-supplied entry, then the one our proxy added
+    assert rate_limits.client_ip(request, trusted_proxies=1) == "1.2.3.4"
+    assert rate_limits.client_ip(request, trusted_proxies=2) == "6.6.6.6"
+    # Fewer entries than proxies: fall back to the connection
+    assert rate_limits.client_ip(make_request(), trusted_proxies=1) == "10.0.0.1"
@@ -0,0 +1,251 @@
+"""
+The Strava call path: circuit breaker, retries with backoff and Retry-After, and
+deadlines that turn into partial results. Strava is an httpx MockTransport.
+"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import strava_client
+from strava_client import CircuitBreaker, DeadlineExceeded, StravaUnavailable
+
+URL = f"{strava_client.STRAVA_API_URL}/segments/1"
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    """A fresh breaker for every test, so tests don't trip each other's circuit"""
+    breaker = CircuitBreaker(failure_threshold=3, cooldown=60)
+    monkeypatch.setattr(strava_client, "strava_breaker", breaker)
+    return breaker
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Retry waits, recorded instead of slept"""
+    waited = []
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay, *args, **kwargs):
+        waited.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(strava_client.asyncio, "sleep", sleep)
+    return waited
+
+
+def mock_strava(*responses):
+    """A client answering with these responses in order (the last one repeats), and the requests it got"""
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return responses[min(len(requests), len(responses)) - 1]
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler)), requests
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_breaker_opens_after_failure_threshold(breaker):
+    async def main():
+        client, requests = mock_strava(httpx.Response(503))
+        async with client:
+            statuses = [(await strava_client.strava_get(client, URL, retry=False)).status_code for _ in range(3)]
+            with pytest.raises(StravaUnavailable):
+                await strava_client.strava_get(client, URL)
+        return statuses, len(requests)
+
+    statuses, sent = run(main())
+    assert statuses == [503, 503, 503]
+    assert sent == 3  # The call after the threshold never reached Strava
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == 1
+
+
+def test_client_errors_dont_count_as_failures(breaker):
+    async def main():
+        client, _ = mock_strava(httpx.Response(503), httpx.Response(503), httpx.Response(404), httpx.Response(503))
+        async with client:
+            for _ in range(4):
+                await strava_client.strava_get(client, URL, retry=False)
+
+    run(main())
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.consecutive_failures == 1
+
+
+def test_half_open_lets_one_probe_through(breaker):
+    breaker.cooldown = 0.05
+    for _ in range(3):
+        breaker.record_failure("503")
+    time.sleep(0.06)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    async def main():
+        async def slow_ok(request):
+            await asyncio.sleep(0.05)
+            return httpx.Response(200)
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(slow_ok)) as client:
+            return await asyncio.gather(
+                strava_client.strava_get(client, URL, retry=False),
+                strava_client.strava_get(client, URL, retry=False),
+                return_exceptions=True,
+            )
+
+    probe, other = run(main())
+    assert probe.status_code == 200
+    assert isinstance(other, StravaUnavailable)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_probe_reopens_the_circuit(breaker):
+    breaker.cooldown = 0.05
+    for _ in range(3):
+        breaker.record_failure("503")
+    time.sleep(0.06)
+
+    async def main():
+        client, _ = mock_strava(httpx.Response(503))
+        async with client:
+            return await strava_client.strava_get(client, URL, retry=False)
+
+    assert run(main()).status_code == 503
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == 2
+
+
+def test_retry_waits_for_retry_after(breaker, sleeps):
+    async def main():
+        client, requests = mock_strava(httpx.Response(429, headers={"Retry-After": "2"}), httpx.Response(200))
+        async with client:
+            response = await strava_client.strava_get(client, URL)
+        return response, len(requests)
+
+    response, sent = run(main())
+    assert response.status_code == 200
+    assert sent == 2
+    assert sleeps == [2.0]
+
+
+def test_retry_after_past_the_cap_returns_the_response(breaker, sleeps):
+    async def main():
+        too_long = str(int(strava_client.RETRY_MAX_DELAY) + 60)
+        client, requests = mock_strava(httpx.Response(429, headers={"Retry-After": too_long}), httpx.Response(200))
+        async with client:
+            response = await strava_client.strava_get(client, URL)
+        return response, len(requests)
+
+    response, sent = run(main())
+    assert response.status_code == 429
+    assert sent == 1
+    assert sleeps == []
+
+
+def test_server_errors_retry_with_capped_backoff(breaker, sleeps):
+    async def main():
+        client, requests = mock_strava(httpx.Response(502), httpx.Response(503), httpx.Response(200))
+        async with client:
+            response = await strava_client.strava_get(client, URL)
+        return response, len(requests)
+
+    response, sent = run(main())
+    assert response.status_code == 200
+    assert sent == 3
+    assert len(sleeps) == 2
+    assert all(0 <= delay <= strava_client.RETRY_MAX_DELAY for delay in sleeps)
+
+
+@pytest.mark.parametrize("status", [400, 401, 404])
+def test_client_errors_are_not_retried(breaker, sleeps, status):
+    async def main():
+        client, requests = mock_strava(httpx.Response(status), httpx.Response(200))
+        async with client:
+            response = await strava_client.strava_get(client, URL)
+        return response, len(requests)
+
+    response, sent = run(main())
+    assert response.status_code == status
+    assert sent == 1
+    assert sleeps == []
+
+
+def test_non_idempotent_requests_are_not_retried(breaker, sleeps):
+    async def main():
+        client, requests = mock_strava(httpx.Response(503), httpx.Response(200))
+        async with client:
+            response = await strava_client.strava_request(client, "POST", strava_client.STRAVA_TOKEN_URL)
+        return response, len(requests)
+
+    response, sent = run(main())
+    assert response.status_code == 503
+    assert sent == 1
+    assert sleeps == []
+
+
+def test_within_deadline_cancels_at_the_deadline():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def main():
+        await strava_client.within_deadline(slow(), time.monotonic() + 0.02)
+
+    with pytest.raises(DeadlineExceeded):
+        run(main())
+    assert cancelled == [True]
+
+
+def test_deadline_during_crown_and_efforts_returns_partial_times(breaker):
+    segment = {
+        "name": "Hill Climb", "distance": 1609.34, "elevation_high": 110, "elevation_low": 10,
+        "map": {"polyline": "abc"}, "start_latlng": [37.0, -122.0],
+        "athlete_segment_stats": {"effort_count": 3},
+    }
+
+    async def handler(request):
+        if request.url.path.endswith("/segments/1"):
+            return httpx.Response(200, json=segment)
+        await asyncio.sleep(1)  # Leaderboard and efforts outlast the deadline
+        return httpx.Response(200, json=[])
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await strava_client.fetch_segment_times_from_strava(
+                1, "token", client, deadline=time.monotonic() + 0.1,
+            )
+
+    started = time.monotonic()
+    times = run(main())
+    assert time.monotonic() - started < 0.5
+    assert times.partial
+    assert times.segment_name == "Hill Climb"
+    assert times.polyline == "abc"
+    assert times.crown_holder is None
+    assert times.personal_best_time is None
+    # Running out of our own time says nothing about Strava's health
+    assert breaker.consecutive_failures == 0
+
+
+def test_deadline_before_the_segment_arrives_raises(breaker):
+    async def handler(request):
+        await asyncio.sleep(1)
+        return httpx.Response(200, json={})
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            await strava_client.fetch_segment_times_from_strava(1, "token", client, deadline=time.monotonic() + 0.05)
+
+    with pytest.raises(DeadlineExceeded):
+        run(main())
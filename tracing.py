@@ -0,0 +1,318 @@
+"""
+Lightweight request tracing: timed spans around Strava calls, SQL statements and
+the segment stats lookups, collected per request.
+
+Every span of a request is kept in memory while it runs; when it finishes the
+trace is either exported or thrown away. Requests slower than TRACE_SLOW_MS and
+server errors are always kept, others with probability TRACE_SAMPLE_RATE. Kept
+traces go to a background thread that writes them to:
+
+    TRACE_FILE            one JSON object per trace per line
+    TRACE_OTLP_ENDPOINT   an OpenTelemetry collector's OTLP/HTTP JSON traces endpoint,
+                          e.g. http://localhost:4318/v1/traces
+
+With neither set, tracing is off and span() costs a context variable lookup. An
+incoming W3C traceparent header is honoured, so the spans join the caller's trace.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextvars import ContextVar
+from typing import List, Optional
+
+import httpx
+
+import app_logging
+import metrics
+
+TRACE_FILE = os.getenv("TRACE_FILE")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT")
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1000"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "strava-segment-tracker")
+
+ENABLED = bool(TRACE_FILE or TRACE_OTLP_ENDPOINT)
+
+# A runaway loop (e.g. a full effort resync) shouldn't hold thousands of spans per request
+MAX_SPANS_PER_TRACE = 1000
+
+# Traces waiting for the export thread, and how many go in one OTLP request
+EXPORT_QUEUE_SIZE = 1000
+OTLP_BATCH_SIZE = 50
+
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+logger = logging.getLogger("tracing")
+
+dropped_traces = metrics.Counter("traces_dropped_total", "Sampled traces dropped because the export queue was full")
+
+
+def _new_id(hex_digits: int) -> str:
+    return f"{random.getrandbits(hex_digits * 4):0{hex_digits}x}"
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "kind", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], attributes: dict, kind: str = "internal",
+                 start_ns: Optional[int] = None):
+        self.name = name
+        self.span_id = _new_id(16)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+
+class Trace:
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List[Span] = []
+        self.dropped_spans = 0
+
+    def add(self, span: Span):
+        if len(self.spans) < MAX_SPANS_PER_TRACE:
+            self.spans.append(span)
+        else:
+            self.dropped_spans += 1
+
+
+_trace_var: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_span_var: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+
+class span:
+    """Time the block as a span of the current request's trace (a no-op outside one).
+
+        with tracing.span("strava.token_refresh"):
+            ...
+    """
+
+    __slots__ = ("name", "attributes", "kind", "_trace", "_span", "_token")
+
+    def __init__(self, name: str, kind: str = "internal", **attributes):
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+
+    def __enter__(self) -> Optional[Span]:
+        self._trace = _trace_var.get()
+        if self._trace is None:
+            self._span = None
+            return None
+        parent = _span_var.get()
+        self._span = Span(self.name, parent.span_id if parent else None, self.attributes, self.kind)
+        self._token = _span_var.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._span is None:
+            return
+        _span_var.reset(self._token)
+        self._span.end_ns = time.time_ns()
+        if exc_type is not None:
+            self._span.error = exc_type.__name__
+        self._trace.add(self._span)
+
+
+async def traced(name: str, awaitable, **attributes):
+    """Await `awaitable` inside a span (handy for branches of an asyncio.gather)"""
+    with span(name, **attributes):
+        return await awaitable
+
+
+def record_span(name: str, start_ns: int, end_ns: int, **attributes):
+    """Add a span that was timed elsewhere (e.g. by SQLAlchemy events)"""
+    trace = _trace_var.get()
+    if trace is None:
+        return
+    parent = _span_var.get()
+    finished = Span(name, parent.span_id if parent else None, attributes, start_ns=start_ns)
+    finished.end_ns = end_ns
+    trace.add(finished)
+
+
+def annotate(**attributes):
+    """Set attributes on the innermost open span (the request's own span outside any other)"""
+    current = _span_var.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def _attribute_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+_OTLP_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+
+def _otlp_span(trace: Trace, s: Span) -> dict:
+    entry = {
+        "traceId": trace.trace_id,
+        "spanId": s.span_id,
+        "name": s.name,
+        "kind": _OTLP_KINDS.get(s.kind, 1),
+        "startTimeUnixNano": str(s.start_ns),
+        "endTimeUnixNano": str(s.end_ns or s.start_ns),
+        "attributes": [{"key": key, "value": _attribute_value(value)} for key, value in s.attributes.items()],
+    }
+    if s.parent_id:
+        entry["parentSpanId"] = s.parent_id
+    if s.error:
+        entry["status"] = {"code": 2, "message": s.error}
+    return entry
+
+
+def to_otlp(traces: List[Trace]) -> dict:
+    """Traces as an OTLP/HTTP JSON ExportTraceServiceRequest"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+        "scopeSpans": [{
+            "scope": {"name": "tracing"},
+            "spans": [_otlp_span(trace, s) for trace in traces for s in trace.spans],
+        }],
+    }]}
+
+
+def to_json_line(trace: Trace) -> str:
+    """A trace as one JSON line, span times in ms from the start of the request"""
+    started = min(s.start_ns for s in trace.spans)
+    root = next((s for s in trace.spans if s.kind == "server"), trace.spans[0])
+    return json.dumps({
+        "trace_id": trace.trace_id,
+        "name": root.name,
+        "duration_ms": round(((root.end_ns or root.start_ns) - root.start_ns) / 1e6, 2),
+        "dropped_spans": trace.dropped_spans,
+        "spans": [{
+            "name": s.name,
+            "span_id": s.span_id,
+            "parent_id": s.parent_id,
+            "start_ms": round((s.start_ns - started) / 1e6, 2),
+            "duration_ms": round(((s.end_ns or s.start_ns) - s.start_ns) / 1e6, 2),
+            "attributes": s.attributes,
+            "error": s.error,
+        } for s in sorted(trace.spans, key=lambda s: s.start_ns)],
+    }, default=str)
+
+
+class _Exporter:
+    """Writes sampled traces from a background thread, so exporting never holds up a request"""
+
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue(EXPORT_QUEUE_SIZE)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, trace: Trace):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            dropped_traces.inc()
+
+    def _run(self):
+        client = httpx.Client(timeout=5.0) if TRACE_OTLP_ENDPOINT else None
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < OTLP_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._export(batch, client)
+            except Exception as e:
+                logger.warning("Could not export traces", extra={"traces": len(batch), "error": str(e)})
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _export(self, batch: List[Trace], client: Optional[httpx.Client]):
+        if TRACE_FILE:
+            with open(TRACE_FILE, "a") as f:
+                f.write("".join(to_json_line(trace) + "\n" for trace in batch))
+        if client is not None:
+            client.post(TRACE_OTLP_ENDPOINT, json=to_otlp(batch)).raise_for_status()
+
+    def flush(self):
+        if self._thread is not None:
+            self._queue.join()
+
+
+exporter = _Exporter()
+atexit.register(exporter.flush)
+
+
+def flush():
+    """Wait until every sampled trace is exported (e.g. before a Lambda container is frozen)"""
+    exporter.flush()
+
+
+def should_export(duration_ms: float, status: int) -> bool:
+    return duration_ms >= TRACE_SLOW_MS or status >= 500 or random.random() < TRACE_SAMPLE_RATE
+
+
+class TracingMiddleware:
+    """ASGI middleware giving each request a trace, exported when it's sampled"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ENABLED:
+            return await self.app(scope, receive, send)
+
+        traceparent = TRACEPARENT_PATTERN.match(dict(scope["headers"]).get(b"traceparent", b"").decode("latin-1"))
+        trace = Trace(traceparent.group(1) if traceparent else _new_id(32))
+        root = Span(scope["method"], traceparent.group(2) if traceparent else None, {}, kind="server")
+        response = {"status": 500}
+
+        async def send_and_end(message):
+            await send(message)
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                # Background tasks still add spans, but the request's own duration ends here
+                root.end_ns = time.time_ns()
+
+        trace_token = _trace_var.set(trace)
+        span_token = _span_var.set(root)
+        try:
+            await self.app(scope, receive, send_and_end)
+        finally:
+            _span_var.reset(span_token)
+            _trace_var.reset(trace_token)
+            if root.end_ns is None:
+                root.end_ns = time.time_ns()
+            route = getattr(scope.get("route"), "path", None)
+            root.name = f"{scope['method']} {route or 'unmatched'}"
+            root.attributes.update({
+                "http.method": scope["method"],
+                "http.route": route or "",
+                "http.status_code": response["status"],
+                "request_id": app_logging.request_id_var.get() or "",
+            })
+            if response["status"] >= 500:
+                root.error = str(response["status"])
+            trace.add(root)
+            if should_export((root.end_ns - root.start_ns) / 1e6, response["status"]):
+                exporter.submit(trace)